@@ -0,0 +1,227 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Alerts on new apartments: saved searches matched against the listings which are new or changed
+since the last run.
+
+Each run compares the listings with the fingerprints (rent, rooms, size, description, location) of
+the previous run, so only the new or changed listings are matched, usually a few per run. The saved
+searches are compiled once into arrays of their ranges (sorted by the lower bound of the rent, the
+searches a listing can match are a prefix), and a grid of the bounding boxes of their areas. A
+listing is checked against the candidates of its grid cell only, the polygons and keywords of the
+few remaining searches last. Thousands of saved searches cost next to nothing per run.
+
+Saved searches (JSON list or one JSON object per line), all criteria are optional:
+    {"id": "family-zh", "rent": [null, 3200], "nRooms": [4.5, null], "size": [90, null],
+     "keywords": ["balkon"], "area": "Kreis4.geojson", "commute": {"mins_sbb_1": 35}}
+    rent, nRooms, size: [min, max], null for an open end
+    keywords: all of them in the description (case-insensitive)
+    area: GeoJSON geometry, Feature(Collection) or path to a GeoJSON file (see loadAreas)
+    commute: max. minutes per column of the commuting times (see CommutingTimes)
+
+Usage:
+    class MyAlerts(AlertEngine):
+        SEARCHES = 'searches.jsonl'
+        OUTPUT = 'alerts.jsonl'
+    alerts = MyAlerts().run(listings)   # pd.DataFrame of the alerts, appended to OUTPUT
+
+"""
+
+import json
+import os
+import time
+
+import numpy as np
+import pandas as pd
+from shapely.geometry import Point
+from shapely.prepared import prep
+
+from scrapeApartments import loadAreas
+
+
+class AlertEngine:
+    """
+    Matches saved searches incrementally against the listings.
+
+    Parameters:
+        SEARCHES (str or list): path to the saved searches (JSON list or JSON lines) or a list of dicts
+        OUTPUT (str): JSON lines file the alerts are appended to (the queue, None: not written)
+        STATE_PATH (str): fingerprints of the listings seen (pickle), to detect new and changed listings
+        KEY (list): columns identifying a listing (the first one present and not empty is used)
+        CHANGE_COLS (list): columns of the fingerprint, a change triggers a new evaluation of the listing
+        CELL_SIZE (float): size of the grid cells of the areas in degrees
+
+    Returns:
+        run(listings): pd.DataFrame of the alerts (search, change and the listing)
+        STATS: listings, new, changed, candidate pairs checked, alerts and seconds of the last run
+    """
+
+    SEARCHES = 'searches.jsonl'
+    OUTPUT = 'alerts.jsonl'
+    STATE_PATH = 'alerts_state.pkl'
+    KEY = ['url', 'address']
+    CHANGE_COLS = ['rent', 'nRooms', 'size', 'description', 'lat', 'lon']
+    CELL_SIZE = 0.05
+
+    RANGES = ['rent', 'nRooms', 'size']
+    OUTPUT_COLS = ['url', 'address', 'nRooms', 'size', 'rent', 'description', 'lat', 'lon', 'source']
+
+    def __init__(self):
+        self.SEARCH_LIST = self.SEARCHES if isinstance(self.SEARCHES, list) else loadSearches(self.SEARCHES)
+        self.__compile()
+        self.STATS = {}
+
+
+    def __compile(self):
+        """ Ranges as arrays (searches ordered by the lower bound of the rent), areas in a grid """
+        searches = sorted(self.SEARCH_LIST, key=lambda search: _bound((search.get('rent') or [None])[0], -np.inf))
+        self.IDS = np.array([str(search.get('id', i)) for i, search in enumerate(searches)], dtype=object)
+
+        attributes = list(self.RANGES)
+        for search in searches:
+            attributes += [col for col in (search.get('commute') or {}) if col not in attributes]
+        self.LOW = {}
+        self.HIGH = {}
+        for attribute in attributes:
+            if attribute in self.RANGES:
+                bounds = [search.get(attribute) or [None, None] for search in searches]
+            else:
+                bounds = [[None, (search.get('commute') or {}).get(attribute)] for search in searches]
+            self.LOW[attribute] = np.array([_bound(low, -np.inf) for low, high in bounds], dtype=float)
+            self.HIGH[attribute] = np.array([_bound(high, np.inf) for low, high in bounds], dtype=float)
+        self.RENT_LOWS = self.LOW['rent'] # sorted
+
+        self.KEYWORDS = [[keyword.lower() for keyword in search.get('keywords') or []] for search in searches]
+        self.AREAS = [None] * len(searches)
+        self.GRID = {}
+        everywhere = []
+        for i, search in enumerate(searches):
+            if not search.get('area'):
+                everywhere.append(i)
+                continue
+            polygons, names = loadAreas(search['area'])
+            self.AREAS[i] = [prep(polygon) for polygon in polygons]
+            for polygon in polygons:
+                lonMin, latMin, lonMax, latMax = polygon.bounds
+                for row in range(self.__cell(latMin), self.__cell(latMax) + 1):
+                    for col in range(self.__cell(lonMin), self.__cell(lonMax) + 1):
+                        self.GRID.setdefault((row, col), set()).add(i)
+        self.EVERYWHERE = np.array(everywhere, dtype=np.int64)
+        self.GRID = {cell: np.array(sorted(numbers), dtype=np.int64) for cell, numbers in self.GRID.items()}
+
+
+    def __cell(self, degrees):
+        return int(np.floor(degrees / self.CELL_SIZE))
+
+
+    def run(self, listings):
+        """
+        Matches the new and changed listings against the saved searches, appends the alerts to OUTPUT
+        and stores the fingerprints of all listings for the next run.
+        """
+        t0 = time.time()
+        listings = listings.reset_index(drop=True)
+        keys = self.__keys(listings)
+        fingerprints = pd.Series(pd.util.hash_pandas_object(listings[[col for col in self.CHANGE_COLS if col in listings.columns]],
+                                                            index=False).to_numpy(), index=keys)
+        fingerprints = fingerprints[~fingerprints.index.duplicated(keep='last')]
+
+        previous = pd.read_pickle(self.STATE_PATH) if self.STATE_PATH and os.path.exists(self.STATE_PATH) else pd.Series(dtype='uint64')
+        known = keys.isin(previous.index)
+        changed = known & (previous.reindex(keys).to_numpy() != fingerprints.reindex(keys).to_numpy())
+        delta = np.flatnonzero(~known | changed)
+
+        pairs = self.match(listings.iloc[delta])
+        alerts = listings.iloc[delta[pairs[:, 0]]][[col for col in self.OUTPUT_COLS if col in listings.columns]]
+        alerts.insert(0, 'search', self.IDS[pairs[:, 1]])
+        alerts.insert(1, 'change', np.where(changed[delta[pairs[:, 0]]], 'changed', 'new'))
+        alerts = alerts.reset_index(drop=True)
+
+        if self.OUTPUT and len(alerts) > 0:
+            lines = alerts.assign(time=time.time()).to_json(orient='records', lines=True, force_ascii=False)
+            with open(self.OUTPUT, 'a', encoding='utf-8') as file:
+                file.write(lines.rstrip('\n') + '\n')
+        if self.STATE_PATH:
+            state = pd.concat([previous[~previous.index.isin(fingerprints.index)], fingerprints])
+            state.to_pickle(self.STATE_PATH + '.tmp')
+            os.replace(self.STATE_PATH + '.tmp', self.STATE_PATH) # no partial state after a crash
+
+        self.STATS.update({'listings': len(listings), 'new': int((~known).sum()), 'changed': int(changed.sum()),
+                           'alerts': len(alerts), 'seconds': time.time() - t0})
+        print("AlertEngine: {} new, {} changed listings, {} alerts.".format(self.STATS['new'], self.STATS['changed'], len(alerts)))
+        return alerts
+
+
+    def __keys(self, listings):
+        """ Identifier per listing: the first column of KEY with a value """
+        keys = pd.Series([None] * len(listings), dtype=object)
+        for col in self.KEY:
+            if col in listings.columns:
+                values = listings[col].astype(object)
+                keys = keys.where(keys.notna(), values.where(values.notna() & (values.astype(str) != '')))
+        return pd.Index(keys.fillna('').astype(str))
+
+
+    def match(self, listings):
+        """
+        Matches listings against all saved searches.
+
+        Parameters
+        ----------
+        listings : pd.DataFrame
+            with (some of) rent, nRooms, size, description, lat, lon and the commuting times
+
+        Returns
+        -------
+        np.array (n,2) of (row number of the listing, number of the search)
+
+        """
+        values = {}
+        for attribute in self.LOW:
+            column = listings[attribute] if attribute in listings.columns else pd.Series(np.nan, index=listings.index)
+            values[attribute] = pd.to_numeric(column, errors='coerce').to_numpy(dtype=float)
+        lat = pd.to_numeric(listings['lat'], errors='coerce').to_numpy(dtype=float) if 'lat' in listings.columns else np.full(len(listings), np.nan)
+        lon = pd.to_numeric(listings['lon'], errors='coerce').to_numpy(dtype=float) if 'lon' in listings.columns else np.full(len(listings), np.nan)
+        texts = listings['description'].fillna('').astype(str).str.lower().tolist() if 'description' in listings.columns else [''] * len(listings)
+
+        pairs = []
+        nChecked = 0
+        for i in range(len(listings)):
+            if np.isfinite(lat[i]) and np.isfinite(lon[i]):
+                inGrid = self.GRID.get((self.__cell(lat[i]), self.__cell(lon[i])), self.EVERYWHERE[:0])
+                candidates = np.concatenate([self.EVERYWHERE, inGrid])
+            else:
+                candidates = self.EVERYWHERE
+            # searches ordered by the lower bound of the rent: only a prefix can match
+            if np.isfinite(values['rent'][i]):
+                candidates = candidates[candidates < np.searchsorted(self.RENT_LOWS, values['rent'][i], side='right')]
+            nChecked += len(candidates)
+
+            keep = np.ones(len(candidates), dtype=bool)
+            for attribute in self.LOW:
+                low, high, value = self.LOW[attribute][candidates], self.HIGH[attribute][candidates], values[attribute][i]
+                if np.isnan(value):
+                    keep &= (low == -np.inf) & (high == np.inf) # searches with this criterion need a value
+                else:
+                    keep &= (low <= value) & (value <= high)
+
+            matched = [search for search in candidates[keep]
+                       if (self.AREAS[search] is None or any(area.intersects(Point(lon[i], lat[i])) for area in self.AREAS[search]))
+                       and all(keyword in texts[i] for keyword in self.KEYWORDS[search])]
+            pairs.append(np.column_stack([np.full(len(matched), i, dtype=np.int64), np.array(matched, dtype=np.int64)]))
+
+        self.STATS['checked'] = nChecked
+        return np.concatenate(pairs) if pairs else np.zeros((0, 2), dtype=np.int64)
+
+
+def loadSearches(path):
+    """ Reads saved searches from a JSON list or a JSON lines file """
+    with open(path, 'r', encoding='utf-8') as file:
+        content = file.read().strip()
+    if content.startswith('['):
+        return json.loads(content)
+    return [json.loads(line) for line in content.splitlines() if line.strip()]
+
+
+def _bound(value, default):
+    return default if value is None else float(value)
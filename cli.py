@@ -0,0 +1,124 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Command-line entry point (e.g. for cron): runs the steps of a search from a config file (JSON).
+
+    python cli.py scrape  config.json     -> listings (files.scrape)
+    python cli.py geocode config.json     -> listings with lat/lon (files.geocode)
+    python cli.py commute config.json     -> listings with the commuting times (files.commute)
+    python cli.py export  config.json     -> GeoJSON, GeoParquet, FlatGeobuf or tiles for the map
+    python cli.py all     config.json     -> all steps
+    (-i / -o: other input / output file than in the config)
+
+Config (the sections hold the class attributes of Scraper, Geocoding and CommutingTimes):
+    {"scraper":   {"LOCATION": "Zürich", "PAGE": "homegate_immoscout", "PRICE_MAX": 2500, "SCRAPING_METHOD": "requests"},
+     "geocoding": {"NOMINATIM": "router"},
+     "commuting": {"DESTINATION": ["Hauptbahnhof, 8001 Zürich", [47.3808, 8.5257]]},
+     "export":    {"format": "geojson", "path": "data.geojson", "avgMinutesCol": "mins_sbb_1"},
+     "files":     {"scrape": "listings.pkl", "geocode": "geocoded.pkl", "commute": "commute.pkl"}}
+    export formats: geojson (df2GeoJSON), geoparquet, flatgeobuf, tiles (clusterTiles, path is the directory)
+
+Only the steps run are imported, and scrapeApartments loads its heavy dependencies (selenium,
+geopandas, shapely, geopy, scipy) on first use, so the start-up is dominated by the actual work.
+
+"""
+
+import argparse
+import inspect
+import json
+import sys
+import time
+
+
+FILES = {'scrape': 'listings.pkl', 'geocode': 'geocoded.pkl', 'commute': 'commute.pkl'}
+INPUTS = {'geocode': 'scrape', 'commute': 'geocode', 'export': 'commute'}
+STEPS = ['scrape', 'geocode', 'commute', 'export']
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='cli.py', description='Scrape, geocode, commute and export apartments.')
+    parser.add_argument('step', choices=STEPS + ['all'])
+    parser.add_argument('config', help='config file (JSON)')
+    parser.add_argument('-i', '--input', help='input file (default: output of the previous step in the config)')
+    parser.add_argument('-o', '--output', help='output file (default: in the config)')
+    args = parser.parse_args(argv)
+
+    with open(args.config, 'r', encoding='utf-8') as file:
+        config = json.load(file)
+    files = dict(FILES, **config.get('files', {}))
+
+    steps = STEPS if args.step == 'all' else [args.step]
+    for step in steps:
+        t0 = time.time()
+        source = args.input if (args.input and step == steps[0]) else files.get(INPUTS.get(step))
+        target = args.output if (args.output and step == steps[-1]) else files.get(step)
+        STEP_FUNCTIONS[step](config, source, target)
+        print("{}: {:.1f} seconds.".format(step, time.time() - t0))
+    return 0
+
+
+def scrape(config, source, target):
+    from scrapeApartments import Scraper
+
+    scraper = type('Scraper', (Scraper,), config.get('scraper', {}))
+    listings = scraper().scrape()
+    listings.to_pickle(target)
+    print("{} listings scraped -> {}".format(len(listings), target))
+
+
+def geocode(config, source, target):
+    import pandas as pd
+    from scrapeApartments import Geocoding
+
+    listings = pd.read_pickle(source)
+    geocoder = type('Geocoder', (Geocoding,), dict(config.get('geocoding', {}), DATA=listings))
+    located = geocoder().geocode()[['address', 'lat', 'lon']]
+
+    listings = listings.drop(labels=[col for col in ['lat', 'lon'] if col in listings.columns], axis=1)
+    listings = listings.merge(located, on='address', how='left').dropna(subset=['lat', 'lon']).reset_index(drop=True)
+    listings.to_pickle(target)
+    print("{} listings located -> {}".format(len(listings), target))
+
+
+def commute(config, source, target):
+    import pandas as pd
+    from scrapeApartments import CommutingTimes
+
+    listings = pd.read_pickle(source)
+    commuting = type('Commuting', (CommutingTimes,), dict(config.get('commuting', {}), DATA=listings))
+    listings = commuting().getCommutingTimes()
+    if listings is None:
+        sys.exit("commute: no commuting times, the transport API is not usable (see the message above).")
+    listings.to_pickle(target)
+    print("Commuting times of {} listings -> {}".format(len(listings), target))
+
+
+def export(config, source, target):
+    import pandas as pd
+    import scrapeApartments
+
+    listings = pd.read_pickle(source)
+    options = dict(config.get('export', {}))
+    form = options.pop('format', 'geojson')
+    path = target or options.pop('path', 'data.geojson')
+    options.pop('path', None)
+
+    writers = {'geojson': scrapeApartments.df2GeoJSON, 'geoparquet': scrapeApartments.df2GeoParquet,
+               'flatgeobuf': scrapeApartments.df2FlatGeobuf, 'tiles': scrapeApartments.clusterTiles}
+    if form not in writers:
+        raise ValueError("Unknown export format '{}' (geojson, geoparquet, flatgeobuf or tiles)".format(form))
+
+    # only the options of this writer (e.g. avgMinutesCol is not one of df2GeoParquet)
+    accepted = list(inspect.signature(writers[form]).parameters)[2:]
+    ignored = [option for option in options if option not in accepted]
+    if ignored:
+        print("export: options {} not used by the format {}.".format(ignored, form))
+    writers[form](listings, path, **{option: value for option, value in options.items() if option in accepted})
+    print("{} listings exported -> {}".format(len(listings), path))
+
+
+STEP_FUNCTIONS = {'scrape': scrape, 'geocode': geocode, 'commute': commute, 'export': export}
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,295 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Offline routing for public transportation over a GTFS feed (e.g. https://opentransportdata.swiss/en/dataset/timetable-2022-gtfs2020).
+
+The feed is loaded into compact array-backed timetables (one array of arrival/departure times per
+route pattern, CSR arrays for stop -> patterns and footpaths). A reverse RAPTOR search
+(https://www.microsoft.com/en-us/research/publication/round-based-public-transit-routing/) from a
+destination then yields for every stop the latest departure to arrive by a given time, i.e. the
+commuting times of all listings come from a single in-process query per destination.
+
+Used by CommutingTimes (MEANS = 'gtfs'). A small feed for testing purposes is found in data/gtfs_sample.
+
+"""
+
+import os
+
+import numpy as np
+import pandas as pd
+
+from scrapeApartments import SpatialIndex, haversine, haversineMatrix
+
+
+WALKING_SPEED = 4000 / 3600 # meters per second (as in CommutingTimes)
+
+
+def gtfsTime(hhmmss):
+    """ Converts GTFS times (HH:MM:SS, may exceed 24:00:00) to seconds after midnight """
+    hhmmss = pd.Series(hhmmss, dtype=object)
+    if len(hhmmss) == 0: # e.g. no service on the date
+        return np.zeros(0, dtype=np.int64)
+    hms = hhmmss.astype(str).str.strip().str.split(':', expand=True).astype(int)
+    return (hms[0]*3600 + hms[1]*60 + hms[2]).to_numpy()
+
+
+class GTFSTimetable:
+    """
+    Timetable of a GTFS feed for a single service date, stored in arrays for the RAPTOR search.
+
+    Parameters:
+        PATH (str): folder with the GTFS files (stops, trips, stop_times, calendar and/or calendar_dates)
+        SERVICE_DATE (datetime.date): date of the timetable
+        TRANSFER_RADIUS (float): stops within this distance (meters) are connected by footpaths
+        MIN_CHANGE_TIME (int): min. time (seconds) to change between two trips at the same stop
+    """
+
+    PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data', 'gtfs_sample')
+    SERVICE_DATE = None
+    TRANSFER_RADIUS = 250
+    MIN_CHANGE_TIME = 120
+
+    def __init__(self):
+        stops = pd.read_csv(os.path.join(self.PATH, 'stops.txt'), dtype={'stop_id':str})
+        trips = pd.read_csv(os.path.join(self.PATH, 'trips.txt'), dtype={'trip_id':str, 'service_id':str, 'route_id':str})
+        stopTimes = pd.read_csv(os.path.join(self.PATH, 'stop_times.txt'), dtype={'trip_id':str, 'stop_id':str},
+                                usecols=['trip_id','arrival_time','departure_time','stop_id','stop_sequence'])
+
+        self.STOP_IDS = stops.stop_id.to_numpy()
+        self.STOP_NAMES = stops.stop_name.to_numpy() if 'stop_name' in stops.columns else self.STOP_IDS
+        self.STOP_LATLON = stops[['stop_lat','stop_lon']].to_numpy(dtype=float)
+        self.STOP_INDEX = SpatialIndex(self.STOP_LATLON)
+        stopNo = pd.Series(np.arange(len(stops)), index=self.STOP_IDS)
+
+        services = self.__activeServices()
+        trips = trips[trips.service_id.isin(services)]
+        stopTimes = stopTimes[stopTimes.trip_id.isin(trips.trip_id)].sort_values(['trip_id','stop_sequence'])
+        stopTimes = stopTimes.assign(stop=stopNo.reindex(stopTimes.stop_id).to_numpy(),
+                                     arr=gtfsTime(stopTimes.arrival_time), dep=gtfsTime(stopTimes.departure_time))
+
+        self.__buildPatterns(stopTimes)
+        self.__buildFootpaths()
+
+
+    def __activeServices(self):
+        """ service_ids running on SERVICE_DATE (calendar.txt and calendar_dates.txt) """
+        day = pd.Timestamp(self.SERVICE_DATE)
+        dateInt = int(day.strftime('%Y%m%d'))
+        services = set()
+
+        calendarPath = os.path.join(self.PATH, 'calendar.txt')
+        if os.path.isfile(calendarPath):
+            calendar = pd.read_csv(calendarPath, dtype={'service_id':str})
+            weekday = day.strftime('%A').lower()
+            running = (calendar[weekday] == 1) & (calendar.start_date <= dateInt) & (calendar.end_date >= dateInt)
+            services.update(calendar.service_id[running])
+
+        datesPath = os.path.join(self.PATH, 'calendar_dates.txt')
+        if os.path.isfile(datesPath):
+            dates = pd.read_csv(datesPath, dtype={'service_id':str})
+            dates = dates[dates.date == dateInt]
+            services.update(dates.service_id[dates.exception_type == 1])
+            services.difference_update(dates.service_id[dates.exception_type == 2])
+
+        return services
+
+
+    def __buildPatterns(self, stopTimes):
+        """
+        Groups the trips by their sequence of stops (patterns). Per pattern, the arrival and departure
+        times are stored as (trips x stops) arrays, trips sorted by departure.
+        """
+        tripStops = stopTimes.groupby('trip_id', sort=False)['stop'].apply(lambda stops: '-'.join(stops.astype(str)))
+        patternOfTrip = pd.Series(pd.factorize(tripStops)[0], index=tripStops.index)
+
+        self.PATTERN_STOPS = []
+        self.ARRIVALS = []
+        self.DEPARTURES = []
+        stopTimes = stopTimes.assign(position=stopTimes.groupby('trip_id').cumcount())
+        for seq, trips in tripStops.groupby(patternOfTrip, sort=True):
+            times = stopTimes[stopTimes.trip_id.isin(trips.index)]
+            arr = times.pivot(index='trip_id', columns='position', values='arr').to_numpy()
+            dep = times.pivot(index='trip_id', columns='position', values='dep').to_numpy()
+            order = np.argsort(dep[:,0], kind='stable')
+            self.PATTERN_STOPS.append(np.array(trips.iloc[0].split('-'), dtype=np.int32))
+            self.ARRIVALS.append(arr[order].astype(np.int32))
+            self.DEPARTURES.append(dep[order].astype(np.int32))
+
+        # CSR: stop -> (pattern, position in pattern)
+        pairs = np.array([(stop, pattern, pos) for pattern,stops in enumerate(self.PATTERN_STOPS) for pos,stop in enumerate(stops)],
+                         dtype=np.int32).reshape(-1,3)
+        pairs = pairs[np.argsort(pairs[:,0], kind='stable')]
+        self.STOP_PATTERN_PTR = np.searchsorted(pairs[:,0], np.arange(len(self.STOP_IDS)+1))
+        self.STOP_PATTERNS = pairs[:,1]
+        self.STOP_PATTERN_POS = pairs[:,2]
+
+
+    def __buildFootpaths(self):
+        """ CSR of footpaths between stops (transfers.txt and stops within TRANSFER_RADIUS) """
+        neighbours = self.STOP_INDEX.withinRadius(self.STOP_LATLON, self.TRANSFER_RADIUS)
+        fromStop = np.concatenate([np.full(len(n), i) for i,n in enumerate(neighbours)]).astype(np.int32)
+        toStop = np.concatenate([np.array(n, dtype=np.int32) for n in neighbours])
+        distance = haversine(self.STOP_LATLON[fromStop].T, self.STOP_LATLON[toStop].T) # element-wise
+        seconds = np.ceil(distance / WALKING_SPEED)
+
+        transfersPath = os.path.join(self.PATH, 'transfers.txt')
+        if os.path.isfile(transfersPath):
+            transfers = pd.read_csv(transfersPath, dtype={'from_stop_id':str, 'to_stop_id':str}).dropna(subset=['min_transfer_time'])
+            stopNo = pd.Series(np.arange(len(self.STOP_IDS)), index=self.STOP_IDS)
+            transfers = transfers[transfers.from_stop_id.isin(stopNo.index) & transfers.to_stop_id.isin(stopNo.index)]
+            fromStop = np.r_[fromStop, stopNo[transfers.from_stop_id].to_numpy()]
+            toStop = np.r_[toStop, stopNo[transfers.to_stop_id].to_numpy()]
+            seconds = np.r_[seconds, transfers.min_transfer_time.to_numpy()]
+
+        keep = fromStop != toStop
+        fromStop, toStop, seconds = fromStop[keep], toStop[keep], seconds[keep]
+        order = np.argsort(fromStop, kind='stable')
+        self.FOOT_PTR = np.searchsorted(fromStop[order], np.arange(len(self.STOP_IDS)+1))
+        self.FOOT_TO = toStop[order]
+        self.FOOT_SECONDS = seconds[order].astype(np.int32)
+
+
+    def latestDepartures(self, destination, arriveBy, maxWalk=1000, maxRounds=6):
+        """
+        Reverse RAPTOR: for every stop, the latest departure to reach the destination by arriveBy.
+
+        Parameters
+        ----------
+        destination : tuple
+            lat/lon in decimal degrees
+        arriveBy : int
+            seconds after midnight
+        maxWalk : float, optional
+            max. walking distance (meters) from the last stop to the destination. The default is 1000.
+        maxRounds : int, optional
+            max. number of trips (i.e. transfers + 1). The default is 6.
+
+        Returns
+        -------
+        departure (np.array, seconds after midnight, -inf if not reachable),
+        arrival (np.array, arrival at the destination of that journey),
+        trips (np.array, number of trips used)
+
+        """
+        nStops = len(self.STOP_IDS)
+        targets = np.array(self.STOP_INDEX.withinRadius([destination], maxWalk)[0], dtype=int)
+        egress = np.zeros(nStops)
+        egress[targets] = np.ceil(haversineMatrix(self.STOP_LATLON[targets], [destination])[:,0] / WALKING_SPEED)
+
+        # footpaths (transfers.txt, TRANSFER_RADIUS) from these stops are part of the walk to the destination
+        final = dict(zip(targets.tolist(), egress[targets].tolist()))
+        for stop in targets.tolist():
+            for i in range(self.FOOT_PTR[stop], self.FOOT_PTR[stop+1]):
+                other = int(self.FOOT_TO[i])
+                if egress[stop] + self.FOOT_SECONDS[i] < final.get(other, np.inf):
+                    final[other] = egress[stop] + self.FOOT_SECONDS[i]
+        targets = np.array(sorted(final), dtype=int)
+        egress[targets] = [final[stop] for stop in targets.tolist()]
+
+        bestDep = np.full(nStops, -np.inf)
+        bestArr = np.full(nStops, np.nan)
+        bestTrips = np.zeros(nStops, dtype=int)
+        bestDep[targets] = arriveBy - egress[targets]
+        bestArr[targets] = arriveBy
+        isEgress = np.zeros(nStops, dtype=bool)
+        isEgress[targets] = True
+
+        prevDep = bestDep.copy()
+        prevArr = bestArr.copy()
+        prevEgress = isEgress.copy()
+        marked = set(targets.tolist())
+
+        for k in range(1, maxRounds+1):
+            if not marked:
+                break
+
+            # patterns serving marked stops, scanned backwards from the last marked position
+            scan = {}
+            for stop in marked:
+                for i in range(self.STOP_PATTERN_PTR[stop], self.STOP_PATTERN_PTR[stop+1]):
+                    pattern = self.STOP_PATTERNS[i]
+                    scan[pattern] = max(scan.get(pattern, -1), self.STOP_PATTERN_POS[i])
+
+            newMarked = set()
+            for pattern, last in scan.items():
+                stops = self.PATTERN_STOPS[pattern]
+                arr = self.ARRIVALS[pattern]
+                dep = self.DEPARTURES[pattern]
+                trip = -1
+                tripArr = np.nan
+
+                for j in range(last, -1, -1):
+                    stop = stops[j]
+                    if trip >= 0 and dep[trip,j] > bestDep[stop]:
+                        bestDep[stop] = dep[trip,j]
+                        bestArr[stop] = tripArr
+                        bestTrips[stop] = k
+                        isEgress[stop] = False
+                        newMarked.add(stop)
+
+                    # alight here from a later trip?
+                    if prevDep[stop] > -np.inf:
+                        slack = 0 if prevEgress[stop] else self.MIN_CHANGE_TIME
+                        t = np.searchsorted(arr[:,j], prevDep[stop] - slack, side='right') - 1
+                        if t > trip:
+                            trip = t
+                            tripArr = arr[t,j] + egress[stop] if prevEgress[stop] else prevArr[stop]
+
+            # footpaths
+            for stop in list(newMarked):
+                for i in range(self.FOOT_PTR[stop], self.FOOT_PTR[stop+1]):
+                    other = self.FOOT_TO[i]
+                    if bestDep[stop] - self.FOOT_SECONDS[i] > bestDep[other]:
+                        bestDep[other] = bestDep[stop] - self.FOOT_SECONDS[i]
+                        bestArr[other] = bestArr[stop]
+                        bestTrips[other] = k
+                        isEgress[other] = False
+                        newMarked.add(other)
+
+            prevDep = bestDep.copy()
+            prevArr = bestArr.copy()
+            prevEgress = isEgress.copy()
+            marked = newMarked
+
+        return bestDep, bestArr, bestTrips
+
+
+    def travelTimes(self, latlons, destination, arriveBy, maxWalk=1000, maxRounds=6):
+        """
+        Travel times (minutes) from many origins (e.g. listings) to one destination, for the latest
+        journey arriving by arriveBy. Includes walking to the first and from the last stop.
+
+        Parameters
+        ----------
+        latlons : array-like (n,2)
+            origins, lat/lon in decimal degrees
+        destination : tuple
+            lat/lon in decimal degrees
+        arriveBy : int
+            seconds after midnight
+        maxWalk : float, optional
+            max. walking distance (meters) to/from a stop. The default is 1000.
+        maxRounds : int, optional
+            max. number of trips. The default is 6.
+
+        Returns
+        -------
+        minutes (np.array (n,), NaN if not reachable), trips (np.array (n,))
+
+        """
+        dep, arr, trips = self.latestDepartures(destination, arriveBy, maxWalk, maxRounds)
+        latlons = np.asarray(latlons, dtype=float).reshape(-1,2)
+
+        minutes = np.full(len(latlons), np.nan)
+        nTrips = np.zeros(len(latlons), dtype=int)
+        for i, stops in enumerate(self.STOP_INDEX.withinRadius(latlons, maxWalk)):
+            stops = np.array(stops, dtype=int)
+            stops = stops[np.isfinite(dep[stops])]
+            if len(stops) == 0:
+                continue
+            access = haversineMatrix(self.STOP_LATLON[stops], latlons[i])[:,0] / WALKING_SPEED
+            leave = dep[stops] - access
+            best = np.argmax(leave)
+            minutes[i] = (arr[stops[best]] - leave[best]) / 60
+            nTrips[i] = trips[stops[best]]
+        return minutes, nTrips
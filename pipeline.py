@@ -0,0 +1,341 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Streaming pipeline of the modules of scrapeApartments: scrape -> geocode -> commute.
+
+Instead of running the Scraper, the Geocoding and the CommutingTimes one after the other on the
+whole set of listings, the stages are connected by bounded queues and the listings flow through
+page by page (Scraper.scrapeUnits()). Geocoding starts with the first page scraped, routing with
+the first batch geocoded, and the first scored listings are available after a few seconds. A full
+queue blocks the stage before it (backpressure), e.g. the scraper waits for a slow geocoder
+instead of piling up pages in memory.
+
+Usage:
+    class MyScraper(Scraper):
+        LOCATION = 'Zürich'
+    class MyCommute(CommutingTimes):
+        DESTINATION = [(47.3782, 8.5402)]
+    class Run(Pipeline):
+        SCRAPER = MyScraper
+        COMMUTING = MyCommute
+    for batch in Run().stream():   # or: Run().run() -> pd.DataFrame
+        print(batch)
+
+With RUN_DIR, each stage persists its completed units (pages of the portals, and their geocoded and
+routed listings) to the run directory. Running the pipeline again with the same RUN_DIR resumes the
+run: finished units are read from the disk, and only the missing or failed units are processed
+(e.g. after a crash, or a batch failing on a malformed response).
+
+    RUN_DIR/
+        scrape/<unit>.pkl       listings of a page (unit, e.g. homegate-3)
+        scrape/_complete        all pages scraped, the portals are not accessed on resume
+        geocode/<unit>.pkl      listings of the page with lat/lon
+        commute/<unit>.pkl      listings of the page with the commuting times
+        commute/<unit>.npz      statistics of the commuting times of the page (for COMMUTE_STORE)
+        errors.jsonl            failed units (stage, unit, error, time)
+
+"""
+
+import json
+import os
+import queue
+import threading
+import time
+
+import numpy as np
+import pandas as pd
+
+from scrapeApartments import Scraper, Geocoding, CommutingTimes, CommuteMatrixStore
+
+
+_DONE = object() # end of a stage, one per worker of the next stage
+
+
+class Pipeline:
+    """
+    Runs the Scraper, the Geocoding and the CommutingTimes as concurrent stages.
+
+    Parameters:
+        SCRAPER (class): Scraper (or subclass) providing scrapeUnits()
+        GEOCODING (class): Geocoding (or subclass), one instance per batch
+        COMMUTING (class): CommutingTimes (or subclass), the destinations are resolved once. Its COMMUTE_STORE
+            is written once at the end of stream(), with the listings of all batches
+        QUEUE_SIZE (int): max. number of batches waiting between two stages
+        GEOCODE_WORKERS (int): threads geocoding batches (keep 1 with the router and its csv cache)
+        COMMUTE_WORKERS (int): threads getting the commuting times of batches
+        RUN_DIR (str): directory for the checkpoints of a run, to resume it (None: no checkpoints). Use 
+            a new directory for other search parameters.
+
+    Returns:
+        stream(): generator of pd.DataFrame (listings with lat, lon and the commuting times) per batch
+        run(): pd.DataFrame of all listings
+        STATS: per stage the number of batches, listings and seconds spent; seconds until the first result
+        ERRORS: list of (stage, unit, exception) of the failed batches (skipped, retried on resume)
+        RESUMED: number of units per stage read from the checkpoints
+        STORE: CommuteMatrixStore of all listings (if COMMUTING.COMMUTE_STORE is set)
+    """
+
+    SCRAPER = Scraper
+    GEOCODING = Geocoding
+    COMMUTING = CommutingTimes
+    QUEUE_SIZE = 4
+    GEOCODE_WORKERS = 1
+    COMMUTE_WORKERS = 2
+    RUN_DIR = None
+
+    STAGES = ['scrape', 'geocode', 'commute']
+
+    def __init__(self):
+        self.STATS = {stage: {'batches': 0, 'listings': 0, 'seconds': 0.0} for stage in self.STAGES}
+        self.ERRORS = []
+        self.RESUMED = {stage: 0 for stage in self.STAGES}
+        self.__lock = threading.Lock()
+        if self.RUN_DIR:
+            for stage in self.STAGES:
+                os.makedirs(os.path.join(self.RUN_DIR, stage), exist_ok=True)
+
+
+    def run(self):
+        batches = list(self.stream())
+        if len(batches) == 0:
+            return pd.DataFrame()
+        return pd.concat(batches).reset_index(drop=True)
+
+
+    def stream(self):
+        """ Yields the scored listings batch by batch, as soon as they passed all stages """
+        start = time.time()
+        self.STATS['first_result_seconds'] = None
+
+        # destinations are resolved (geocoded) once, each batch gets a copy (see CommutingTimes.forData)
+        class Commuting(self.COMMUTING):
+            DATA = pd.DataFrame({'address': [], 'lat': [], 'lon': []})
+            COMMUTE_STORE = None # written once from all batches (see __writeStore)
+        self.__commuting = Commuting()
+        self.__commuteStats = []
+
+        toGeocode = queue.Queue(maxsize=self.QUEUE_SIZE)
+        toCommute = queue.Queue(maxsize=self.QUEUE_SIZE)
+        results = queue.Queue(maxsize=self.QUEUE_SIZE)
+        self.__running = {'geocode': self.GEOCODE_WORKERS, 'commute': self.COMMUTE_WORKERS}
+        
+        done = {stage: self.__checkpoints(stage) for stage in self.STAGES}
+        self.RESUMED = {stage: len(done[stage]) for stage in self.STAGES}
+
+        threads = [threading.Thread(target=self.__scrapeStage, args=(toGeocode, toCommute, done), daemon=True)]
+        threads += [threading.Thread(target=self.__stage, args=('geocode', self.__geocode, toGeocode, toCommute, self.COMMUTE_WORKERS), daemon=True)
+                    for _ in range(self.GEOCODE_WORKERS)]
+        threads += [threading.Thread(target=self.__stage, args=('commute', self.__commute, toCommute, results, 1), daemon=True)
+                    for _ in range(self.COMMUTE_WORKERS)]
+        for thread in threads:
+            thread.start()
+        
+        # units finished in a previous run
+        for unit in done['commute']:
+            try:
+                batch = self.__load('commute', unit)
+                self.__loadStats(unit, batch)
+            except Exception as e:
+                self.__failed('commute', unit, e)
+                continue
+            if len(batch) > 0:
+                yield batch
+
+        while True:
+            item = results.get()
+            if item is _DONE:
+                break
+            unit, batch = item
+            if len(batch) == 0:
+                continue
+            if self.STATS['first_result_seconds'] is None:
+                self.STATS['first_result_seconds'] = time.time() - start
+            yield batch
+
+        for thread in threads:
+            thread.join()
+        self.__writeStore()
+        self.STATS['total_seconds'] = time.time() - start
+
+
+    def __scrapeStage(self, toGeocode, toCommute, done):
+        """ Feeds the units of a previous run to the next stages, then scrapes the missing pages """
+        try:
+            for unit in done['geocode']:
+                if unit not in done['commute']:
+                    self.__resume('geocode', unit, toCommute)
+            for unit in done['scrape']:
+                if unit not in done['geocode'] and unit not in done['commute']:
+                    self.__resume('scrape', unit, toGeocode)
+            if not self.__complete():
+                self.__scrape(toGeocode, done)
+        except Exception as e:
+            self.__failed('scrape', 'pages', e)
+        finally:
+            # the geocoders always get their end, else stream() would wait forever
+            for _ in range(self.GEOCODE_WORKERS):
+                toGeocode.put(_DONE)
+
+
+    def __resume(self, stage, unit, output):
+        """ Passes a unit completed by the stage in a previous run on to the next stage """
+        try:
+            batch = self.__load(stage, unit)
+        except Exception as e:
+            self.__failed(stage, unit, e)
+            return
+        output.put((unit, batch))
+
+
+    def __scrape(self, toGeocode, done):
+        """ Scrapes the pages not scraped in a previous run, page by page """
+        errors = []
+        try:
+            scraper = self.SCRAPER()
+            seen = set()
+            for unit in done['scrape']:
+                try:
+                    seen.update(self.__load('scrape', unit)['url'])
+                except Exception as e:
+                    errors.append((unit, e))
+
+            t0 = time.time()
+            for unit, batch in scraper.scrapeUnits(skip=set(done['scrape']), seen=seen, errors=errors):
+                try:
+                    self.__count('scrape', batch, time.time() - t0)
+                    self.__save('scrape', unit, batch)
+                except Exception as e:
+                    errors.append((unit, e))
+                    continue
+                toGeocode.put((unit, batch)) # blocks if the geocoders lag behind
+                t0 = time.time()
+            if len(errors) == 0:
+                self.__complete(True)
+        except Exception as e:
+            errors.append(('pages', e))
+        for unit, e in errors:
+            self.__failed('scrape', unit, e)
+
+
+    def __stage(self, stage, function, source, output, nextWorkers):
+        """ Worker of a stage: takes units from source until _DONE, passes the results on to output """
+        try:
+            while True:
+                item = source.get()
+                if item is _DONE:
+                    break
+                unit, batch = item
+                t0 = time.time()
+                try:
+                    if len(batch) > 0:
+                        batch = function(unit, batch)
+                    self.__count(stage, batch, time.time() - t0)
+                    self.__save(stage, unit, batch)
+                except Exception as e:
+                    self.__failed(stage, unit, e)
+                    continue
+                output.put((unit, batch))
+        finally:
+            # the last worker of the stage closes the next stage (also if this worker died)
+            with self.__lock:
+                self.__running[stage] -= 1
+                last = self.__running[stage] == 0
+            if last:
+                for _ in range(nextWorkers):
+                    output.put(_DONE)
+
+
+    def __count(self, stage, batch, seconds):
+        with self.__lock:
+            self.STATS[stage]['batches'] += 1
+            self.STATS[stage]['listings'] += len(batch)
+            self.STATS[stage]['seconds'] += seconds
+            
+            
+    def __failed(self, stage, unit, exception):
+        print("Pipeline: {} failed at {}: {}".format(unit, stage, exception))
+        with self.__lock:
+            self.ERRORS.append((stage, unit, exception))
+            if self.RUN_DIR:
+                try:
+                    with open(os.path.join(self.RUN_DIR, 'errors.jsonl'), 'a') as f:
+                        f.write(json.dumps({'stage': stage, 'unit': unit, 'error': '{}: {}'.format(type(exception).__name__, exception), 
+                                            'time': time.time()}) + '\n')
+                except OSError as e:
+                    print("Pipeline: errors.jsonl not written: {}".format(e))
+
+
+    def __checkpoints(self, stage):
+        """ Units completed by the stage in a previous run """
+        if not self.RUN_DIR:
+            return []
+        files = sorted(os.listdir(os.path.join(self.RUN_DIR, stage)))
+        return [file[:-len('.pkl')] for file in files if file.endswith('.pkl')]
+    
+    
+    def __save(self, stage, unit, batch):
+        if self.RUN_DIR:
+            path = os.path.join(self.RUN_DIR, stage, unit + '.pkl')
+            batch.to_pickle(path + '.tmp')
+            os.replace(path + '.tmp', path) # no partial checkpoints after a crash
+            
+            
+    def __load(self, stage, unit):
+        return pd.read_pickle(os.path.join(self.RUN_DIR, stage, unit + '.pkl'))
+    
+    
+    def __complete(self, complete=False):
+        """ Returns (or sets) whether all pages have been scraped """
+        if not self.RUN_DIR:
+            return False
+        path = os.path.join(self.RUN_DIR, 'scrape', '_complete')
+        if complete:
+            open(path, 'w').close()
+        return os.path.exists(path)
+
+
+    def __geocode(self, unit, batch):
+        """ Adds lat/lon to the listings of a batch, omits listings which could not be located """
+        class Geocoder(self.GEOCODING):
+            DATA = batch
+        located = Geocoder().geocode()[['address', 'lat', 'lon']]
+
+        batch = batch.drop(labels=[col for col in ['lat', 'lon'] if col in batch.columns], axis=1)
+        batch = batch.merge(located, on='address', how='left')
+        return batch.dropna(subset=['lat', 'lon']).reset_index(drop=True)
+
+
+    def __commute(self, unit, batch):
+        commuting = self.__commuting.forData(batch)
+        batch = commuting.getCommutingTimes()
+        if batch is None: # test() of the transport API failed
+            raise RuntimeError("no commuting times, the transport API is not usable ({})".format(commuting.TRANSPORT_URL))
+        if self.COMMUTING.COMMUTE_STORE:
+            with self.__lock:
+                self.__commuteStats.append((batch, commuting.COMMUTE_STATS, commuting.SLOTS))
+            if self.RUN_DIR:
+                np.savez(os.path.join(self.RUN_DIR, 'commute', unit + '.npz'), stats=commuting.COMMUTE_STATS, slots=commuting.SLOTS)
+        return batch
+
+
+    def __loadStats(self, unit, batch):
+        """ Statistics of the commuting times of a unit finished in a previous run (for COMMUTE_STORE) """
+        path = os.path.join(self.RUN_DIR, 'commute', unit + '.npz')
+        if self.COMMUTING.COMMUTE_STORE and len(batch) > 0 and os.path.exists(path):
+            stats = np.load(path)
+            self.__commuteStats.append((batch, stats['stats'], stats['slots'].tolist()))
+
+
+    def __writeStore(self):
+        """ Writes the statistics of the commuting times of all batches to COMMUTE_STORE (see CommuteMatrixStore) """
+        if not self.COMMUTING.COMMUTE_STORE or len(self.__commuteStats) == 0:
+            return
+        batches, stats, slots = zip(*self.__commuteStats)
+        listings = pd.concat(batches).reset_index(drop=True)
+        listings = pd.DataFrame({'key': listings['url'] if 'url' in listings.columns else listings['address'],
+                                 'lat': listings['lat'], 'lon': listings['lon']})
+        class Store(CommuteMatrixStore):
+            PATH = self.COMMUTING.COMMUTE_STORE
+        self.STORE = Store(listings, self.__commuting.DESTINATION, slots[0])
+        self.STORE.MATRIX[:] = np.concatenate(stats)
+        self.STORE.flush()
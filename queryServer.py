@@ -0,0 +1,305 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Local HTTP query service over the scraped, geocoded and commute-scored listings.
+
+The listings are held in memory with one index per numeric column (row numbers sorted by value,
+a range is two binary searches) and a grid over lat/lon for bounding boxes. A query combines
+ranges, a bounding box and a sort order: the most selective index yields the candidates, the
+other conditions are checked on these candidates only, and the top-k are selected without
+sorting all matches. Queries over a few hundred thousand listings take milliseconds.
+
+Usage:
+    class Server(QueryServer):
+        DATA = 'listings.parquet'     # or a pd.DataFrame, .pkl, .csv
+        PORT = 8765
+    server = Server().start()         # http://127.0.0.1:8765
+    ...
+    server.stop()
+
+    GET /listings?rent_max=2500&nRooms_min=3.5&bbox=47.33,8.47,47.41,8.6&sort=mins_sbb_1&limit=100
+        -> GeoJSON FeatureCollection (as data.geojson, numberMatched: number of all matches)
+        <col>_min / <col>_max: range of an indexed column (inclusive)
+        bbox: lat_min,lon_min,lat_max,lon_max
+        sort: indexed column, '-<col>' for descending (default: AVG_MINUTES_COL)
+        limit: max. number of listings (default DEFAULT_LIMIT, at most MAX_LIMIT)
+    GET /stats -> number of listings, indexed columns and their ranges
+
+ScrapedApartmentsMap.html queries the service if queryServerURL is set.
+
+"""
+
+import json
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+
+import numpy as np
+import pandas as pd
+
+from scrapeApartments import geoJSONFeatures, readGeoParquet
+
+
+class ListingIndex:
+    """
+    In-memory indexes over listings: sorted row numbers per numeric column and a grid for bounding boxes.
+
+    Parameters:
+        data (pd.DataFrame): listings with lat, lon
+        columns (list): numeric columns to index (None: rent, size, nRooms and the commuting times mins_*, median_*, p90_*)
+        cellSize (float): size of the grid cells in degrees
+    """
+
+    def __init__(self, data, columns=None, cellSize=0.01):
+        self.DATA = data.reset_index(drop=True)
+        if columns is None:
+            columns = [col for col in self.DATA.columns if col in ('rent', 'size', 'nRooms') or
+                       col.startswith(('mins_', 'median_', 'p90_'))]
+
+        self.VALUES = {}
+        self.SORTED = {}
+        for col in columns:
+            values = pd.to_numeric(self.DATA[col], errors='coerce').to_numpy(dtype=float)
+            order = np.argsort(values, kind='stable') # NaN last
+            nValid = int(np.isfinite(values).sum())
+            self.VALUES[col] = values
+            self.SORTED[col] = (values[order[:nValid]], order[:nValid])
+
+        self.LAT = pd.to_numeric(self.DATA['lat'], errors='coerce').to_numpy(dtype=float)
+        self.LON = pd.to_numeric(self.DATA['lon'], errors='coerce').to_numpy(dtype=float)
+        self.__buildGrid(cellSize)
+
+
+    def __buildGrid(self, cellSize):
+        """ Row numbers sorted by grid cell (row-major), with the offset of each cell """
+        valid = np.flatnonzero(np.isfinite(self.LAT) & np.isfinite(self.LON))
+        if len(valid) == 0:
+            self.ORIGIN, self.CELL, self.GRID_SHAPE = (0.0, 0.0), cellSize, (1, 1)
+            self.CELL_ROWS, self.CELL_START = valid, np.zeros(2, dtype=np.int64)
+            return
+        self.ORIGIN = (self.LAT[valid].min(), self.LON[valid].min())
+        extent = max(self.LAT[valid].max() - self.ORIGIN[0], self.LON[valid].max() - self.ORIGIN[1])
+        self.CELL = max(cellSize, extent / 2048) # at most 2048 x 2048 cells
+        self.GRID_SHAPE = (int((self.LAT[valid].max() - self.ORIGIN[0]) / self.CELL) + 1,
+                           int((self.LON[valid].max() - self.ORIGIN[1]) / self.CELL) + 1)
+
+        cell = self.__cell(self.LAT[valid], self.LON[valid])
+        order = np.argsort(cell, kind='stable')
+        self.CELL_ROWS = valid[order]
+        self.CELL_START = np.searchsorted(cell[order], np.arange(self.GRID_SHAPE[0] * self.GRID_SHAPE[1] + 1))
+
+
+    def __cell(self, lat, lon):
+        row = np.clip(((lat - self.ORIGIN[0]) / self.CELL).astype(np.int64), 0, self.GRID_SHAPE[0] - 1)
+        col = np.clip(((lon - self.ORIGIN[1]) / self.CELL).astype(np.int64), 0, self.GRID_SHAPE[1] - 1)
+        return row * self.GRID_SHAPE[1] + col
+
+
+    def range(self, col, low=None, high=None):
+        """ Row numbers with low <= col <= high (binary search on the sorted values) """
+        values, rows = self.SORTED[col]
+        start = 0 if low is None else np.searchsorted(values, low, side='left')
+        end = len(values) if high is None else np.searchsorted(values, high, side='right')
+        return rows[start:max(start, end)]
+
+
+    def bbox(self, latMin, lonMin, latMax, lonMax):
+        """ Row numbers in the grid cells overlapping the bounding box (candidates, not checked exactly) """
+        if (latMin > latMax or lonMin > lonMax or latMax < self.ORIGIN[0] or lonMax < self.ORIGIN[1] or
+            latMin > self.ORIGIN[0] + self.GRID_SHAPE[0] * self.CELL or lonMin > self.ORIGIN[1] + self.GRID_SHAPE[1] * self.CELL):
+            return np.zeros(0, dtype=np.int64)
+        first = self.__cell(np.array([latMin]), np.array([lonMin]))[0]
+        last = self.__cell(np.array([latMax]), np.array([lonMax]))[0]
+        nCols = self.GRID_SHAPE[1]
+        col0, col1 = first % nCols, last % nCols
+        # the cells of a grid row within the bbox are contiguous
+        slices = [self.CELL_ROWS[self.CELL_START[row*nCols + col0]:self.CELL_START[row*nCols + col1 + 1]]
+                  for row in range(first // nCols, last // nCols + 1)]
+        return np.concatenate(slices) if slices else np.zeros(0, dtype=np.int64)
+
+
+    def query(self, ranges=None, bbox=None, sort=None, descending=False, k=None):
+        """
+        Listings matching all ranges and the bounding box, the first k by sort.
+
+        Parameters
+        ----------
+        ranges : dict, optional
+            {column: (low, high)}, None for an open end. The default is None.
+        bbox : tuple, optional
+            (lat_min, lon_min, lat_max, lon_max). The default is None.
+        sort : str, optional
+            indexed column to sort by (listings without a value last). The default is None (order of the data).
+        descending : bool, optional
+            sort descending. The default is False.
+        k : int, optional
+            max. number of listings. The default is None (all).
+
+        Returns
+        -------
+        np.array of the row numbers (of DATA), int number of all matches.
+
+        """
+        ranges = {col: bounds for col, bounds in (ranges or {}).items() if bounds != (None, None)}
+        for col in list(ranges) + ([sort] if sort else []):
+            if col not in self.SORTED:
+                raise KeyError("'{}' is not indexed, indexed are: {}".format(col, ', '.join(self.SORTED)))
+
+        # candidates from the most selective condition
+        candidates = [self.range(col, *bounds) for col, bounds in ranges.items()]
+        if bbox is not None:
+            candidates.append(self.bbox(*bbox))
+        if candidates:
+            rows = min(candidates, key=len)
+        else:
+            rows = np.arange(len(self.DATA))
+
+        keep = np.ones(len(rows), dtype=bool)
+        for col, (low, high) in ranges.items():
+            values = self.VALUES[col][rows]
+            if low is not None:
+                keep &= values >= low
+            if high is not None:
+                keep &= values <= high
+        if bbox is not None:
+            latMin, lonMin, latMax, lonMax = bbox
+            lat, lon = self.LAT[rows], self.LON[rows]
+            keep &= (lat >= latMin) & (lat <= latMax) & (lon >= lonMin) & (lon <= lonMax)
+        rows = np.sort(rows[keep])
+        total = len(rows)
+
+        if sort:
+            values = self.VALUES[sort][rows]
+            values = np.where(np.isnan(values), np.inf, -values if descending else values)
+            if k is not None and k < len(rows):
+                top = np.argpartition(values, k)[:k]
+                rows, values = rows[top], values[top]
+            rows = rows[np.argsort(values, kind='stable')]
+        if k is not None:
+            rows = rows[:k]
+        return rows, total
+
+
+class QueryServer:
+    """
+    Local HTTP service answering filter + bbox + top-k queries on the listings (see ListingIndex).
+
+    Parameters:
+        DATA (pd.DataFrame or str): listings, or path to them (.parquet written by df2GeoParquet, .pkl, .csv)
+        HOST (str): interface to listen on
+        PORT (int): port (0: any free port, see URL after start())
+        COLUMNS (list): indexed columns (None: rent, size, nRooms and the commuting times)
+        AVG_MINUTES_COL (str): commuting time shown on the map (property avgMinutes) and default sort order
+        CELL_SIZE (float): size of the grid cells in degrees
+        DEFAULT_LIMIT (int): listings returned if no limit is given
+        MAX_LIMIT (int): max. listings returned per query
+    """
+
+    DATA = 'listings.parquet'
+    HOST = '127.0.0.1'
+    PORT = 8765
+    COLUMNS = None
+    AVG_MINUTES_COL = 'mins_sbb_1'
+    CELL_SIZE = 0.01
+    DEFAULT_LIMIT = 500
+    MAX_LIMIT = 10000
+
+    def __init__(self):
+        data = self.DATA if isinstance(self.DATA, pd.DataFrame) else loadListings(self.DATA)
+        if self.AVG_MINUTES_COL in data.columns:
+            data = data.assign(avgMinutes=data[self.AVG_MINUTES_COL])
+        self.INDEX = ListingIndex(data, columns=self.COLUMNS, cellSize=self.CELL_SIZE)
+        self.server = None
+
+
+    def start(self):
+        service = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                status, body = service.respond(self.path)
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.send_header('Access-Control-Allow-Origin', '*') # the map is opened as a local file
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer((self.HOST, self.PORT), Handler)
+        self.server.daemon_threads = True
+        self.URL = 'http://{}:{}'.format(self.HOST, self.server.server_address[1])
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        print("QueryServer: {} listings at {}/listings".format(len(self.INDEX.DATA), self.URL))
+        return self
+
+
+    def stop(self):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+
+
+    def respond(self, path):
+        """ Returns status and body for a request path """
+        url = urlparse(path)
+        params = {key: values[-1] for key, values in parse_qs(url.query).items()}
+        endpoint = url.path.rstrip('/')
+        try:
+            if endpoint == '/listings':
+                return 200, self.listings(params).encode()
+            if endpoint == '/stats':
+                return 200, json.dumps(self.stats()).encode()
+            return 404, b'{"errors":[{"message":"Not found"}]}'
+        except (KeyError, ValueError) as e:
+            return 400, json.dumps({'errors': [{'message': str(e).strip('"')}]}).encode()
+
+
+    def listings(self, params):
+        """ GeoJSON FeatureCollection of the listings matching the query parameters (see module docstring) """
+        ranges = {}
+        bbox = None
+        sort = self.AVG_MINUTES_COL if self.AVG_MINUTES_COL in self.INDEX.SORTED else None
+        descending = False
+        limit = self.DEFAULT_LIMIT
+
+        for key, value in params.items():
+            if key == 'bbox':
+                bbox = tuple(float(x) for x in value.split(','))
+                if len(bbox) != 4:
+                    raise ValueError('bbox must be lat_min,lon_min,lat_max,lon_max')
+            elif key == 'sort':
+                descending = value.startswith('-')
+                sort = value.lstrip('-') or None
+            elif key == 'limit':
+                limit = int(value)
+            elif key.endswith(('_min', '_max')):
+                col, bound = key.rsplit('_', 1)
+                low, high = ranges.get(col, (None, None))
+                ranges[col] = (float(value), high) if bound == 'min' else (low, float(value))
+            else:
+                raise ValueError("unknown parameter '{}'".format(key))
+
+        rows, total = self.INDEX.query(ranges, bbox=bbox, sort=sort, descending=descending,
+                                       k=max(0, min(limit, self.MAX_LIMIT)))
+        features = geoJSONFeatures(self.INDEX.DATA.iloc[rows])
+        return ('{"type": "FeatureCollection", "numberMatched": ' + str(total) + ', "numberReturned": ' + str(len(rows)) +
+                ', "features": [' + ', '.join(features) + ']}')
+
+
+    def stats(self):
+        index = self.INDEX
+        return {'listings': len(index.DATA),
+                'columns': {col: [float(values[0]), float(values[-1])] if len(values) else None
+                            for col, (values, rows) in index.SORTED.items()}}
+
+
+def loadListings(path):
+    """ Reads listings from .parquet (see df2GeoParquet), .pkl or .csv """
+    if path.endswith('.parquet'):
+        return readGeoParquet(path)
+    if path.endswith('.pkl'):
+        return pd.read_pickle(path)
+    return pd.read_csv(path)
@@ -0,0 +1,257 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Long-running scheduler for many search profiles (daemon mode of the Scraper).
+
+A profile is a set of Scraper parameters (LOCATION, RADIUS, PAGE, ROOMS_MIN, PRICE_MAX, FILTER_KEYWORDS,
+...) with a name and an interval. The profiles run on their intervals with a random jitter. Profiles
+due at about the same time run together and share one Fetcher: its rate limits per host apply to all
+profiles, and a page requested by several profiles (in flight or within CACHE_SECONDS) is fetched once.
+
+Overlapping searches are coalesced before fetching: the portals filter by location and radius on
+their side, so the profiles with the same portal, location and radius become one search over the
+union of their ranges (rooms, size, price), and the listings are split per profile locally. E.g.
+'Zürich r=10, max. 2500 CHF' and 'Zürich r=10, 3.5+ rooms' fetch their result pages once.
+
+Usage:
+    class Daemon(Scheduler):
+        PROFILES = [{'name': 'zh', 'LOCATION': 'Zürich', 'RADIUS': 10, 'PRICE_MAX': 2500, 'INTERVAL': 30},
+                    {'name': 'zh-family', 'LOCATION': 'Zürich', 'RADIUS': 10, 'ROOMS_MIN': 4.5},
+                    {'name': 'winti', 'LOCATION': 'Winterthur', 'RADIUS': 10, 'PAGE': 'homegate'}]
+        CALLBACK = lambda name, listings: MyAlerts().run(listings)   # e.g. alerts.AlertEngine
+    Daemon().run()   # until stop() or Ctrl+C; run(cycles=1) runs all profiles once
+
+"""
+
+import os
+import random
+import threading
+import time
+from urllib.parse import urlparse
+
+import pandas as pd
+import requests
+
+from scrapeApartments import Scraper, RateLimit
+
+
+class Fetcher:
+    """
+    Fetch layer shared by scrapers: rate limits per host, concurrent requests of the same URL are
+    coalesced (one request, all callers get its result) and pages are cached for CACHE_SECONDS.
+
+    Parameters:
+        REQUESTS_PER_SECOND (dict): max. requests per second per host (suffix of the host name)
+        DEFAULT_REQUESTS_PER_SECOND (float): for other hosts (None: no limit)
+        CACHE_SECONDS (float): pages are reused within this time
+        TIMEOUT (float): timeout of a request in seconds
+    """
+
+    REQUESTS_PER_SECOND = {'homegate.ch': 1.0, 'immoscout24.ch': 1.0, 'comparis.ch': 0.1}
+    DEFAULT_REQUESTS_PER_SECOND = 1.0
+    CACHE_SECONDS = 300
+    TIMEOUT = 30
+
+    def __init__(self):
+        self.STATS = {'requests': 0, 'cached': 0, 'coalesced': 0}
+        self.__cache = {}
+        self.__inFlight = {}
+        self.__limits = {}
+        self.__lock = threading.Lock()
+
+
+    def get(self, url):
+        """ Returns the html of url """
+        while True:
+            with self.__lock:
+                cached = self.__cache.get(url)
+                if cached is not None and time.time() - cached[0] < self.CACHE_SECONDS:
+                    self.STATS['cached'] += 1
+                    return cached[1]
+                event = self.__inFlight.get(url)
+                if event is None:
+                    self.__inFlight[url] = threading.Event()
+                    break
+                self.STATS['coalesced'] += 1
+            event.wait() # fetched by another thread (or failed there: then fetch it here)
+
+        try:
+            self.__limit(urlparse(url).netloc).wait()
+            response = requests.get(url, timeout=self.TIMEOUT)
+            response.raise_for_status() # no error pages (e.g. 429, 5xx) in the cache
+            html = response.content.decode('utf-8')
+            with self.__lock:
+                self.STATS['requests'] += 1
+                self.__cache[url] = (time.time(), html)
+            return html
+        finally:
+            with self.__lock:
+                self.__inFlight.pop(url).set()
+
+
+    def __limit(self, host):
+        """ RateLimit of a host, shared by all hosts matching the same entry of REQUESTS_PER_SECOND """
+        key = next((suffix for suffix in self.REQUESTS_PER_SECOND if host == suffix or host.endswith('.' + suffix)), host)
+        with self.__lock:
+            if key not in self.__limits:
+                self.__limits[key] = RateLimit(self.REQUESTS_PER_SECOND.get(key, self.DEFAULT_REQUESTS_PER_SECOND))
+            return self.__limits[key]
+
+
+    def prune(self):
+        """ Drops the pages older than CACHE_SECONDS """
+        with self.__lock:
+            now = time.time()
+            self.__cache = {url: cached for url, cached in self.__cache.items() if now - cached[0] < self.CACHE_SECONDS}
+
+
+class Scheduler:
+    """
+    Runs search profiles periodically (see module docstring).
+
+    Parameters:
+        PROFILES (list): dicts of Scraper parameters, with 'name' and optionally 'INTERVAL' (minutes)
+        SCRAPER (class): Scraper (or subclass) the profiles are based on
+        FETCHER (class): Fetcher (or subclass) shared by all profiles
+        INTERVAL (float): default interval of a profile in minutes
+        JITTER (float): random deviation of the intervals (share of the interval)
+        COALESCE_SECONDS (float): profiles due within this time run together
+        OUTPUT_DIR (str): the listings of the last run of a profile are saved as OUTPUT_DIR/<name>.pkl (None: not saved)
+        CALLBACK (function): called with (name, listings) after each run of a profile
+
+    Returns:
+        run(cycles=None): runs until stop() (or for a number of cycles)
+        runProfiles(profiles): dict name -> pd.DataFrame, runs profiles once
+        STATS: cycles, searches (after coalescing), profiles run and errors
+    """
+
+    PROFILES = []
+    SCRAPER = Scraper
+    FETCHER = Fetcher
+    INTERVAL = 60
+    JITTER = 0.1
+    COALESCE_SECONDS = 60
+    OUTPUT_DIR = 'profiles'
+    CALLBACK = None
+
+    RANGES = [('nRooms', 'ROOMS_MIN', 'ROOMS_MAX'), ('size', 'SIZE_MIN', 'SIZE_MAX'), ('rent', 'PRICE_MIN', 'PRICE_MAX')]
+    PORTALS = ['homegate', 'immoscout', 'comparis']
+
+    def __init__(self):
+        self.FETCH = self.FETCHER()
+        self.PROFILE_LIST = [dict(profile, name=str(profile.get('name', i))) for i, profile in enumerate(self.PROFILES)]
+        self.NEXT = {profile['name']: time.time() for profile in self.PROFILE_LIST} # all due at start
+        self.STATS = {'cycles': 0, 'searches': 0, 'profiles': 0, 'errors': 0}
+        self.__stop = threading.Event()
+
+
+    def run(self, cycles=None):
+        if len(self.PROFILE_LIST) == 0:
+            print("Scheduler: no PROFILES.")
+            return
+        cycle = 0
+        try:
+            while not self.__stop.is_set() and (cycles is None or cycle < cycles):
+                wait = min(self.NEXT.values()) - time.time()
+                if wait > 0:
+                    self.__stop.wait(wait)
+                    continue
+
+                due = [profile for profile in self.PROFILE_LIST if self.NEXT[profile['name']] <= time.time() + self.COALESCE_SECONDS]
+                self.runProfiles(due)
+                for profile in due:
+                    interval = profile.get('INTERVAL', self.INTERVAL) * 60
+                    self.NEXT[profile['name']] = time.time() + interval * (1 + random.uniform(-self.JITTER, self.JITTER))
+                self.FETCH.prune()
+                self.STATS['cycles'] += 1
+                cycle += 1
+        except KeyboardInterrupt:
+            print("Scheduler stopped.")
+
+
+    def stop(self):
+        self.__stop.set()
+
+
+    def runProfiles(self, profiles):
+        """ Runs the profiles once (coalesced searches), returns dict name -> pd.DataFrame """
+        found = {profile['name']: [] for profile in profiles}
+        for search, members in self.coalesce(profiles):
+            scraper = type('Search', (self.SCRAPER,), dict(search, FETCHER=self.FETCH))
+            try:
+                listings = scraper().scrape()
+            except Exception as e:
+                print("Scheduler: search {} ({}) failed: {}".format(search.get('LOCATION'), search['PAGE'], e))
+                self.STATS['errors'] += 1
+                continue
+            self.STATS['searches'] += 1
+            for profile in members:
+                found[profile['name']].append(self.__select(listings, profile))
+
+        results = {}
+        for name, batches in found.items():
+            listings = pd.concat(batches) if batches else pd.DataFrame()
+            if 'url' in listings.columns:
+                listings = listings.drop_duplicates(subset=['url']).reset_index(drop=True)
+            results[name] = listings
+            self.STATS['profiles'] += 1
+            if self.OUTPUT_DIR:
+                os.makedirs(self.OUTPUT_DIR, exist_ok=True)
+                listings.to_pickle(os.path.join(self.OUTPUT_DIR, name + '.pkl'))
+            if self.CALLBACK is not None:
+                self.CALLBACK(name, listings)
+            print("Scheduler: {} listings for {}.".format(len(listings), name))
+        return results
+
+
+    def coalesce(self, profiles):
+        """
+        Groups the profiles into searches: one per portal and parameters other than the ranges (e.g.
+        LOCATION, RADIUS), searching the union of the ranges of its profiles.
+
+        Returns
+        -------
+        list of (dict of Scraper parameters, list of profiles).
+
+        """
+        groups = {}
+        for profile in profiles:
+            page = self.__get(profile, 'PAGE')
+            page = '_'.join(page) if isinstance(page, list) else page
+            portals = [portal for portal in self.PORTALS if page == 'all' or portal in page]
+            others = {key: value for key, value in profile.items()
+                      if key not in ('name', 'INTERVAL', 'PAGE', 'FILTER_KEYWORDS') and
+                      not any(key in (low, high) for col, low, high in self.RANGES)}
+            for portal in portals:
+                key = (portal, repr(sorted(others.items())))
+                groups.setdefault(key, (dict(others, PAGE=portal), []))[1].append(profile)
+
+        searches = []
+        for search, members in groups.values():
+            search.setdefault('SCRAPING_METHOD', 'requests') # selenium does not use the shared Fetcher
+            search['FILTER_KEYWORDS'] = []                   # filtered per profile
+            for col, low, high in self.RANGES:
+                search[low] = min(self.__get(profile, low) for profile in members)
+                search[high] = max(self.__get(profile, high) for profile in members)
+            searches.append((search, members))
+        return searches
+
+
+    def __get(self, profile, attribute):
+        return profile.get(attribute, getattr(self.SCRAPER, attribute))
+
+
+    def __select(self, listings, profile):
+        """ Listings of a coalesced search within the ranges and without the keywords of a profile """
+        keep = pd.Series(True, index=listings.index)
+        for col, low, high in self.RANGES:
+            if col in listings.columns:
+                values = pd.to_numeric(listings[col], errors='coerce')
+                keep &= values.isna() | values.between(self.__get(profile, low), self.__get(profile, high))
+
+        keywords = self.__get(profile, 'FILTER_KEYWORDS') or []
+        keywords = keywords if isinstance(keywords, list) else [keywords]
+        if 'description' in listings.columns:
+            for keyword in keywords:
+                keep &= ~listings['description'].astype(str).str.contains(keyword)
+        return listings[keep]
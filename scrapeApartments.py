@@ -11,6 +11,31 @@ Version: 22-03
 Note:
     - Names of classes and functions might have changed. 
     
+Changes (compared to the version of Mar 2022):
+    - Geocoding / CommutingTimes take the DataFrame of the Scraper and keep the coordinates delivered by the portals
+      (Scraper.INCLUDE_COORDS = True by default)
+    - Geocoding with a fallback chain (cache, postal codes, local and public Nominatim)
+    - SpatialFilter: keeps listings within areas of interest (GeoJSON polygons)
+    - Persistent cache for the commuting times (CommuteCache, opt-in with CommutingTimes.COMMUTE_CACHE)
+    - Clustering of nearby origins to share commute queries (CLUSTER_CELL)
+    - Offline commuting times from a GTFS feed (MEANS = 'gtfs', see gtfsRouting.py)
+    - Commuting by bike or by foot on the OSM street network (MEANS = 'bike' / 'walk', see streetRouting.py)
+    - Async client for the SBB-API with retries, and a local stand-in server (see transportClient.py)
+    - Commuting budget (MAX_COMMUTE_MINUTES): listings out of reach are pruned before routing
+    - Statistics of the commuting times (min/mean/p90/transfers) in a memory-mapped CommuteMatrixStore
+    - Sampling of the departures over a window (DEPARTURE_WINDOW, DEPARTURE_STEP)
+    - Scraper.scrapePages() yields the listings page by page, e.g. for the streaming Pipeline (see pipeline.py)
+    - Checkpoints of the Pipeline in a run directory, to resume long runs (Pipeline.RUN_DIR)
+    - df2GeoJSON streams the features to the file (writeGeoJSON), optionally gzipped
+    - Clusters per zoom level written as tiles for the map (clusterTiles)
+    - GeoParquet (Hilbert sorted, bbox covering) and FlatGeobuf (spatial index) exports
+    - Local query service over the listings with indexed filters, bbox and top-k (see queryServer.py)
+    - Alerts of saved searches on new or changed listings (see alerts.py)
+    - Scheduler for many search profiles with a shared fetch layer (Scraper.FETCHER, see scheduler.py)
+    - Sharded scraping (location x portal x page range) over a SQLite work queue with N worker processes (see sharding.py)
+    - Parsing of the pages in a process pool (PARSE_PROCESSES), parsers at module level (Functions C)
+    - Heavy dependencies (selenium, geopandas, shapely, geopy, scipy, ...) are imported on first use; command line (see cli.py)
+    
 Changes (compared to the version of Feb 2022):
     - Adding parameter SCRAPING_METHOD to the class Scraper. Acts as a switch to use selenium (as in the version of Nov 21).
     
@@ -26,31 +51,82 @@ Changes (compared to the version of Nov 2021):
 Add-ons which would be great:
     - Initiating and closing a local Nominatim instance from the script
     - More pages to scrape from
-    - More means to commute (e.g. bike)
 
 """
 __version__ = "22-03"
 
 
 import os, sys 
-from selenium import webdriver
+import copy
+import gzip
+import importlib
 import urllib.parse
-import requests
 import re
 import concurrent.futures
+import threading
+import sqlite3
+import warnings
 #import subprocess
 
 import numpy as np
 import pandas as pd
-import geopandas as gpd
 import json
-import xmltodict
-
-from geopy.geocoders import Nominatim
-from shapely.geometry import Point
 
 import time
-from datetime import timedelta, date
+from datetime import timedelta, date, datetime
+
+
+class _Lazy:
+    """
+    Stand-in for a module (or a class/function of it) which is imported on first use. The heavy
+    dependencies (selenium, geopandas, shapely, geopy, scipy, ...) are only loaded by the code paths
+    using them, e.g. a requests scrape of immoscout does not load selenium or geopandas.
+    """
+    
+    def __init__(self, module, attribute=None):
+        self._module = module
+        self._attribute = attribute
+        self._target = None
+        
+        
+    def _load(self):
+        if self._target is None:
+            target = importlib.import_module(self._module)
+            self._target = getattr(target, self._attribute) if self._attribute else target
+        return self._target
+    
+    
+    def __getattr__(self, name):
+        return getattr(self._load(), name)
+    
+    
+    def __call__(self, *args, **kwargs):
+        return self._load()(*args, **kwargs)
+
+
+requests = _Lazy('requests')
+webdriver = _Lazy('selenium.webdriver')
+gpd = _Lazy('geopandas')
+xmltodict = _Lazy('xmltodict')
+
+Nominatim = _Lazy('geopy.geocoders', 'Nominatim')
+RateLimiter = _Lazy('geopy.extra.rate_limiter', 'RateLimiter')
+Point = _Lazy('shapely.geometry', 'Point')
+shape = _Lazy('shapely.geometry', 'shape')
+prep = _Lazy('shapely.prepared', 'prep')
+STRtree = _Lazy('shapely.strtree', 'STRtree')
+cKDTree = _Lazy('scipy.spatial', 'cKDTree')
+
+
+def shapelyPoints(lon, lat):
+    """ Points of arrays of coordinates at once (Shapely >= 2.0) """
+    import shapely
+    return shapely.points(lon, lat)
+
+
+def _vectorizedShapely():
+    import shapely
+    return hasattr(shapely, 'points') # Shapely >= 2.0
 
 ##################################################################################
 #
@@ -86,8 +162,14 @@ class Scraper:
         FILTER_KEYWORDS (list): Filter out ads (e.g. if the apartment is shared, temporary contarct etc.)
         MAX_WORKERS (int): Number of workers for multi-threading
         INCLUDE_COORDS (bool): to keep or drop the columns lat/lon (as =True has many NULL values, it is recommended
-                                                                    to use Module 2 for geocoding)
+                                                                    to use Module 2 for geocoding, which keeps 
+                                                                    the coordinates found and fills the gaps;
+                                                                    with =False, all addresses are geocoded)
         SCRAPING_METHOD (str): Insert 'selenium' to use the old scraper (selenium, headless)
+        PARSE_PROCESSES (int): processes parsing the pages of homegate and immoscout (None: parsed in the 
+                                   threads fetching them)
+        FETCHER (object): shared fetch layer with get(url) -> html (e.g. scheduler.Fetcher with rate limits
+                                                                    per host), None: requests.get
         
     Returns:
         pd.DataFrame with columns: url (to ad), address, nRooms, size, rent, currency, description (title of the ad)
@@ -107,8 +189,10 @@ class Scraper:
     RADIUS = 0
     FILTER_KEYWORDS = ["Befristet", "befristet"]
     MAX_WORKERS = 10
-    INCLUDE_COORDS = False
+    INCLUDE_COORDS = True
     SCRAPING_METHOD = 'selenium'
+    PARSE_PROCESSES = None
+    FETCHER = None
     
     def __init__(self):
         
@@ -164,8 +248,153 @@ class Scraper:
             self.results = self.filterDescription(self.results)
           
         return self.results       
+    
+    
+    def scrapePages(self):
+        """
+        Scrapes page by page and yields the listings of each page as soon as it is parsed (e.g. for the 
+        Pipeline), instead of waiting for all portals as scrape(). The pages are fetched by MAX_WORKERS 
+        threads; comparis and the selenium scrapers yield one batch per portal.
+        
+        Yields
+        ------
+        pd.DataFrame (same columns as scrape()) per page, without listings yielded before.
+        """
+        for unit, batch in self.scrapeUnits():
+            if len(batch) > 0:
+                yield batch
+                
+                
+    def scrapeUnits(self, skip=(), seen=(), errors=None, only=None):
+        """
+        As scrapePages(), but yields every page as (unit, pd.DataFrame), also if empty, with the unit 
+        naming the page (e.g. 'homegate-3'). Used for checkpoints (see Pipeline.RUN_DIR).
+        
+        Parameters
+        ----------
+        skip : set
+            units not to scrape (e.g. done before)
+        seen : set
+            urls yielded before (e.g. by the skipped units)
+        errors : list
+            if given, pages failing are skipped and appended as (unit, exception), else the exception is raised
+        only : list
+            if given, only these units are scraped (see units(), e.g. a page range of a work unit of 
+            sharding.py), without fetching the number of pages
+        """
+        tasks = self.__tasks(only)
+        
+        seen = set(seen)
+        for source, unit, batch in self.__runTasks([task for task in tasks if task[1] not in skip]):
+            if isinstance(batch, Exception):
+                if errors is None:
+                    raise batch
+                errors.append((unit, batch))
+                continue
+            batch['source'] = source
+            
+            keys = list(zip(batch.url, batch.address, batch.description, batch.rent))
+            new = np.array([(key[0] not in seen) and (key[1:] not in seen) for key in keys], dtype=bool)
+            seen.update([key[0] for key in keys] + [key[1:] for key in keys])
+            batch = batch[new].reset_index(drop=True)
+            
+            batch['description'] = correctUmlauts(batch.description.tolist())
+            batch['address'] = correctUmlauts(batch.address.tolist())
+            if self.INCLUDE_COORDS==False:
+                batch = batch.drop(['lat','lon'], axis=1)
+            if self.FILTER_KEYWORDS and len(batch) > 0:
+                batch = self.filterDescription(batch)
+            
+            yield unit, batch
   
     
+    def units(self):
+        """ Names of the units (pages) of the portals to scrape, see scrapeUnits(); fetches the number of pages """
+        return [unit for source, unit, function, args in self.__tasks()]
+    
+    
+    def __tasks(self, only=None):
+        """ (source, unit, function, args) per unit to scrape """
+        tasks = []
+        if (self.PAGE == 'all') or ('homegate' in self.PAGE):
+            if self.SCRAPING_METHOD == 'selenium':
+                tasks.append(('homegate', 'homegate', self.__scrapeHomegate_selenium, ()))
+            else:
+                URL, pages = self.__pagesHomegate() if only is None else (self.URLS['homegate'], _pagesOfUnits(only, 'homegate'))
+                tasks += [('homegate', 'homegate-{}'.format(page), self.__scrapePage, ('homegate', URL, page)) for page in pages]
+                
+        if (self.PAGE == 'all') or ('immoscout' in self.PAGE):
+            if self.SCRAPING_METHOD == 'selenium':
+                tasks.append(('immoscout', 'immoscout', self.__scrapeImmoscout_selenium, ()))
+            else:
+                URL, pages = self.__pagesImmoscout() if only is None else (self.URLS['immoscout'], _pagesOfUnits(only, 'immoscout'))
+                tasks += [('immoscout', 'immoscout-{}'.format(page), self.__scrapePage, ('immoscout', URL, page)) for page in pages]
+                
+        if (self.PAGE == 'all') or ('comparis' in self.PAGE):
+            tasks.append(('comparis', 'comparis', self.__scrapeComparis, ()))
+        
+        if only is not None:
+            tasks = [task for task in tasks if task[1] in set(only)]
+        return tasks
+    
+    
+    def __runTasks(self, tasks):
+        """
+        Runs the tasks (see __tasks), yields (source, unit, pd.DataFrame or the exception) as they complete. 
+        The pages are fetched by MAX_WORKERS threads; with PARSE_PROCESSES, the raw pages are parsed by 
+        a pool of processes (in parallel, not serialized by the GIL), else in the fetching threads.
+        """
+        parsePool = concurrent.futures.ProcessPoolExecutor(max_workers=self.PARSE_PROCESSES) if self.PARSE_PROCESSES else None
+        try:
+            with concurrent.futures.ThreadPoolExecutor(max_workers=self.MAX_WORKERS) as executor:
+                pending = {}
+                for source, unit, function, args in tasks:
+                    if parsePool is not None and function == self.__scrapePage:
+                        pending[executor.submit(self.__fetchPage, *args)] = (source, unit, True)
+                    else:
+                        pending[executor.submit(function, *args)] = (source, unit, False)
+                
+                while pending:
+                    done, _ = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+                    for future in done:
+                        source, unit, fetched = pending.pop(future)
+                        try:
+                            result = future.result()
+                        except Exception as e:
+                            yield source, unit, e
+                            continue
+                        if fetched:
+                            pending[parsePool.submit(PAGE_PARSERS[source], result)] = (source, unit, False)
+                        else:
+                            yield source, unit, result if isinstance(result, pd.DataFrame) else pd.DataFrame(result)
+        finally:
+            if parsePool is not None:
+                parsePool.shutdown()
+    
+    
+    def __fetchPage(self, source, URL, page):
+        """ Returns a result page of a portal, raw (bytes) if fetched with requests """
+        if source == 'homegate':
+            url = URL+"&ep="+str(int(page)+1)
+        else:
+            url = URL+"&pn="+str(page) #&pn=X
+        if self.FETCHER is not None:
+            return self.FETCHER.get(url)
+        return requests.get(url).content
+    
+    
+    def __scrapePage(self, source, URL, page):
+        """ Scrapes one page of homegate or immoscout, returns pd.DataFrame """
+        return pd.DataFrame(PAGE_PARSERS[source](self.__fetchPage(source, URL, page)))
+    
+    
+    def fetch(self, url):
+        """ Returns the html of a page, through the FETCHER if set """
+        if self.FETCHER is not None:
+            return self.FETCHER.get(url)
+        return requests.get(url).content.decode('utf-8')
+    
+    
     def __getURL(self):
         
         self.URL = {}
@@ -258,8 +487,7 @@ class Scraper:
         driver = None
         
         URL = self.URLS['comparis']
-        request = requests.get(URL)
-        html = request.text
+        html = self.fetch(URL)
 
         urls = []
         addresses = []
@@ -344,9 +572,24 @@ class Scraper:
     
     def __scrapeImmoscout(self):
 
+        URL, pages = self.__pagesImmoscout()
+        tasks = [('immoscout', 'immoscout-{}'.format(page), self.__scrapePage, ('immoscout', URL, page)) for page in pages]
+        
+        submitted = []
+        for source, unit, batch in self.__runTasks(tasks):
+            if isinstance(batch, Exception):
+                raise batch
+            submitted.append(batch)
+        trawledImmoscout = pd.concat(submitted)
+        trawledImmoscout['source'] = 'immoscout'
+
+        return trawledImmoscout.drop_duplicates(subset=["url"])
+    
+    
+    def __pagesImmoscout(self):
+        """ Returns the URL and the pages to scrape (immoscout) """
         URL = self.URLS['immoscout']
-        response = requests.get(URL)
-        html = response.content.decode('utf-8')
+        html = self.fetch(URL)
    
         maxPagesTagStart = "<section class=\"Pagination__PaginationSection" 
         maxPagesTagEnd = "</section>"
@@ -359,113 +602,9 @@ class Scraper:
             maxPagination = np.max([int(x) for x in paginationsImmo])
                 
         print("Immoscout accessed, no. of pages: {}".format(maxPagination))
-        
-        
-        startStr = '\{"id":\d{7},"accountId"'
-        endStr = '\<\/script>'
-        
-        pages = list(range(maxPagination+1))
-        
-        def __scrapeImmoscout_pages(page):
-            
-            urls = []
-            addresses = []
-            prices = []
-            rooms = []
-            sizes = []
-            descriptions = []
-            pdates = []
-            currency = []
-            lat = []
-            lon = []
-            
-            newURL = URL+"&pn="+str(page) #&pn=X
-            response = requests.get(newURL)
-            html = response.content.decode('utf-8')
-            startInfos = re.search(startStr,html).span(0)[0]
-            endInfos = re.search(endStr,html).span(0)[0]
-            infoChunk = html[startInfos:endInfos]
-            
-            startPoints = [m.start(0)  for m in re.finditer(startStr,infoChunk)][:24]
-            
-            for i,point in enumerate(startPoints):
-                
-                info = infoChunk[point:infoChunk.find('"userRelevantScore"', point+1)-1]+"}"
-                if len(info) > 15000:
-                    continue
-                
-                infoAsDict = json.loads(info)
-                if len(infoAsDict) <9:
-                    continue
-                
-                _url = 'https://www.immoscout24.ch'+infoAsDict['propertyUrl']
-                _url = _url.replace("https://www.immoscout24.chhttps://","https://www.")
-                urls.append(_url)
-                
-                if 'street' in infoAsDict:
-                    addresses.append( ", ".join([infoAsDict['street'], " ".join([infoAsDict['zip'],  infoAsDict['cityName']])]))
-                else:
-                    addresses.append(" ".join([infoAsDict['zip'],  infoAsDict['cityName']]))
-
-                if infoAsDict['priceFormatted'] == 'Preis auf Anfrage':
-                    prices.append(np.nan)
-                elif 'grossPrice' in infoAsDict:
-                    prices.append( infoAsDict['grossPrice'] )
-                else:
-                    prices.append( infoAsDict['price'])
-                
-                # ugly, but necessary (?)
-                try:
-                    rooms.append(infoAsDict['numberOfRooms'])
-                except KeyError:
-                    rooms.append(np.nan)
-                    
-                try:
-                    sizes.append(infoAsDict['surfaceLiving'] )
-                except KeyError:
-                    sizes.append(np.nan)
-                    
-                try:
-                    descriptions.append(infoAsDict['title'])
-                except KeyError:
-                    descriptions.append('no description')
-                    
-                currency.append(infoAsDict['priceFormatted'][:3])
-                
-                pdate = infoAsDict['lastPublished']
-                pdates.append(pdate)
-                
-                try:
-                    lat.append( infoAsDict['latitude'])
-                    lon.append( infoAsDict['longitude'])
-                except KeyError:
-                    lat.append(np.nan)
-                    lon.append(np.nan)
-                
-            newURL = URL+"&pn="+str(page+1) #&pn=X
-            response = requests.get(newURL)
-            html = response.content.decode('utf-8')
-            #print("Scraped immoscout24: page {}".format(page))
-            
-            newRow = pd.DataFrame({'url':urls, 'address':addresses, 'nRooms':rooms, 'size':sizes, 'rent':prices, 'currency':currency, 
-                                          'description':descriptions, 
-                                          'published':pdates, 'lat':lat, 'lon':lon})
-            return newRow
-            
-        rows = []
-        with concurrent.futures.ThreadPoolExecutor(max_workers=self.MAX_WORKERS) as executor:
-            for page in pages:
-                row = executor.submit(__scrapeImmoscout_pages, page)
-                rows.append(row)
-            
-            
-        submitted = [row.result() for row in rows]
-        trawledImmoscout = pd.concat(submitted)
-        trawledImmoscout['source'] = 'immoscout'
-
-        return trawledImmoscout.drop_duplicates(subset=["url"])
-
-
+        return URL, list(range(maxPagination+1))
+    
+    
     def __scrapeImmoscout_selenium(self):
         # old, but works - again/still...
         URL = None
@@ -601,118 +740,33 @@ class Scraper:
     
     def __scrapeHomegate(self):
         
+        URL, pages = self.__pagesHomegate()
+        tasks = [('homegate', 'homegate-{}'.format(page), self.__scrapePage, ('homegate', URL, page)) for page in pages]
+        
+        submitted = []
+        for source, unit, batch in self.__runTasks(tasks):
+            if isinstance(batch, Exception):
+                raise batch
+            submitted.append(batch)
+        trawledHomegate = pd.concat(submitted)
+        
+        trawledHomegate['source'] = 'homegate'
+        return trawledHomegate.drop_duplicates(subset=["url"])
+    
+    
+    def __pagesHomegate(self):
+        """ Returns the URL and the pages to scrape (homegate) """
         URL = self.URLS['homegate']
-        response = requests.get(URL)
-        html = response.content.decode('utf-8')
+        html = self.fetch(URL)
         
         maxPageSpan = re.search('"pageCount":\d{1,5}', html).span()
         maxPageStr = html[maxPageSpan[0]:maxPageSpan[1]].split(':')[1]
         maxPage = int(maxPageStr)
                           
         print("Homegate accessed, no. of pages: {}".format(maxPage))
-        def __get_HTMLchunks(page):
-            #for pageNumber in range(maxPage):
-            newURL = URL+"&ep="+str(int(page)+1) 
-            response = requests.get(newURL)
-            html = response.content.decode('utf-8')
-            chunkStart = re.search('<script>window.__INITIAL_STATE__=', html).span()[1]
-            chunkEnd = re.search(',"page":\d{1,5},"pageCount":\d{1,5},"', html).span()[0]
-            
-            htmlChunk = html[chunkStart:chunkEnd]
-            return htmlChunk
-        
-        pages = list(range(maxPage+1))
-        htmlChunks = []
-        with concurrent.futures.ThreadPoolExecutor(max_workers=self.MAX_WORKERS) as executor:
-            for page in pages:
-                chunk = executor.submit(__get_HTMLchunks, page)
-                htmlChunks.append(chunk)
-                
-        htmlChunks = " ".join([h.result() for h in htmlChunks])
-        
+        return URL, list(range(maxPage+1))
+    
     
-        matches = [m.start(0) for m in re.finditer('{"listingType":', htmlChunks)]
-        
-        def __harvest_HomegateChunks(miniStart):
-            urls = []
-            addresses = []
-            prices = []
-            rooms = []
-            sizes = []
-            descriptions = []
-            pdates = []
-            currency = []
-            lat = []
-            lon = []
-        
-            miniEnd = htmlChunks.find('"currency":',miniStart)+len('"currency":')+5
-            miniChunk = htmlChunks[miniStart:miniEnd]+"}}}"
-            chunkDict = json.loads(miniChunk)
-            
-            url = 'https://www.homegate.ch/mieten/'+chunkDict['listing']['id']
-            urls.append(url)
-            
-            try: 
-                if chunkDict['listing']['prices']['rent']['interval'] == 'WEEK':
-                    multiplier = 4
-                else:
-                    multiplier = 1
-                
-            except KeyError:
-                #print('KeyError: check rent interval, assumed interval: monthly')
-                multiplier = 1
-            
-                
-            try:
-                chunkDict['listing']['prices']['rent']['gross']
-                rent = chunkDict['listing']['prices']['rent']['gross'] * multiplier
-                
-            except KeyError:
-                rent = np.nan
-
-            prices.append(rent)
-            currency.append(chunkDict['listing']['prices']['currency'])
-        
-            if len(chunkDict['listing']['address']) == 3:
-                plzAdr = " ".join([chunkDict['listing']['address']['postalCode'], chunkDict['listing']['address']['locality']])
-                address = ", ".join([chunkDict['listing']['address']['street'], plzAdr])
-                
-            elif len(chunkDict['listing']['address']) == 2:
-                address = " ".join([chunkDict['listing']['address']['postalCode'], chunkDict['listing']['address']['locality']])
-                
-            addresses.append(address.replace(',,',','))        
-            
-            rooms.append(chunkDict['listing']['characteristics']['numberOfRooms'])
-            sizes.append(chunkDict['listing']['characteristics']['livingSpace'])
-            descriptions.append(chunkDict['listing']['localization']['de']['text']['title'])
-        
-            pdates.append(np.nan)
-            lat.append(np.nan)
-            lon.append(np.nan)
-            
-            newRow = pd.DataFrame({'url':urls, 'address':addresses, 'nRooms':rooms, 'size':sizes, 'rent':prices, 'currency':currency, 
-                                          'description':descriptions, 
-                                          'published':pdates, 'lat':lat, 'lon':lon})
-            return newRow
-            
-        
-           
-        
-        rows = []
-        with concurrent.futures.ThreadPoolExecutor(max_workers=self.MAX_WORKERS) as executor:
-            for match in matches:
-                row = executor.submit(__harvest_HomegateChunks, match)
-                print(row)
-                rows.append(row)
-            
-            
-        submitted = [row.result() for row in rows]
-        trawledHomegate = pd.concat(submitted)
-        
-        trawledHomegate['source'] = 'homegate'
-        return trawledHomegate.drop_duplicates(subset=["url"])
-            
-
     def __scrapeHomegate_selenium(self):
         # old, but works - again/still...
         URL = None
@@ -864,6 +918,83 @@ class Scraper:
 #
 ##################################################################################
     
+class GeocodingMetrics:
+    """
+    Collects metrics on the geocoding, to find the actual bottleneck (e.g. to tune MAX_WORKERS or the 
+    cleaning table). Thread-safe, filled by Geocoding and returned with geocode(returnMetrics=True).
+    
+    Reports (summary()): 
+        - per source: number of addresses, hits, empty results, errors, empty-result rate, 
+          requests/s and latency (mean, p50, p90, max)
+        - latency histogram per source (latencyHistogram())
+        - exceptions counted by type
+        - cleaning rules fired (and how often)
+    """
+    
+    LATENCY_BINS = [0, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, np.inf] # in seconds
+    
+    def __init__(self):
+        self.records = []
+        self.exceptions = {}
+        self.rulesFired = {}
+        self.__lock = threading.Lock()
+        
+        
+    def record(self, address, source, start, seconds, outcome, exception=None):
+        """ 
+        Records one address: outcome is 'hit', 'empty' (nothing found) or 'error'. 
+        start is the time.time() the request started.
+        """
+        with self.__lock:
+            self.records.append((address, source, start, seconds, outcome))
+            if exception is not None:
+                name = type(exception).__name__
+                self.exceptions[name] = self.exceptions.get(name, 0) + 1
+                
+                
+    def ruleFired(self, rule):
+        with self.__lock:
+            self.rulesFired[rule] = self.rulesFired.get(rule, 0) + 1
+            
+            
+    def toDataFrame(self):
+        return pd.DataFrame(self.records, columns=['address','source','start','seconds','outcome'])
+    
+    
+    def latencyHistogram(self):
+        """ Number of addresses per latency bin (rows) and source (columns) """
+        df = self.toDataFrame()
+        labels = ['<{}s'.format(b) if np.isfinite(b) else '>={}s'.format(self.LATENCY_BINS[-2]) for b in self.LATENCY_BINS[1:]]
+        histogram = {}
+        for source, group in df.groupby('source'):
+            histogram[source] = np.histogram(group.seconds, bins=self.LATENCY_BINS)[0]
+        return pd.DataFrame(histogram, index=labels)
+    
+    
+    def summary(self):
+        """ Summary per source """
+        df = self.toDataFrame()
+        rows = []
+        for source, group in df.groupby('source'):
+            wallTime = (group.start + group.seconds).max() - group.start.min()
+            rows.append({'source': source,
+                         'addresses': len(group),
+                         'hits': (group.outcome == 'hit').sum(),
+                         'empty': (group.outcome == 'empty').sum(),
+                         'errors': (group.outcome == 'error').sum(),
+                         'empty_rate': (group.outcome == 'empty').mean(),
+                         'requests_per_s': len(group) / wallTime if wallTime > 0 else np.nan,
+                         'latency_mean': group.seconds.mean(),
+                         'latency_p50': group.seconds.quantile(0.5),
+                         'latency_p90': group.seconds.quantile(0.9),
+                         'latency_max': group.seconds.max()})
+        return pd.DataFrame(rows)
+    
+    
+    def __repr__(self):
+        return "GeocodingMetrics\n{}\nexceptions: {}\nrules fired: {}".format(self.summary(), self.exceptions, self.rulesFired)
+    
+    
 class Geocoding:
     """ 
     Module for geocoding. In a nutshell, it takes a list of addresses and finds the 
@@ -878,15 +1009,34 @@ class Geocoding:
     is only encouraged for small number of single-threadedly queried addresses (less than 100). Else,
     the IP address will be blocked for 1h.    
     
+    With NOMINATIM = 'router', the sources are tried in the order of their costs (ROUTER): a cache 
+    on the hard disk, an offline lookup of postal codes (for addresses without street), the local 
+    Nominatim and at last the public Nominatim (rate limited to 1 request/s). Each source only gets
+    the addresses the cheaper sources could not locate. SOURCE_STATS summarizes hits and latency.
+    
+    
+    If DATA is the pd.DataFrame returned by the Scraper (with INCLUDE_COORDS = True), the coordinates
+    delivered by the portals (e.g. immoscout) are kept and only the addresses without (valid) coordinates
+    are sent to Nominatim.
     
     Parameters:
-        NOMINATIM (str): local or localhost for running it locally, else it web-based
-        ADDRESSES (list pd/gpd.(Geo)DataFrame with 'address' column): list of strings with addresses to be geocoded
+        NOMINATIM (str): local or localhost for running it locally, router for the fallback chain (see above), 
+            else it web-based
+        NOMINATIM_URL (str): search endpoint of the local Nominatim
+        ROUTER (list): sources of the fallback chain, in order: 'cache', 'plz', 'local', 'public'
+        GEOCODE_CACHE (str): path to the csv used as cache (router only; None: no cache)
+        PLZ_CENTROIDS (dict / str): {plz: (lat, lon)} or path to a csv with the columns plz, lat, lon (router only)
+        DATA (list pd/gpd.(Geo)DataFrame with 'address' column): list of strings with addresses to be geocoded
         CLEAN_ADDRESS_ENTRIES (dict): dict with key and value pair. Searches for key and replaces with value.
         MAX_WORKERS (int): Max. workers for multi-threading
+        KEEP_PORTAL_COORDS (bool): keep lat/lon of DATA (if given as pd.DataFrame) instead of geocoding these addresses
+        VALIDATE_COORDS (bool): only keep portal coordinates within Switzerland (and the PLZ, see below)
+        PLZ_BOUNDING_BOXES (dict / str): {plz: (latMin, lonMin, latMax, lonMax)} or path to a csv with the 
+            columns plz, lat_min, lon_min, lat_max, lon_max. Portal coordinates outside the box of their PLZ are geocoded.
     
     Returns:
         pd.DataFrame with the columns address (input address), address_located (cleaned address), lat, lon 
+        (and GeocodingMetrics, if geocode(returnMetrics=True); also available as METRICS)
         
     * Please make sure to run Nominatim ("cd /folder/with/import && nominatim serve")    
     """
@@ -896,27 +1046,69 @@ class Geocoding:
     DATA = ['']
     CLEAN_ADDRESS_ENTRIES = {}
     MAX_WORKERS = 50
+    KEEP_PORTAL_COORDS = True
+    VALIDATE_COORDS = True
+    PLZ_BOUNDING_BOXES = None
+    NOMINATIM_URL = 'http://localhost:8088/search.php'
+    ROUTER = ['cache', 'plz', 'local', 'public']
+    GEOCODE_CACHE = 'geocodeCache.csv'
+    PLZ_CENTROIDS = None
+    PORTAL_COORDS = pd.DataFrame({'address':[], 'address_located':[], 'lat':[], 'lon':[]}) # none, e.g. a list of addresses
     
     def __init__(self):
         if self.MAX_WORKERS < 1:
             self.MAX_WORKERS = 1
         if isinstance(self.DATA, str):
             self.DATA = [self.DATA]
-        if isinstance(self.DATA, (pd.DataFrame or gpd.GeoDataFrame)):
+            
+        if isinstance(self.DATA, pd.DataFrame): # also gpd.GeoDataFrame
             if 'address' in self.DATA.columns:
-                self.DATA = self.DATA['address'].tolist()
+                if self.KEEP_PORTAL_COORDS and ('lat' in self.DATA.columns) and ('lon' in self.DATA.columns):
+                    self.PORTAL_COORDS = self.__portalCoordinates(self.DATA)
+                    located = set(self.PORTAL_COORDS.address)
+                    self.DATA = [adr for adr in self.DATA['address'].tolist() if adr not in located]
+                else:
+                    self.DATA = self.DATA['address'].tolist()
         self.DATA = list(set(self.DATA))
         
         assert isinstance(self.CLEAN_ADDRESS_ENTRIES, dict), "CLEAN_ADDRESS_ENTRIES must be a dictionary"
         
 
-    def geocode(self):
+    def geocode(self, returnMetrics=False):
+        self.METRICS = GeocodingMetrics()
+        
+        if len(self.DATA) == 0:
+            df = self.PORTAL_COORDS.reset_index(drop=True)
+            return (df, self.METRICS) if returnMetrics else df
+        
         cleanAddr =  self.__cleanAddresses()
         if self.NOMINATIM in ['localhost', 'local']:
-            return  self.__geocode_local(cleanAddr)
+            df = self.__geocode_local(cleanAddr)
+        elif self.NOMINATIM == 'router':
+            df = self.__geocode_router(cleanAddr)
         else:
-            return self.__geocode_internet(cleanAddr)
+            df = self.__geocode_internet(cleanAddr)
+            
+        df = pd.concat([self.PORTAL_COORDS, df])
+        df = df.drop_duplicates(subset=['address']).reset_index(drop=True)
+        return (df, self.METRICS) if returnMetrics else df
  
+    
+    def __portalCoordinates(self, dataframe):
+        """ Returns the (valid) coordinates delivered by the portals, one row per address """
+        coords = dataframe[['address','lat','lon']].copy()
+        coords['lat'] = pd.to_numeric(coords['lat'], errors='coerce')
+        coords['lon'] = pd.to_numeric(coords['lon'], errors='coerce')
+        coords = coords.dropna(subset=['lat','lon'])
+        
+        if self.VALIDATE_COORDS:
+            coords = coords[validateCoordinates(coords, self.PLZ_BOUNDING_BOXES)]
+        
+        coords = coords.drop_duplicates(subset=['address'])
+        coords['address_located'] = coords['address']
+        return coords[['address','address_located','lat','lon']].reset_index(drop=True)
+        
+        
         
     def __cleanAddresses(self):
         """ cleans addresses (issues with umlauts, abbvreviations, typos etc.) """
@@ -954,16 +1146,26 @@ class Geocoding:
             addressRaw = correctUmlauts(addressRaw)
             
             adr = addressRaw.replace('pl.','platz').replace('str.','strasse').replace('str ','strasse ')
-            adr = adr.replace(', Schweiz','').replace('Schweiz','') #regex it...
-            adr = re.sub("(N|n)(a|ä)he ","",adr)
+            if adr != addressRaw:
+                self.METRICS.ruleFired('abbreviations')
+            cleaned = adr.replace(', Schweiz','').replace('Schweiz','') #regex it...
+            cleaned = re.sub("(N|n)(a|ä)he ","",cleaned)
+            if cleaned != adr:
+                self.METRICS.ruleFired('Schweiz / Nähe')
+            adr = cleaned
             
             for key in cleaningLookUp.keys():
-                adr = adr.replace(key, cleaningLookUp[key])
+                if key and key in adr:
+                    self.METRICS.ruleFired(key)
+                    adr = adr.replace(key, cleaningLookUp[key])
                 
             # get nominatim ready address:    
-            
-            params = createNominatimParams(adr)  
-            cleanAddress = params['street']+", "+ params['postalcode']+" "+params['city']
+            try:
+                params = createNominatimParams(adr)  
+                cleanAddress = params['street']+", "+ params['postalcode']+" "+params['city']
+            except IndexError as e:
+                self.METRICS.record(addressRaw, 'cleaning', time.time(), 0, 'error', e)
+                cleanAddress = adr
                 
             cleanAddresses.append(cleanAddress)
             originalAddresses.append(addressRaw)
@@ -986,18 +1188,24 @@ class Geocoding:
             address = row['address']
             clean = row['cleanAddress']
             
-            params = createNominatimParams(clean)
-   
-            r = requests.get('http://localhost:8088/search.php', params)
-            if len(r.text) == 2:
+            t0 = time.time()
+            try:
+                params = createNominatimParams(clean)
+                r = requests.get(self.NOMINATIM_URL, params)
+                result = json.loads(r.text)
+            except Exception as e:
+                self.METRICS.record(address, 'local', t0, time.time()-t0, 'error', e)
+                result = []
+            else:
+                self.METRICS.record(address, 'local', t0, time.time()-t0, 'hit' if len(result) > 0 else 'empty')
+            
+            if len(result) == 0:
                 address_scraped.append(address) 
                 address_located.append(clean) 
                 lats.append(np.nan) 
                 lons.append(np.nan) 
             
             else:
-                result = json.loads(r.text)
-                
                 ranks = [res['place_rank'] for res in result]
                 selectResult = np.argmax(ranks)
                 
@@ -1022,14 +1230,22 @@ class Geocoding:
 
 
     def __geocode_internet(self,cleanAddr):
-        """ Uses Nominatim from a web server. Multi-threading not encouraged. """
+        """ Uses Nominatim from a web server (1 request/s). Multi-threading not encouraged. """
         
-        nom = Nominatim(user_agent="FindApartment_CH", scheme='http', domain='nominatim.openstreetmap.org')
+        nom = publicNominatim()
         lat = []
         lon = []       
                    
         for idx, row in cleanAddr.iterrows():  
-            location = nom.geocode(row.cleanAddress)    
+            t0 = time.time()
+            try:
+                location = nom(row.cleanAddress)
+            except Exception as e:
+                self.METRICS.record(row.address, 'public', t0, time.time()-t0, 'error', e)
+                location = None
+            else:
+                self.METRICS.record(row.address, 'public', t0, time.time()-t0, 'empty' if location is None else 'hit')
+                
             if type(location) == type(None):
                 lat.append(None)
                 lon.append(None)
@@ -1042,40 +1258,334 @@ class Geocoding:
         return df.drop_duplicates(subset=['address'])
     
     
+    def __geocode_router(self, cleanAddr):
+        """ Tries the sources of ROUTER in order, each source only gets the misses of the previous one """
+        sources = {'cache': self.__locate_cache,
+                   'plz': self.__locate_plz,
+                   'local': self.__locate_local,
+                   'public': self.__locate_public}
+        
+        self.SOURCE_STATS = pd.DataFrame({'source':[], 'queried':[], 'hits':[], 'seconds':[]})
+        located = []
+        misses = cleanAddr.drop_duplicates(subset=['address'])
+        
+        for source in self.ROUTER:
+            if len(misses) == 0:
+                break
+            
+            t0 = time.time()
+            hits = sources[source](misses)
+            hits = hits.dropna(subset=['lat','lon'])
+            seconds = time.time() - t0
+            
+            if source in ['cache', 'plz']:
+                hit = set(hits.address)
+                for address in misses.address:
+                    self.METRICS.record(address, source, t0, seconds/len(misses), 'hit' if address in hit else 'empty')
+            
+            self.SOURCE_STATS = self.SOURCE_STATS.append({'source':source, 'queried':len(misses), 'hits':len(hits), 
+                                                          'seconds':seconds}, ignore_index=True)
+            located.append(hits)
+            misses = misses[~misses.address.isin(hits.address)]
+            
+        self.SOURCE_STATS['hit_rate'] = self.SOURCE_STATS['hits'] / self.SOURCE_STATS['queried']
+        self.SOURCE_STATS['seconds_per_address'] = self.SOURCE_STATS['seconds'] / self.SOURCE_STATS['queried']
+        
+        located = pd.concat(located + [pd.DataFrame({'address':misses.address, 'address_located':misses.cleanAddress, 
+                                                     'lat':np.nan, 'lon':np.nan})])
+        
+        if self.GEOCODE_CACHE and ('cache' in self.ROUTER):
+            self.__updateCache(located.merge(cleanAddr, on='address'))
+            
+        return located.drop_duplicates(subset=['address'])
+    
+    
+    def __noHits(self):
+        return pd.DataFrame({'address':[], 'address_located':[], 'lat':[], 'lon':[]})
+    
+    
+    def __readCache(self):
+        if self.GEOCODE_CACHE and os.path.isfile(self.GEOCODE_CACHE):
+            return pd.read_csv(self.GEOCODE_CACHE, dtype={'cleanAddress':str, 'address_located':str})
+        return pd.DataFrame({'cleanAddress':[], 'address_located':[], 'lat':[], 'lon':[]}, dtype=object)
+    
+    
+    def __updateCache(self, located):
+        """ Adds the located addresses to the cache on the hard disk """
+        located = located.dropna(subset=['lat','lon'])[['cleanAddress','address_located','lat','lon']]
+        cache = pd.concat([self.__readCache(), located]).drop_duplicates(subset=['cleanAddress'], keep='last')
+        cache.to_csv(self.GEOCODE_CACHE, index=False)
+    
+    
+    def __locate_cache(self, misses):
+        """ Looks up the cleaned addresses in the cache """
+        hits = misses.merge(self.__readCache(), on='cleanAddress', how='inner')
+        return hits[['address','address_located','lat','lon']]
+    
+    
+    def __locate_plz(self, misses):
+        """ Offline lookup of the centroid of the postal code, only for addresses without street """
+        if self.PLZ_CENTROIDS is None:
+            return self.__noHits()
+        
+        if isinstance(self.PLZ_CENTROIDS, dict):
+            centroids = pd.DataFrame([[str(plz), latlon[0], latlon[1]] for plz,latlon in self.PLZ_CENTROIDS.items()],
+                                     columns=['plz','lat','lon'])
+        else:
+            centroids = pd.read_csv(self.PLZ_CENTROIDS, dtype={'plz':str})
+        
+        noStreet = misses[misses.cleanAddress.str.split(',').str[0].str.strip() == '']
+        noStreet = noStreet.assign(plz=noStreet.cleanAddress.str.extract(r'\b(\d{4})\b', expand=False))
+        hits = noStreet.merge(centroids[['plz','lat','lon']], on='plz', how='inner')
+        hits['address_located'] = hits['cleanAddress']
+        return hits[['address','address_located','lat','lon']]
+    
+    
+    def __locate_local(self, misses):
+        """ Local Nominatim, skipped if it is not running """
+        try:
+            requests.get(self.NOMINATIM_URL, params={'q':'Zürich', 'format':'jsonv2'}, timeout=2)
+        except requests.exceptions.RequestException:
+            print("Local Nominatim not reachable, skipped.")
+            return self.__noHits()
+        
+        hits = self.__geocode_local(misses)
+        hits['lat'] = pd.to_numeric(hits['lat'])
+        hits['lon'] = pd.to_numeric(hits['lon'])
+        return hits
+    
+    
+    def __locate_public(self, misses):
+        """ Public Nominatim (1 request/s) """
+        return self.__geocode_internet(misses)
+    
+    
 ##################################################################################
 #
 # Module 3: CommuteTimes
 #
 ##################################################################################
 
-class CommutingTimes(Geocoding):
+class CommuteCache:
     """
-    Class to handle the retrieval of commuting times. 
-    Currently, it uses the SBB-API to retrieve the average time spent for commuting, by
-    accessing the schedule on the 'next monday morning at 8.30 AM'.
+    Persistent cache (sqlite) for the commuting times, as the answer of the SBB-API for a given origin, 
+    destination and departure slot (e.g. monday 08:00) barely changes from one run to the next.
     
-    Given multiple DESTINATIONs, it is possible to get average commuting time to multiple places,
-    useful to estimate the reachability to other places. 
+    The origin is snapped to a grid with cells of CELL_SIZE meters, i.e. listings within the same cell 
+    share the cached connections. Entries expire after TTL seconds; beyond MAX_ENTRIES the least 
+    recently used entries are evicted.
     
-    If the air distance between the given and destination address is smaller than a given distance, 
-    the commuting time is calculated for. Without this, it has been suggest rather complicated routes
-    for adjacent locations.
+    Parameters:
+        PATH (str): path to the sqlite file
+        CELL_SIZE (float): size of the grid cells in meters
+        TTL (float): time to live of an entry in seconds
+        MAX_ENTRIES (int): max. number of entries
+    """
     
-    This module returns a pd.DataFrame which can be merged with another pd.DataFrame on the 'address' column
+    PATH = 'commuteCache.sqlite'
+    CELL_SIZE = 50
+    TTL = 7*24*3600
+    MAX_ENTRIES = 200000
     
-    Ideas for augmentation:
-        - adding other means, namely bicycle
-        
-    Parameters:
-        DATAFRAME (pd.DataFrame): containing columns address, lat and lon
-        DESTINATION (tuple, list / str): pairs of coordinates (lat,lon - decimal degrees ) or str containing the address (which then is geocoded)
-        MAX_WORKERS (int): max. number of threads for multi-threading
+    def __init__(self):
+        self.__lock = threading.Lock()
+        self.__accessed = {} # key -> time of the last hit, written by evict() (get() does not write)
+        self.connection = sqlite3.connect(self.PATH, timeout=30, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL") # readers do not block the writer (e.g. several CommutingTimes)
+        self.connection.execute("PRAGMA busy_timeout=30000")
+        self.connection.execute("""CREATE TABLE IF NOT EXISTS commute (
+                                   key TEXT PRIMARY KEY, result TEXT, created REAL, accessed REAL)""")
+        self.connection.commit()
+        self.hits = 0
+        self.misses = 0
+        
+        
+    def key(self, lat, lon, destination, means, slot):
+        """ Key of the grid cell (origin), destination, means and departure slot """
+        metersPerDegree = np.pi / 180 * EARTH_RADIUS
+        cellY = int(np.floor(lat * metersPerDegree / self.CELL_SIZE))
+        cellX = int(np.floor(lon * metersPerDegree * np.cos(np.deg2rad(46.8)) / self.CELL_SIZE))
+        return "{}:{}|{:.5f},{:.5f}|{}|{}|{}".format(cellY, cellX, destination[0], destination[1], means, slot, self.CELL_SIZE)
+    
+    
+    def get(self, key):
+        """ Returns the cached result (dict) or None """
+        now = time.time()
+        with self.__lock:
+            row = self.connection.execute("SELECT result, created FROM commute WHERE key = ?", (key,)).fetchone()
+            if row is None or now - row[1] > self.TTL:
+                self.misses += 1
+                return None
+            self.__accessed[key] = now
+            self.hits += 1
+        return json.loads(row[0])
+    
+    
+    def put(self, key, result):
+        now = time.time()
+        with self.__lock:
+            self.connection.execute("INSERT OR REPLACE INTO commute VALUES (?, ?, ?, ?)", (key, json.dumps(result), now, now))
+            self.connection.commit() # kept after a crash, and no lock held until close()
+            
+            
+    def evict(self):
+        """ Removes expired entries and the least recently used entries beyond MAX_ENTRIES """
+        with self.__lock:
+            self.connection.executemany("UPDATE commute SET accessed = ? WHERE key = ?",
+                                        [(accessed, key) for key, accessed in self.__accessed.items()])
+            self.__accessed = {}
+            self.connection.execute("DELETE FROM commute WHERE created < ?", (time.time() - self.TTL,))
+            self.connection.execute("""DELETE FROM commute WHERE key IN (
+                                       SELECT key FROM commute ORDER BY accessed DESC LIMIT -1 OFFSET ?)""", (int(self.MAX_ENTRIES),))
+            self.connection.commit()
+            
+            
+    def close(self):
+        self.evict()
+        self.connection.close()
+        
+        
+class CommuteMatrixStore:
+    """
+    Store of the commuting times as one array listings x destinations x departure slots x statistics
+    (float32, NaN if unknown), persisted as memory-mapped .npy in the directory PATH together with the 
+    listing index (listings.csv: key, lat, lon) and the labels of the other axes (axes.json). Ranking 
+    or rendering a map reads it without recomputing the commuting times or merging DataFrames.
+    
+    Usage:
+        store = CommuteMatrixStore()                 # opens an existing store at PATH
+        store.toDataFrame('p90')                     # listings x destinations
+        store.MATRIX[store.position(url), :, 0, 1]   # mean to all destinations of one listing
+    
+    Parameters:
+        PATH (str): directory of the store
+        STATS (list): statistics along the last axis
+    """
+    
+    PATH = 'commuteMatrix'
+    STATS = ['min', 'mean', 'p90', 'transfers']
+    
+    def __init__(self, listings=None, destinations=None, slots=None):
+        """ Opens the store at PATH, or creates it given listings (pd.DataFrame: key, lat, lon), destinations and slots """
+        matrixPath = os.path.join(self.PATH, 'matrix.npy')
+        if listings is None:
+            with open(os.path.join(self.PATH, 'axes.json')) as f:
+                axes = json.load(f)
+            self.LISTINGS = pd.read_csv(os.path.join(self.PATH, 'listings.csv'), dtype={'key': str})
+            self.MATRIX = np.load(matrixPath, mmap_mode='r+')
+        else:
+            os.makedirs(self.PATH, exist_ok=True)
+            axes = {'destinations': [list(dest) for dest in destinations], 'slots': list(slots), 'stats': list(self.STATS)}
+            with open(os.path.join(self.PATH, 'axes.json'), 'w') as f:
+                json.dump(axes, f)
+            self.LISTINGS = listings[['key', 'lat', 'lon']].reset_index(drop=True)
+            self.LISTINGS.to_csv(os.path.join(self.PATH, 'listings.csv'), index=False)
+            shape = (len(self.LISTINGS), len(axes['destinations']), len(axes['slots']), len(axes['stats']))
+            self.MATRIX = np.lib.format.open_memmap(matrixPath, mode='w+', dtype=np.float32, shape=shape)
+            self.MATRIX[:] = np.nan
+        
+        self.DESTINATIONS = [tuple(dest) for dest in axes['destinations']]
+        self.SLOTS = axes['slots']
+        self.STATS = axes['stats']
+        keys = self.LISTINGS['key']
+        self.__positions = pd.Series(np.arange(len(keys)), index=keys)[~keys.duplicated().to_numpy()]
+        
+        
+    def position(self, keys):
+        """ Position(s) of listing keys along the first axis (first listing with the key, -1 if unknown) """
+        if isinstance(keys, str):
+            return int(self.__positions.get(keys, -1))
+        return self.__positions.reindex(keys).fillna(-1).astype(int).to_numpy()
+    
+    
+    def toDataFrame(self, stat='mean', slot=None):
+        """ 
+        Commuting times of all listings as pd.DataFrame (index: listing key, columns: destinations).
+        
+        Parameters
+        ----------
+        stat : str
+            one of STATS
+        slot : str
+            departure slot, None: mean over all slots
+        """
+        values = self.MATRIX[:, :, :, self.STATS.index(stat)]
+        if slot is None:
+            with warnings.catch_warnings():
+                warnings.simplefilter('ignore', category=RuntimeWarning) # all NaN
+                values = np.nanmean(values, axis=2)
+        else:
+            values = values[:, :, self.SLOTS.index(slot)]
+        return pd.DataFrame(values, index=self.LISTINGS['key'], columns=['{}_{}'.format(stat, i+1) for i in range(len(self.DESTINATIONS))])
+        
+        
+    def flush(self):
+        self.MATRIX.flush()
+        
+        
+class CommutingTimes(Geocoding):
+    """
+    Class to handle the retrieval of commuting times. 
+    Currently, it uses the SBB-API to retrieve the average time spent for commuting, by
+    accessing the schedule on the 'next monday morning at 8.30 AM'.
+    
+    With MEANS = 'gtfs', the commuting times are computed offline from a GTFS feed (see gtfsRouting):
+    one reverse search per destination yields the commuting times of all listings, for the latest 
+    journey arriving by GTFS_ARRIVE_BY.
+    With MEANS = 'bike' or 'walk', the commuting times are computed on the street network of an 
+    OSM extract (see streetRouting), one Dijkstra per destination.
+    
+    Given multiple DESTINATIONs, it is possible to get average commuting time to multiple places,
+    useful to estimate the reachability to other places. 
+    
+    If the air distance between the given and destination address is smaller than a given distance, 
+    the commuting time is calculated for. Without this, it has been suggest rather complicated routes
+    for adjacent locations.
+    
+    This module returns a pd.DataFrame which can be merged with another pd.DataFrame on the 'address' column
+    
+    Parameters:
+        DATA (pd.DataFrame / list): containing columns address, lat and lon. The pd.DataFrame returned by the 
+            Scraper can be used directly: addresses without (valid) coordinates are geocoded (see Geocoding).
+        DESTINATION (tuple, list / str): pairs of coordinates (lat,lon - decimal degrees ) or str containing the address (which then is geocoded)
+        MAX_WORKERS (int): max. number of threads for multi-threading (max. concurrent requests to the SBB-API)
         WALKING_DISTANCE (int/float): for distance reasonable to walk
-        TEST_FIRST (bool): Tests the access to the SBB-API
+        MEANS (str): 'public_transportation' (SBB-API), 'gtfs' (offline, GTFS feed), 'bike' or 'walk' (offline, OSM)
+        TEST_FIRST (bool): Tests the access to the SBB-API (once per session)
+        GTFS_PATH (str): folder of the GTFS feed (MEANS = 'gtfs'), by default the sample in data/gtfs_sample
+        GTFS_ARRIVE_BY (str): arrival time (HH:MM) at the destination on the next monday (MEANS = 'gtfs')
+        GTFS_MAX_WALK (float): max. walking distance (meters) to/from a stop (MEANS = 'gtfs')
+        OSM_PATH (str): OSM extract (.osm) or saved street graph (.npz) for MEANS = 'bike' or 'walk'
+        OSM_SPEED (float): speed in km/h on the street network (None: 15 km/h by bike, 4 km/h walking)
+        AREAS_OF_INTEREST (str / dict / list): if given, only listings within these areas are considered (see SpatialFilter)
+        COMMUTE_CACHE (str): path to the persistent cache of the commuting times, a SQLite file, e.g. 
+            'commuteCache.sqlite' (None: no cache, see CommuteCache)
+        CACHE_CELL_SIZE (float): listings within a grid cell of this size (meters) share the cached commuting times
+        CACHE_TTL (float): time to live of the cached commuting times in seconds
+        MAX_REQUESTS_PER_SECOND (float): rate limit for the requests to the SBB-API (None: no limit)
+        MAX_RETRIES (int): retries of requests to the SBB-API failing with 429 (Retry-After respected), 5xx or timeouts
+        TRANSPORT_URL (str): URL of the SBB-API, e.g. of a local MockTransportServer (see transportClient.py)
+        CLUSTER_CELL (float): side length (meters) of square grid cells, listings within a cell share one query, adding the 
+            walking time to the representative of the cell (0: no clustering). The loss of accuracy (walking 
+            offsets) is reported in CLUSTER_REPORT.
+        MAX_COMMUTE_MINUTES (float / list): commuting budget, scalar or one per destination (None: no budget). A 
+            destination a listing cannot reach within the budget even at MAX_NETWORK_SPEED (air distance) is not 
+            routed and gets NaN as commuting time (OUT_OF_BUDGET: listings x destinations). Listings out of the 
+            budget of all destinations are not routed at all and marked in the column commute_pruned.
+        MAX_NETWORK_SPEED (float / list): max. effective speed in km/h along the air line, scalar or one per 
+            destination (None: 120 km/h for public transportation, OSM_SPEED or 15/4 km/h by bike/walking)
+        COMMUTE_STORE (str): directory to persist the statistics of the commuting times (listings x destinations x 
+            slots x min/mean/p90/transfers) as memory-mapped array (None: not persisted, see CommuteMatrixStore). 
+            The statistics are kept in COMMUTE_STATS in any case.
+        DEPARTURE_WINDOW (tuple): first and last departure (HH:MM) on the next monday, e.g. ('07:00', '09:00'), 
+            sampled every DEPARTURE_STEP minutes (SBB-API). With more than one departure, the median and the 
+            90th percentile over all connections in the window are added (median_sbb_N, p90_sbb_N).
+        DEPARTURE_STEP (int): minutes between the sampled departures
         
     Returns:
         pd.DataFrame with columns address, avg. commuting time in minutes. If DESTINATION contains more 
-            than one entry, the results are successively enumerated (mins_sbb_1, mins_sbb_2,...)
+            than one entry, the results are successively enumerated (mins_sbb_1, mins_sbb_2,... or 
+            mins_gtfs_N, mins_bike_N, mins_walk_N for the other MEANS)
     """
     
     DATA = pd.DataFrame(data=None)
@@ -1084,6 +1594,25 @@ class CommutingTimes(Geocoding):
     MEANS = 'public_transportation'
     WALKING_DISTANCE = 650
     TEST_FIRST = True
+    GTFS_PATH = None
+    GTFS_ARRIVE_BY = '08:30'
+    GTFS_MAX_WALK = 1000
+    OSM_PATH = 'streets.osm'
+    OSM_SPEED = None
+    AREAS_OF_INTEREST = None
+    COMMUTE_CACHE = None
+    CACHE_CELL_SIZE = 50
+    CACHE_TTL = 7*24*3600
+    MAX_REQUESTS_PER_SECOND = None
+    MAX_RETRIES = 4
+    TRANSPORT_URL = 'http://transport.opendata.ch/v1'
+    CLUSTER_CELL = 0
+    MAX_COMMUTE_MINUTES = None
+    MAX_NETWORK_SPEED = None
+    COMMUTE_STORE = None
+    DEPARTURE_WINDOW = ('08:00', '08:00')
+    DEPARTURE_STEP = 15
+    _API_TESTED = {}
     
     def __init__(self):
         if self.MAX_WORKERS < 1:
@@ -1096,10 +1625,10 @@ class CommutingTimes(Geocoding):
             dataCond3a = 'address' in self.DATA.columns
             dataCond3b = 'lat' in self.DATA.columns
             dataCond3c = 'lon' in self.DATA.columns
-            if all([dataCond3a,dataCond3b,dataCond3c]) == True:
-                dataCond3 = True
-            else:
+            if dataCond3a == False:
                 print("Enter DATA accordingly.")
+            elif not all([dataCond3b,dataCond3c]) or self.DATA[['lat','lon']].isna().any().any():
+                self.DATA = self.__geocodeMissing(self.DATA)
         
         if any([dataCond1,dataCond2]):
             #getGeocoding = self.Geocoding()
@@ -1111,7 +1640,9 @@ class CommutingTimes(Geocoding):
         assert 'lat' in self.DATA.columns
         assert 'lon' in self.DATA.columns
         assert 'address' in self.DATA.columns
-        assert 'public' in self.MEANS.lower()
+        assert ('public' in self.MEANS.lower()) or (self.MEANS.lower() in ['gtfs', 'bike', 'walk'])
+        
+        self.__filterAreas()
         
         if not isinstance(self.DESTINATION,list):
             return "Enter DESTINATION accordingly"
@@ -1143,100 +1674,424 @@ class CommutingTimes(Geocoding):
             self.DESTINATION_LENGTH = len(DESTINATION)      
             self.DESTINATION_DF = pd.DataFrame({'title':['Destination {}'.format(i) for i in range(len(streets))], 'address':streets, 'lat':lats, 'lon':lons})
         
+    def __filterAreas(self):
+        if self.AREAS_OF_INTEREST is not None:
+            class AreasOfInterest(SpatialFilter):
+                DATA = self.DATA
+                AREAS = self.AREAS_OF_INTEREST
+            self.DATA = AreasOfInterest().filter()
+            
+            
+    def forData(self, dataframe):
+        """ 
+        Returns a copy of this instance (destinations resolved already) for other, geocoded listings, 
+        e.g. a batch of the Pipeline. The copies can run getCommutingTimes() concurrently.
+        """
+        commuting = copy.copy(self)
+        commuting.DATA = dataframe.reset_index(drop=True)
+        commuting.__filterAreas()
+        return commuting
+    
+    
+    def __geocodeMissing(self, dataframe):
+        """ Geocodes the addresses of a pd.DataFrame (e.g. from the Scraper) lacking valid coordinates """
+        data = dataframe.copy()
+        self.DATA = data
+        Geocoding.__init__(self)
+        
+        geocoded = self.geocode()[['address','lat','lon']]
+        data = data.drop(labels=[col for col in ['lat','lon'] if col in data.columns], axis=1)
+        data = data.merge(geocoded, on='address', how='left')
+        
+        notLocated = data[['lat','lon']].isna().any(axis=1)
+        if notLocated.any():
+            print("{} entries could not be geocoded and are omitted.".format(notLocated.sum()))
+        return data[~notLocated].reset_index(drop=True)
+    
+    
     def getCommutingTimes(self):
-        """ Gets commuting time. Currently only for public transportation. """
+        """ Gets commuting time. Currently only for public transportation (SBB-API or GTFS). """
+        
+        # air distances for all listings x destinations, decided upfront (e.g. walking)
+        self.AIR_DISTANCES = haversineMatrix(self.DATA[['lat','lon']].astype(float).to_numpy(), self.DESTINATION)
+        
+        # pairs out of the commuting budget are not routed, nor listings out of the budget of all destinations 
+        # (ROUTED: listings to route)
+        self.OUT_OF_BUDGET = np.zeros((len(self.DATA), self.DESTINATION_LENGTH), dtype=bool)
+        if self.MAX_COMMUTE_MINUTES is not None:
+            self.OUT_OF_BUDGET = self.__prune()
+        self.ROUTED = ~self.OUT_OF_BUDGET.all(axis=1) if self.DESTINATION_LENGTH > 0 else np.ones(len(self.DATA), dtype=bool)
+        if self.MAX_COMMUTE_MINUTES is not None:
+            self.DATA['commute_pruned'] = ~self.ROUTED
+            print("Commuting budget: {} of {} listings and {} of {} listing-destination pairs pruned before routing.".format(
+                  (~self.ROUTED).sum(), len(self.ROUTED), self.OUT_OF_BUDGET.sum(), self.OUT_OF_BUDGET.size))
+        
+        if self.MEANS.lower() == 'gtfs':
+            self.SLOTS = ['Mon' + self.GTFS_ARRIVE_BY]
+            self.COMMUTE_MATRIX = self.__allListings(self.__commute_byGTFS())
+            for destNo in range(self.DESTINATION_LENGTH):
+                self.DATA['mins_gtfs_{}'.format(destNo+1)] = self.COMMUTE_MATRIX[:,destNo]
+            return self.DATA
+        
+        if self.MEANS.lower() in ['bike', 'walk']:
+            self.SLOTS = ['any']
+            self.COMMUTE_MATRIX = self.__allListings(self.__commute_byStreet())
+            for destNo in range(self.DESTINATION_LENGTH):
+                self.DATA['mins_{}_{}'.format(self.MEANS.lower(), destNo+1)] = self.COMMUTE_MATRIX[:,destNo]
+            return self.DATA
         
         if self.TEST_FIRST == True:
             test = self.test()
             if test == False:
                 return
-
-        for self.destNo in range(self.DESTINATION_LENGTH):
-            if 'public' in self.MEANS.lower():
-                commute = self.__commute_byTrain()
-                self.DATA = self.DATA.merge(commute, on='address')
+        
+        # listings close to each other share one query (see clusterOrigins)
+        latlons = self.DATA.loc[self.ROUTED, ['lat','lon']].astype(float).to_numpy()
+        self.CLUSTERS, distances = clusterOrigins(latlons, self.CLUSTER_CELL)
+        self.CLUSTER_OFFSETS = distances / 4000 * 60
+        if self.CLUSTER_CELL > 0:
+            self.CLUSTER_REPORT = {'listings': len(latlons), 
+                                   'clusters': len(np.unique(self.CLUSTERS)),
+                                   'offset_mean_minutes': np.mean(self.CLUSTER_OFFSETS) if len(latlons) else 0,
+                                   'offset_max_minutes': np.max(self.CLUSTER_OFFSETS) if len(latlons) else 0}
+            print("Origin clustering: {listings} listings, {clusters} clusters, walking offset mean {offset_mean_minutes:.1f} min., max {offset_max_minutes:.1f} min.".format(**self.CLUSTER_REPORT))
+        
+        self.CACHE = None
+        if self.COMMUTE_CACHE:
+            class Cache(CommuteCache):
+                PATH = self.COMMUTE_CACHE
+                CELL_SIZE = self.CACHE_CELL_SIZE
+                TTL = self.CACHE_TTL
+            self.CACHE = Cache()
+        
+        if 'public' in self.MEANS.lower():
+            start, end = [datetime.strptime(t, '%H:%M') for t in self.DEPARTURE_WINDOW]
+            self.SLOTS = ['Mon' + t for t in pd.date_range(start, end, freq='{}min'.format(self.DEPARTURE_STEP)).strftime('%H:%M')]
+            self.COMMUTE_MATRIX = self.__allListings(self.__commute_byTrain())
+            for destNo in range(self.DESTINATION_LENGTH):
+                mins = self.COMMUTE_MATRIX[:,destNo]
+                self.DATA['mins_sbb_{}'.format(destNo+1)] = mins.astype(np.int32) if np.isfinite(mins).all() else mins
+            if len(self.SLOTS) > 1:
+                windowStats = np.full((len(self.ROUTED), self.DESTINATION_LENGTH, 2), np.nan)
+                windowStats[self.ROUTED] = self.WINDOW_STATS
+                windowStats[self.OUT_OF_BUDGET] = np.nan
+                for destNo in range(self.DESTINATION_LENGTH):
+                    self.DATA['median_sbb_{}'.format(destNo+1)] = windowStats[:,destNo,0]
+                    self.DATA['p90_sbb_{}'.format(destNo+1)] = windowStats[:,destNo,1]
+                
+        if self.CACHE is not None:
+            print("Commute cache: {} hits, {} requests.".format(self.CACHE.hits, self.CACHE.misses))
+            self.CACHE.close()
         return self.DATA
         
     
+    def __prune(self):
+        """ 
+        Lower bound of the commuting times from the air distances and MAX_NETWORK_SPEED (vectorized).
+        
+        Returns np.array (listings x destinations) of bool, True if the destination cannot be reached within MAX_COMMUTE_MINUTES.
+        """
+        speed = self.MAX_NETWORK_SPEED
+        if speed is None:
+            if self.MEANS.lower() == 'bike':
+                speed = self.OSM_SPEED or 15
+            elif self.MEANS.lower() == 'walk':
+                speed = self.OSM_SPEED or 4
+            else:
+                speed = 120
+        
+        speed = np.broadcast_to(np.asarray(speed, dtype=float), (self.DESTINATION_LENGTH,))
+        budget = np.broadcast_to(np.asarray(self.MAX_COMMUTE_MINUTES, dtype=float), (self.DESTINATION_LENGTH,))
+        lowerBound = self.AIR_DISTANCES / (speed * 1000 / 60) # minutes
+        return lowerBound > budget
+    
+    
+    def __allListings(self, commuteStats):
+        """ 
+        Expands the commuting times of the routed listings to all listings (NaN for pruned listings and pairs 
+        out of the budget), keeps them as COMMUTE_STATS (and in the CommuteMatrixStore at COMMUTE_STORE).
+        
+        Returns np.array (listings x destinations), the mean commuting time (over the slots).
+        """
+        self.COMMUTE_STATS = np.full((len(self.ROUTED),) + commuteStats.shape[1:], np.nan)
+        self.COMMUTE_STATS[self.ROUTED] = commuteStats
+        self.COMMUTE_STATS[self.OUT_OF_BUDGET] = np.nan
+        
+        if self.COMMUTE_STORE:
+            listings = pd.DataFrame({'key': self.DATA['url'] if 'url' in self.DATA.columns else self.DATA['address'],
+                                     'lat': self.DATA['lat'], 'lon': self.DATA['lon']})
+            class Store(CommuteMatrixStore):
+                PATH = self.COMMUTE_STORE
+            self.STORE = Store(listings, self.DESTINATION, self.SLOTS)
+            self.STORE.MATRIX[:] = self.COMMUTE_STATS
+            self.STORE.flush()
+        
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', category=RuntimeWarning) # all NaN
+            return np.nanmean(self.COMMUTE_STATS[:, :, :, CommuteMatrixStore.STATS.index('mean')], axis=2)
+    
+    
     def test(self):
-        """ Tests, if the SBB-API is useable. """
-        testURL = 'http://transport.opendata.ch/v1/connections?from=47.3799622+8.5281334&to=47.378294+8.5275268&datetime='
-        r = requests.get(testURL)
-        Res = json.loads(r.text)
+        """ Tests, if the SBB-API is useable (once per session and TRANSPORT_URL). """
+        if self.TRANSPORT_URL in CommutingTimes._API_TESTED:
+            return CommutingTimes._API_TESTED[self.TRANSPORT_URL]
         
+        testURL = self.TRANSPORT_URL+'/connections?from=47.3799622+8.5281334&to=47.378294+8.5275268&datetime='
         try:
-            resultat = Res['connections']
+            r = requests.get(testURL, timeout=30)
+            Res = json.loads(r.text)
+        except (requests.exceptions.RequestException, ValueError) as e:
+            print(e)
+            return False
+        
+        if 'connections' in Res:
+            CommutingTimes._API_TESTED[self.TRANSPORT_URL] = True
             return True
-        except KeyError:
+        try:
             print(Res['errors'][0]['message'])
-            return False
+        except (KeyError, IndexError):
+            print(Res)
         return False
     
     
+    def __commute_byGTFS(self):
+        """ 
+        Gets the commuting times from a GTFS feed (offline), one search per destination.
+        
+        Returns np.array (listings x destinations x slots x stats) with the commuting time in minutes (NaN if not reachable).
+        """
+        from gtfsRouting import GTFSTimetable
+        
+        today = date.today()
+        nextMonday = today + timedelta(days=-today.weekday(), weeks=1)
+        hours, minutes = self.GTFS_ARRIVE_BY.split(':')
+        arriveBy = int(hours)*3600 + int(minutes)*60
+        
+        class Timetable(GTFSTimetable):
+            SERVICE_DATE = nextMonday
+        if self.GTFS_PATH:
+            Timetable.PATH = self.GTFS_PATH
+        timetable = Timetable()
+        
+        latlons = self.DATA.loc[self.ROUTED, ['lat','lon']].astype(float).to_numpy()
+        airDistances = self.AIR_DISTANCES[self.ROUTED]
+        walking = airDistances <= self.WALKING_DISTANCE
+        
+        commuteStats = np.full((len(latlons), self.DESTINATION_LENGTH, 1, len(CommuteMatrixStore.STATS)), np.nan)
+        for destNo in range(self.DESTINATION_LENGTH):
+            minutes, trips = timetable.travelTimes(latlons, self.DESTINATION[destNo], arriveBy, self.GTFS_MAX_WALK)
+            minutes[walking[:,destNo]] = np.ceil(airDistances[walking[:,destNo],destNo] / 4000 * 60)
+            transfers = np.where(walking[:,destNo], 0, np.maximum(trips - 1, 0)).astype(float)
+            transfers[~np.isfinite(minutes)] = np.nan
+            commuteStats[:,destNo,0,:3] = np.round(minutes)[:,None] # one journey: min = mean = p90
+            commuteStats[:,destNo,0,3] = transfers
+        return commuteStats
+    
+    
+    def __commute_byStreet(self):
+        """ 
+        Gets the commuting times by bike or by foot on the street network (offline), one search per destination.
+        
+        Returns np.array (listings x destinations x slots x stats) with the commuting time in minutes (NaN if not reachable).
+        """
+        from streetRouting import StreetGraph
+        
+        class Streets(StreetGraph):
+            PATH = self.OSM_PATH
+            MEANS = self.MEANS.lower()
+            SPEED = self.OSM_SPEED
+        streets = Streets()
+        
+        latlons = self.DATA.loc[self.ROUTED, ['lat','lon']].astype(float).to_numpy()
+        commuteStats = np.full((len(latlons), self.DESTINATION_LENGTH, 1, len(CommuteMatrixStore.STATS)), np.nan)
+        for destNo in range(self.DESTINATION_LENGTH):
+            minutes = np.round(streets.travelTimes(latlons, self.DESTINATION[destNo]))
+            commuteStats[:,destNo,0,:3] = minutes[:,None]
+            commuteStats[:,destNo,0,3] = np.where(np.isfinite(minutes), 0, np.nan)
+        return commuteStats
+    
+    
     def __commute_byTrain(self):
-        """ get commuting time using SBB-API """
-        def __commuteTimes(row):
-            sbbResults = []#
+        """ 
+        Gets the commuting times using the SBB-API, for each departure slot (see DEPARTURE_WINDOW). All 
+        pairs of listings x destinations x slots are fetched at once by the async TransportClient (sharing 
+        MAX_WORKERS and MAX_REQUESTS_PER_SECOND). Failed queries (e.g. rate limit exceeded after all 
+        retries) result in NaN. The durations of all connections are parsed in one pass.
+        
+        Returns np.array (listings x destinations x slots x stats) with the statistics over the connections 
+        (see CommuteMatrixStore.STATS), the commuting times in minutes. The median and the 90th percentile 
+        over all connections in the departure window are kept in WINDOW_STATS (listings x destinations x 2).
+        """
+        from transportClient import TransportClient
+        
+        today = date.today()
+        nextMonday = today + timedelta(days=-today.weekday(), weeks=1)
+        departures = [nextMonday.strftime("%Y-%m-%d")+"T"+slot[3:] for slot in self.SLOTS]
+        
+        latlons = self.DATA.loc[self.ROUTED, ['lat','lon']].astype(float).to_numpy()
+        airDistances = self.AIR_DISTANCES[self.ROUTED]
+        walking = airDistances <= self.WALKING_DISTANCE
+        
+        # one query per cluster of origins (representative), destination and slot, members add the walking time;
+        # not for destinations out of the budget of all members
+        reps = np.unique(self.CLUSTERS)
+        inBudget = np.zeros((len(latlons), self.DESTINATION_LENGTH), dtype=bool)
+        np.logical_or.at(inBudget, self.CLUSTERS, ~self.OUT_OF_BUDGET[self.ROUTED])
+        queries = {}
+        for destNo in range(self.DESTINATION_LENGTH):
+            for rep in reps[~walking[reps,destNo] & inBudget[reps,destNo]]:
+                for slotNo in range(len(self.SLOTS)):
+                    queries[(rep,destNo,slotNo)] = None
+        
+        keys = {}
+        if self.CACHE is not None:
+            for (rep,destNo,slotNo) in queries:
+                keys[(rep,destNo,slotNo)] = self.CACHE.key(latlons[rep][0], latlons[rep][1], self.DESTINATION[destNo], 'public_transportation', self.SLOTS[slotNo])
+                queries[(rep,destNo,slotNo)] = self.CACHE.get(keys[(rep,destNo,slotNo)])
+        
+        class Client(TransportClient):
+            BASE_URL = self.TRANSPORT_URL
+            MAX_CONCURRENCY = self.MAX_WORKERS
+            REQUESTS_PER_SECOND = self.MAX_REQUESTS_PER_SECOND
+            MAX_RETRIES = self.MAX_RETRIES
+        client = Client()
+        
+        misses = [query for query,Res in queries.items() if Res is None]
+        responses = client.connections([(latlons[rep], self.DESTINATION[destNo], departures[slotNo]) for (rep,destNo,slotNo) in misses])
+        for query, Res in zip(misses, responses):
+            if 'error' in Res:
+                queries[query] = Res
+                continue
+            Res = {'connections': [{'duration': c['duration'], 'transfers': c.get('transfers')} for c in Res['connections']]}
+            queries[query] = Res
+            if self.CACHE is not None:
+                self.CACHE.put(keys[query], Res)
+                
+        self.TRANSPORT_STATS = client.STATS
+        if client.STATS['failures'] > 0:
+            errors = pd.Series([Res['error'] for Res in queries.values() if 'error' in Res]).value_counts()
+            print("{} of {} queries to the SBB-API failed:\n{}".format(client.STATS['failures'], len(misses), errors.head()))
+        
+        # all connections as one table, parsed and aggregated at once
+        owners = [query for query,Res in queries.items() for c in Res['connections']]
+        connections = pd.DataFrame(owners, columns=['rep','destNo','slotNo'], dtype=np.int64)
+        connections['minutes'] = parseDurations([c['duration'] for Res in queries.values() for c in Res['connections']])
+        connections['transfers'] = pd.to_numeric(pd.Series([c.get('transfers') for Res in queries.values() for c in Res['connections']], dtype=object), errors='coerce').to_numpy(dtype=float)
+        connections = connections[connections.minutes.notna()]
+        
+        bySlot = connections.groupby(['rep','destNo','slotNo'])
+        perSlot = pd.DataFrame({'min': bySlot.minutes.min(), 'mean': bySlot.minutes.mean(), 
+                                'p90': bySlot.minutes.quantile(0.9), 'transfers': bySlot.transfers.mean()})
+        byWindow = connections.groupby(['rep','destNo'])
+        perWindow = pd.DataFrame({'median': byWindow.minutes.median(), 'p90': byWindow.minutes.quantile(0.9)})
+        
+        repStats = np.full((len(latlons), self.DESTINATION_LENGTH, len(self.SLOTS), len(CommuteMatrixStore.STATS)), np.nan)
+        repWindow = np.full((len(latlons), self.DESTINATION_LENGTH, 2), np.nan)
+        if len(perSlot) > 0:
+            repStats[tuple(perSlot.index.to_frame().to_numpy(dtype=np.int64).T)] = perSlot[CommuteMatrixStore.STATS].to_numpy()
+            repWindow[tuple(perWindow.index.to_frame().to_numpy(dtype=np.int64).T)] = perWindow.to_numpy()
+        
+        # listings: statistics of their representative plus the walking offset, or walking only
+        offsets = np.asarray(self.CLUSTER_OFFSETS, dtype=float)
+        commuteStats = repStats[self.CLUSTERS]
+        commuteStats[..., :3] += offsets[:,None,None,None]
+        windowStats = repWindow[self.CLUSTERS] + offsets[:,None,None]
+        
+        walkingMinutes = np.ceil(airDistances / 4000 * 60)
+        repWalking = walking[self.CLUSTERS] & ~walking
+        walkingMinutes[repWalking] = (walkingMinutes[self.CLUSTERS] + offsets[:,None])[repWalking]
+        walkingAny = walking | repWalking
+        commuteStats[walkingAny, :, :3] = walkingMinutes[walkingAny][:,None,None]
+        commuteStats[walkingAny, :, 3] = 0
+        windowStats[walkingAny] = walkingMinutes[walkingAny][:,None]
+        
+        commuteStats[..., :3] = np.floor(commuteStats[..., :3])
+        self.WINDOW_STATS = np.floor(windowStats)
+        return commuteStats
+        
+    
 
-            address = row['address']
-            lat = float(row['lat'])
-            lon = float(row['lon'])
-            
-            destLat = self.DESTINATION[self.destNo][0]
-            destLon = self.DESTINATION[self.destNo][1]
-            
-            today = date.today()
-            nextMonday = today + timedelta(days=-today.weekday(), weeks=1)
-            startCommute = nextMonday.strftime("%Y-%m-%d")+"T08%3A00"
-            
-            
-            airDistance = haversine((lat,lon),(destLat,destLon))
-            
-            if airDistance <= self.WALKING_DISTANCE:
-                timeWalking = airDistance / 4000 * 60
-                Res = json.loads('{"connections":[{"duration":'+str(np.ceil(timeWalking))+'}]}')
-                sbbResults.append([address, Res])
+##################################################################################
+#
+# Module 4: Spatial filter
+#
+##################################################################################
+
+class SpatialFilter:
+    """
+    Filters the (geocoded) listings by areas of interest, e.g. neighbourhoods, isochrones or a 
+    strip along the lake. Keeps only the listings within (or on the boundary of) at least one of 
+    the polygons. Best used before the CommutingTimes, to spend the queries on relevant listings.
     
-            else:
-                getURL = 'http://transport.opendata.ch/v1/connections?from='+str(lat)+'+'+str(lon)+'&to='+str(destLat)+'+'+str(destLon)+'&datetime='+startCommute 
-                r = requests.get(getURL)
-                Res = json.loads(r.text)  
-                sbbResults.append([address, Res])
-            return sbbResults
+    The polygons are indexed with a STRtree and tested as prepared geometries; with Shapely >= 2.0
+    the whole set of points is queried at once (vectorized).
+    
+    Parameters:
+        DATA (pd.DataFrame): containing columns lat and lon
+        AREAS (str / dict / list): path to a GeoJSON file (with or without 'var xyz = ' as written by 
+            df2GeoJSON), a GeoJSON dict (FeatureCollection, Feature or geometry), a shapely geometry 
+            or a list of those
         
-        sbbResults = []
-        with concurrent.futures.ThreadPoolExecutor(max_workers=self.MAX_WORKERS) as executor:
-            for i,row in self.DATA.iterrows():
-                sbb = executor.submit(__commuteTimes, row)
-                sbbResults.append(sbb)
+    Returns:
+        pd.DataFrame with the listings inside the areas, the column 'area' contains the name (property 
+            'name' or 'title', else the number) of the first area the listing is in
+    """
+    
+    DATA = pd.DataFrame(data=None)
+    AREAS = []
+    
+    def __init__(self):
+        self.POLYGONS, self.NAMES = loadAreas(self.AREAS)
+        assert len(self.POLYGONS) > 0, "Enter AREAS accordingly."
         
-        sbbResults = [sbbRes.result()[0] for sbbRes in sbbResults]
         
-        avgMinutes = []
-        addresses = []
+    def filter(self):
+        lat = pd.to_numeric(self.DATA['lat'], errors='coerce').to_numpy(dtype=float)
+        lon = pd.to_numeric(self.DATA['lon'], errors='coerce').to_numpy(dtype=float)
+        valid = np.isfinite(lat) & np.isfinite(lon)
         
-        for i,result in enumerate(sbbResults):
-            adr = result[0]
-            res = result[1]
-            mins = []
-            for connection in res['connections']:
-                if len(connection) == 1:
-                    mins.append(np.int32(connection['duration']))
-                    
-                else:
-                    h = connection['duration'][3:]
-                    delta = timedelta(hours=float(h.split(':')[0]), minutes=float(h.split(':')[1]), seconds=float(h.split(':')[2]))
-                    minutes = delta.total_seconds()/60
-                    mins.append(minutes)                    
-            avgMinute = np.int32(np.nanmean(mins))
-            avgMinutes.append(avgMinute)
-            addresses.append(adr)
+        areaNo = np.full(len(lat), -1)
+        if _vectorizedShapely():
+            pointIdx, polygonIdx = self.__query_vectorized(lat[valid], lon[valid])
+        else:
+            pointIdx, polygonIdx = self.__query_prepared(lat[valid], lon[valid])
+        
+        # first area per point: write in reversed order, so that the lowest polygon number remains
+        validIdx = np.flatnonzero(valid)
+        order = np.argsort(-polygonIdx, kind='stable')
+        areaNo[validIdx[pointIdx[order]]] = polygonIdx[order]
+        
+        inside = areaNo >= 0
+        filtered = self.DATA[inside].copy()
+        filtered['area'] = [self.NAMES[i] for i in areaNo[inside]]
+        print("{} of {} entries within the areas of interest.".format(inside.sum(), len(self.DATA)))
+        return filtered.reset_index(drop=True)
+    
+    
+    def __query_vectorized(self, lat, lon):
+        """ Shapely >= 2.0: bulk query of all points against the STRtree of the polygons """
+        tree = STRtree(self.POLYGONS)
+        pointIdx, polygonIdx = tree.query(shapelyPoints(lon, lat), predicate='intersects')
+        return pointIdx, polygonIdx
     
-        commuteTimes = pd.DataFrame({'address':addresses, 'mins_sbb_{}'.format(self.destNo+1):avgMinutes})
-        return commuteTimes
+    
+    def __query_prepared(self, lat, lon):
+        """ Shapely < 2.0: STRtree of the points, candidates tested against the prepared polygons """
+        points = [Point(xy) for xy in zip(lon, lat)]
+        pointNo = {id(point): i for i,point in enumerate(points)}
+        tree = STRtree(points)
         
+        pointIdx = []
+        polygonIdx = []
+        for i,polygon in enumerate(self.POLYGONS):
+            prepared = prep(polygon)
+            for candidate in tree.query(polygon):
+                if prepared.intersects(candidate):
+                    pointIdx.append(pointNo[id(candidate)])
+                    polygonIdx.append(i)
+        return np.array(pointIdx, dtype=int), np.array(polygonIdx, dtype=int)
+    
     
-
 ##################################################################################
 #
 # Functions A: Prepare for display
@@ -1244,10 +2099,10 @@ class CommutingTimes(Geocoding):
 ##################################################################################
 
 
-def df2GeoJSON(dataframe, outpath, varname='dataset', avgMinutesCol='mins_sbb_1'):
+def df2GeoJSON(dataframe, outpath, varname='dataset', avgMinutesCol='mins_sbb_1', compress=False):
     """
     Writes the pd.DataFrame to the hard disk as a GeoJSON file, later to be used
-    to be displayed (e.g. GIS or HTML/Leaflet).
+    to be displayed (e.g. GIS or HTML/Leaflet). Streams the features to the file (see writeGeoJSON).
 
     Parameters
     ----------
@@ -1259,32 +2114,201 @@ def df2GeoJSON(dataframe, outpath, varname='dataset', avgMinutesCol='mins_sbb_1'
         Column to be displayed as commute time (on the website). The default is 'mins_sbb_1'.
     varname : str, optional
         Variable name (if used on a website). The default is 'dataset'.
+    compress : bool, optional
+        Writes a gzipped file (.geojson.gz). The default is False.
 
     Returns
     -------
     None.
 
     """
-    lons = dataframe.lon.tolist()
-    lon = [float(lon) for lon in lons]
-    lats = dataframe.lat.tolist()
-    lat = [float(lat) for lat in lats]
-    
-    geometry = [Point(xy) for xy in zip(lon,lat)] # Achtung, lon lat
-    gdf = gpd.GeoDataFrame(dataframe,geometry=geometry,crs=4326)
     if avgMinutesCol:
-        gdf['avgMinutes'] = dataframe[avgMinutesCol]
-    
-    geojson = gdf.to_json()
-    if varname:
-        geojson = 'var '+varname+' = '+geojson
-    gdf_output = correctUmlauts(geojson)
+        dataframe = dataframe.assign(avgMinutes=dataframe[avgMinutesCol])
     
     if not outpath.endswith('.geojson'):
         outpath += '.geojson'
     
-    with open(outpath, 'w') as file:
-        file.write(gdf_output)
+    writeGeoJSON(dataframe, outpath, varname=varname, compress=compress)
+    
+    
+def writeGeoJSON(dataframe, outpath, varname=None, compress=False, chunkSize=20000, callback=None):
+    """
+    Streams a pd.DataFrame with the columns lat/lon as GeoJSON (points) to a file, chunk by chunk: the 
+    properties are serialized by pandas straight from the columns, no geometries are built and the 
+    whole file is never held in memory.
+
+    Parameters
+    ----------
+    dataframe : pd.DataFrame
+        with the columns lat, lon; all columns (but geometry) are written as properties, the index as id.
+    outpath : str
+        path of the file ('.gz' is appended if compress and missing).
+    varname : str, optional
+        if given, the GeoJSON is assigned to a JavaScript variable (var varname = ...). The default is None.
+    compress : bool, optional
+        gzip the file. The default is False.
+    chunkSize : int, optional
+        rows serialized at once. The default is 20000.
+    callback : str, optional
+        if given, the GeoJSON is passed to this JavaScript function (callback({...});), e.g. to load 
+        files with script tags on demand. The default is None.
+
+    Returns
+    -------
+    str, path of the file.
+
+    """
+    properties = dataframe.drop(labels=[col for col in ['geometry'] if col in dataframe.columns], axis=1)
+    
+    if compress:
+        if not outpath.endswith('.gz'):
+            outpath += '.gz'
+        file = gzip.open(outpath, 'wt', encoding='utf-8')
+    else:
+        file = open(outpath, 'w', encoding='utf-8')
+    
+    with file:
+        if varname:
+            file.write('var '+varname+' = ')
+        if callback:
+            file.write(callback+'(')
+        file.write('{"type": "FeatureCollection", "features": [')
+        
+        for start in range(0, len(properties), chunkSize):
+            features = geoJSONFeatures(properties.iloc[start:start+chunkSize])
+            if start > 0:
+                file.write(', ')
+            file.write(', '.join(features))
+            
+        file.write(']}')
+        if callback:
+            file.write(');')
+    return outpath
+
+
+def geoJSONFeatures(dataframe):
+    """
+    GeoJSON features (points) of the rows of a pd.DataFrame with the columns lat/lon, serialized
+    by pandas straight from the columns. All columns (but geometry) are properties, the index is the id.
+
+    Returns
+    -------
+    list of str, one feature per row.
+
+    """
+    chunk = dataframe.drop(labels=[col for col in ['geometry'] if col in dataframe.columns], axis=1)
+    for col in chunk.columns[chunk.dtypes == object]:
+        chunk = chunk.assign(**{col: _correctUmlautsSeries(chunk[col])})
+    
+    lon = pd.to_numeric(dataframe['lon'], errors='coerce').to_numpy(dtype=float)
+    lat = pd.to_numeric(dataframe['lat'], errors='coerce').to_numpy(dtype=float)
+    props = chunk.to_json(orient='records', lines=True, date_format='iso').splitlines() if len(chunk) else []
+    ids = chunk.index.astype(str)
+    
+    # no coordinates (e.g. not geocoded): null geometry, as nan is neither valid JSON nor JS
+    located = np.isfinite(lon) & np.isfinite(lat)
+    geometries = ['{"type": "Point", "coordinates": ['+repr(x)+', '+repr(y)+']}' if ok else 'null'
+                  for x,y,ok in zip(lon.tolist(), lat.tolist(), located.tolist())]
+    return ['{"id": "'+i+'", "type": "Feature", "properties": '+p+', "geometry": '+g+'}'
+            for i,p,g in zip(ids, props, geometries)]
+
+
+def clusterTiles(dataframe, outdir='tiles', minZoom=0, maxZoom=14, radius=64, avgMinutesCol='mins_sbb_1'):
+    """
+    Precomputes clusters of the listings per zoom level and writes them as tiles (Web Mercator, 
+    256 px), to display large sets of listings (e.g. a whole canton) on ScrapedApartmentsMap.html, 
+    which loads only the tiles in view at the current zoom.
+    
+    The clusters are cells of a grid of about radius pixels, nested across the zoom levels (each 
+    cell splits in four on the next level), aggregated at once per level (vectorized). At maxZoom, 
+    the listings are written individually.
+    
+    Written files:
+        outdir/<z>/<x>/<y>.js : features of a tile, as clusterTile({...}); (see writeGeoJSON) with 
+            the properties _zoom and, for clusters, cluster, point_count, expansion_zoom and avgMinutes 
+            (the shortest commute within the cluster)
+        outdir/index.js : var clusterIndex = {minZoom, maxZoom, path, tiles: {"z/x/y": number of features}}
+
+    Parameters
+    ----------
+    dataframe : pd.DataFrame
+        listings with the columns lat, lon
+    outdir : str, optional
+        directory of the tiles (next to the html). The default is 'tiles'.
+    minZoom / maxZoom : int, optional
+        zoom levels of the tiles. The defaults are 0 and 14.
+    radius : int, optional
+        size of the clusters in pixels, rounded to 256/2^k. The default is 64.
+    avgMinutesCol : str, optional
+        column of the commuting times (avgMinutes, as in df2GeoJSON). The default is 'mins_sbb_1'.
+
+    Returns
+    -------
+    dict, number of tiles and features per zoom level.
+
+    """
+    data = dataframe.reset_index(drop=True)
+    if avgMinutesCol:
+        data = data.assign(avgMinutes=data[avgMinutesCol])
+    lat = pd.to_numeric(data['lat'], errors='coerce').to_numpy(dtype=float)
+    lon = pd.to_numeric(data['lon'], errors='coerce').to_numpy(dtype=float)
+    valid = np.isfinite(lat) & np.isfinite(lon)
+    data, lat, lon = data[valid].reset_index(drop=True), lat[valid], lon[valid]
+    minutes = pd.to_numeric(data['avgMinutes'], errors='coerce').to_numpy(dtype=float) if 'avgMinutes' in data.columns else np.full(len(data), np.nan)
+    
+    # Web Mercator in [0,1)
+    mx = np.clip((lon + 180) / 360, 0, 1 - 1e-12)
+    sinLat = np.clip(np.sin(np.deg2rad(lat)), -0.9999, 0.9999)
+    my = np.clip(0.5 - np.log((1 + sinLat) / (1 - sinLat)) / (4 * np.pi), 0, 1 - 1e-12)
+    cellsPerTile = 2 ** int(np.clip(np.round(np.log2(256 / radius)), 0, 8))
+    
+    index = {}
+    report = {}
+    for z in range(minZoom, maxZoom+1):
+        if z == maxZoom:
+            features = data.assign(_zoom=z)
+            tileX = np.floor(mx * 2**z).astype(np.int64)
+            tileY = np.floor(my * 2**z).astype(np.int64)
+        else:
+            nCells = 2**z * cellsPerTile
+            cells = pd.DataFrame({'cx': np.floor(mx * nCells).astype(np.int64), 'cy': np.floor(my * nCells).astype(np.int64),
+                                  'lat': lat, 'lon': lon, 'avgMinutes': minutes, 'row': np.arange(len(data))})
+            grouped = cells.groupby(['cx','cy'], sort=False)
+            clusters = grouped.agg(lat=('lat','mean'), lon=('lon','mean'), avgMinutes=('avgMinutes','min'),
+                                   point_count=('row','size'), row=('row','first')).reset_index()
+            
+            single = clusters.point_count == 1
+            singles = data.iloc[clusters.row[single].to_numpy()].assign(_zoom=z)
+            merged = clusters[~single].assign(cluster=True, expansion_zoom=z+1, _zoom=z)
+            features = pd.concat([singles, merged[['lat','lon','avgMinutes','point_count','cluster','expansion_zoom','_zoom']]], ignore_index=True)
+            features = features.astype({'point_count': 'Int64', 'expansion_zoom': 'Int64'})
+            
+            cellX = np.concatenate([clusters.cx[single].to_numpy(), merged.cx.to_numpy()])
+            cellY = np.concatenate([clusters.cy[single].to_numpy(), merged.cy.to_numpy()])
+            tileX, tileY = cellX // cellsPerTile, cellY // cellsPerTile
+        
+        tiles = pd.DataFrame({'x': tileX, 'y': tileY}).groupby(['x','y']).indices
+        for (x, y), rows in tiles.items():
+            os.makedirs(os.path.join(outdir, str(z), str(x)), exist_ok=True)
+            writeGeoJSON(features.iloc[rows].dropna(axis=1, how='all'), os.path.join(outdir, str(z), str(x), '{}.js'.format(y)), callback='clusterTile')
+            index['{}/{}/{}'.format(z, x, y)] = len(rows)
+        report[z] = {'tiles': len(tiles), 'features': len(features)}
+    
+    with open(os.path.join(outdir, 'index.js'), 'w') as file:
+        file.write('var clusterIndex = ' + json.dumps({'minZoom': minZoom, 'maxZoom': maxZoom, 
+                                                       'path': os.path.basename(os.path.normpath(outdir)), 'tiles': index}))
+    return report
+
+
+def _correctUmlautsSeries(series):
+    """ correctUmlauts() for the strings of a pd.Series (vectorized), other values are kept """
+    isString = series.map(type) == str
+    if not isString.any():
+        return series
+    corrected = series[isString]
+    for wrong, umlaut in {'Ã¶':'ö', 'Ã¼':'ü','Ã¤':'ä'}.items():
+        corrected = corrected.str.replace(wrong, umlaut, regex=False)
+    return series.where(~isString, corrected)
         
 
 def createDestinationGeoJSON(outputPath,addresses,titles= ['Destination'], comments=['']):
@@ -1294,28 +2318,194 @@ def createDestinationGeoJSON(outputPath,addresses,titles= ['Destination'], comme
     
     lats = []
     lons = []
-    geometries = []
     titlesOut = []
     
-    for i,address in addresses:
+    titles = (list(titles) * len(addresses))[:len(addresses)]
+    comments = (list(comments) * len(addresses))[:len(addresses)]
+    
+    for i,address in enumerate(addresses):
         lat,lon = geocode(address)
-        geometry = Point(lon,lat) # Achtung, it takes lon lat
         lats.append(lat)
         lons.append(lon)
-        geometries.append(geometry)
         titlesOut.append(titles[i]+"_"+str(i))
     
-    if len(comments) != len(addresses):
-        comments += comments * (len(addresses) - len(comments))
+    destination = pd.DataFrame({'address':addresses, 'title':titlesOut, 'comment':comments, 'lat':lats, 'lon':lons})
+    writeGeoJSON(destination, outputPath, varname='destAddress')
+    
+    
+def hilbertIndex(lat, lon, order=16, bounds=None):
+    """
+    Position of points on a Hilbert curve over their bounding box (vectorized), to sort them such 
+    that points close to each other are stored close to each other.
+
+    Parameters
+    ----------
+    lat, lon : array-like
+        coordinates in decimal degrees
+    order : int, optional
+        bits per axis (2^order x 2^order cells). The default is 16.
+    bounds : tuple, optional
+        (lat_min, lon_min, lat_max, lon_max) of the curve. The default is the bounding box of the points.
+
+    Returns
+    -------
+    np.array of int64.
+
+    """
+    lat = np.asarray(lat, dtype=float)
+    lon = np.asarray(lon, dtype=float)
+    if bounds is None:
+        bounds = (np.nanmin(lat), np.nanmin(lon), np.nanmax(lat), np.nanmax(lon)) if len(lat) else (0, 0, 1, 1)
+    latMin, lonMin, latMax, lonMax = bounds
+    
+    side = 2**order
+    x = np.clip((lon - lonMin) / max(lonMax - lonMin, 1e-12) * side, 0, side - 1)
+    y = np.clip((lat - latMin) / max(latMax - latMin, 1e-12) * side, 0, side - 1)
+    x = np.nan_to_num(x).astype(np.int64)
+    y = np.nan_to_num(y).astype(np.int64)
+    
+    d = np.zeros(len(x), dtype=np.int64)
+    s = side // 2
+    while s > 0:
+        rx = (x & s) > 0
+        ry = (y & s) > 0
+        d += s * s * ((3 * rx.astype(np.int64)) ^ ry.astype(np.int64))
+        # rotate the quadrant
+        flip = ~ry & rx
+        x = np.where(flip, side - 1 - x, x)
+        y = np.where(flip, side - 1 - y, y)
+        x, y = np.where(~ry, y, x), np.where(~ry, x, y)
+        s //= 2
+    return d
+
+
+def df2GeoParquet(dataframe, outpath, rowGroupSize=10000):
+    """
+    Writes the listings as GeoParquet (1.1, points as WKB), sorted along a Hilbert curve and with a 
+    bbox column (covering), so that each row group covers a small area. Readers can then skip the 
+    row groups outside of a bounding box by their statistics (see readGeoParquet, or GDAL/DuckDB).
+    Requires pyarrow.
+
+    Parameters
+    ----------
+    dataframe : pd.DataFrame
+        listings with the columns lat, lon
+    outpath : str
+        path of the .parquet file
+    rowGroupSize : int, optional
+        rows per row group. The default is 10000.
+
+    Returns
+    -------
+    None.
+
+    """
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    
+    lat = pd.to_numeric(dataframe['lat'], errors='coerce').to_numpy(dtype=float)
+    lon = pd.to_numeric(dataframe['lon'], errors='coerce').to_numpy(dtype=float)
+    valid = np.isfinite(lat) & np.isfinite(lon)
+    order = np.argsort(hilbertIndex(lat[valid], lon[valid]), kind='stable')
+    data = dataframe[valid].iloc[order].reset_index(drop=True)
+    lat, lon = lat[valid][order], lon[valid][order]
+    
+    # WKB of the points at once: byte order, type (1: point), x, y
+    wkb = np.zeros(len(data), dtype=np.dtype([('byteOrder','u1'), ('type','<u4'), ('x','<f8'), ('y','<f8')]))
+    wkb['byteOrder'] = 1
+    wkb['type'] = 1
+    wkb['x'] = lon
+    wkb['y'] = lat
+    offsets = np.arange(len(data)+1, dtype=np.int32) * wkb.dtype.itemsize
+    geometry = pa.BinaryArray.from_buffers(pa.binary(), len(data), [None, pa.py_buffer(offsets), pa.py_buffer(wkb.tobytes())])
+    bbox = pa.StructArray.from_arrays([pa.array(lon), pa.array(lat), pa.array(lon), pa.array(lat)], names=['xmin','ymin','xmax','ymax'])
+    
+    table = pa.Table.from_pandas(data.drop(labels=[col for col in ['geometry','bbox'] if col in data.columns], axis=1), preserve_index=False)
+    table = table.append_column('bbox', bbox).append_column('geometry', geometry)
+    
+    geo = {'version': '1.1.0', 'primary_column': 'geometry', 
+           'columns': {'geometry': {'encoding': 'WKB', 'geometry_types': ['Point'],
+                                    'bbox': [float(lon.min()), float(lat.min()), float(lon.max()), float(lat.max())] if len(data) else [],
+                                    'covering': {'bbox': {'xmin': ['bbox','xmin'], 'ymin': ['bbox','ymin'], 
+                                                          'xmax': ['bbox','xmax'], 'ymax': ['bbox','ymax']}}}}}
+    metadata = dict(table.schema.metadata or {})
+    metadata[b'geo'] = json.dumps(geo).encode()
+    pq.write_table(table.replace_schema_metadata(metadata), outpath, row_group_size=rowGroupSize)
+    
+    
+def readGeoParquet(path, bbox=None, columns=None):
+    """
+    Reads listings written by df2GeoParquet, only the row groups intersecting bbox (by their statistics).
+
+    Parameters
+    ----------
+    path : str
+        path of the .parquet file
+    bbox : tuple, optional
+        (lat_min, lon_min, lat_max, lon_max). The default is None (all).
+    columns : list, optional
+        columns to read (lat/lon are always read). The default is None (all but geometry and bbox).
+
+    Returns
+    -------
+    pd.DataFrame.
+
+    """
+    import pyarrow.parquet as pq
+    
+    parquet = pq.ParquetFile(path)
+    rowGroups = list(range(parquet.num_row_groups))
+    if bbox is not None:
+        latMin, lonMin, latMax, lonMax = bbox
+        paths = [parquet.schema.column(i).path for i in range(parquet.metadata.num_columns)]
+        position = {name: paths.index('bbox.' + name) for name in ['xmin','ymin','xmax','ymax']}
+        selected = []
+        for i in rowGroups:
+            stats = {name: parquet.metadata.row_group(i).column(col).statistics for name, col in position.items()}
+            if any(stat is None or not stat.has_min_max for stat in stats.values()):
+                selected.append(i)
+            elif (stats['xmin'].min <= lonMax and stats['xmax'].max >= lonMin and 
+                  stats['ymin'].min <= latMax and stats['ymax'].max >= latMin):
+                selected.append(i)
+        rowGroups = selected
+    
+    if columns is None:
+        columns = [name for name in parquet.schema_arrow.names if name not in ['geometry','bbox']]
+    else:
+        columns = list(dict.fromkeys(list(columns) + ['lat','lon']))
+    data = parquet.read_row_groups(rowGroups, columns=columns).to_pandas()
     
-    destgdf = gpd.GeoDataFrame({'address':addresses, 'title':titlesOut, 'comment':comments, 'geometry': geometries})
-    destgdf.to_file(outputPath, driver="GeoJSON")
-      
-    geojsoned = destgdf.to_json()
-    gdf = 'var destAddress='+geojsoned
-    with open(outputPath, 'w') as file:
-        file.write(gdf)
+    if bbox is not None:
+        inside = data.lat.between(latMin, latMax) & data.lon.between(lonMin, lonMax)
+        data = data[inside].reset_index(drop=True)
+    return data
+
+
+def df2FlatGeobuf(dataframe, outpath):
+    """
+    Writes the listings as FlatGeobuf with a packed Hilbert R-tree (spatial index), e.g. for QGIS or 
+    to read a bounding box with geopandas.read_file(outpath, bbox=(lon_min, lat_min, lon_max, lat_max)).
+
+    Parameters
+    ----------
+    dataframe : pd.DataFrame
+        listings with the columns lat, lon
+    outpath : str
+        path of the .fgb file
+
+    Returns
+    -------
+    None.
+
+    """
+    lat = pd.to_numeric(dataframe['lat'], errors='coerce')
+    lon = pd.to_numeric(dataframe['lon'], errors='coerce')
+    valid = (lat.notna() & lon.notna()).to_numpy()
+    data = dataframe[valid].drop(labels=[col for col in ['geometry'] if col in dataframe.columns], axis=1)
+    gdf = gpd.GeoDataFrame(data, geometry=gpd.points_from_xy(lon[valid], lat[valid]), crs=4326)
+    gdf.to_file(outpath, driver='FlatGeobuf', SPATIAL_INDEX='YES')
         
+
 ##################################################################################
 #
 # Functions B: Auxiliary functions
@@ -1399,6 +2589,9 @@ def correctUmlauts(entries):
         return correctedUmlaute
     
 
+EARTH_RADIUS = 6367082 # in meters, see haversine()
+
+
 def haversine(latlon1,latlon2):
     """
     Haversine formula to calculate great-circle distance between two points on a sphere.
@@ -1421,15 +2614,282 @@ def haversine(latlon1,latlon2):
     insideArcsin = np.sin(dlat/2)**2 + np.cos(lat1) * np.cos(lat2) * np.sin(dlon/2)**2
     d = 2 * np.arcsin(np.sqrt(insideArcsin)) 
     
-    radiusToGroundlevel =  6367082
-    distance = radiusToGroundlevel * d
+    distance = EARTH_RADIUS * d
     return distance
 
 
+SWISS_BOUNDING_BOX = (45.81, 5.95, 47.81, 10.50) # latMin, lonMin, latMax, lonMax
+
+
+def loadPLZBoundingBoxes(source):
+    """
+    Loads bounding boxes of postal codes (PLZ).
+
+    Parameters
+    ----------
+    source : dict / str
+        {plz: (latMin, lonMin, latMax, lonMax)} or path to a csv with the columns 
+        plz, lat_min, lon_min, lat_max, lon_max.
+
+    Returns
+    -------
+    pd.DataFrame indexed by the PLZ (as str) with the columns lat_min, lon_min, lat_max, lon_max.
+
+    """
+    if isinstance(source, pd.DataFrame):
+        boxes = source.copy()
+    elif isinstance(source, dict):
+        boxes = pd.DataFrame([[plz]+list(box) for plz,box in source.items()], 
+                             columns=['plz','lat_min','lon_min','lat_max','lon_max'])
+    else:
+        boxes = pd.read_csv(source, dtype={'plz':str})
+        
+    boxes['plz'] = boxes['plz'].astype(str)
+    return boxes.set_index('plz')[['lat_min','lon_min','lat_max','lon_max']]
+
+
+def validateCoordinates(dataframe, plzBoundingBoxes=None):
+    """
+    Checks, if the coordinates (lat/lon) of a pd.DataFrame are plausible: within Switzerland and, 
+    if plzBoundingBoxes is given, within the bounding box of the PLZ found in the address column.
+    Addresses with a PLZ not listed in plzBoundingBoxes are only checked against Switzerland.
+
+    Parameters
+    ----------
+    dataframe : pd.DataFrame
+        with the columns lat, lon (and address, if plzBoundingBoxes is given)
+    plzBoundingBoxes : dict / str / pd.DataFrame, optional
+        see loadPLZBoundingBoxes(). The default is None.
+
+    Returns
+    -------
+    np.array (bool), True for valid coordinates.
+
+    """
+    lat = pd.to_numeric(dataframe['lat'], errors='coerce').to_numpy(dtype=float)
+    lon = pd.to_numeric(dataframe['lon'], errors='coerce').to_numpy(dtype=float)
+    
+    latMin, lonMin, latMax, lonMax = SWISS_BOUNDING_BOX
+    valid = (lat >= latMin) & (lat <= latMax) & (lon >= lonMin) & (lon <= lonMax)
+    
+    if plzBoundingBoxes is not None and len(dataframe) > 0:
+        boxes = loadPLZBoundingBoxes(plzBoundingBoxes)
+        plz = dataframe['address'].astype(str).str.extract(r'.*\b(\d{4})\b', expand=False)
+        box = boxes.reindex(plz.tolist())
+        known = box['lat_min'].notna().to_numpy()
+        inBox = ((lat >= box['lat_min'].to_numpy()) & (lat <= box['lat_max'].to_numpy()) & 
+                 (lon >= box['lon_min'].to_numpy()) & (lon <= box['lon_max'].to_numpy()))
+        valid = valid & (~known | inBox)
+        
+    return valid
+
+
+_PUBLIC_NOMINATIM = None
+
+def publicNominatim():
+    """ 
+    Returns the geocode function of the public Nominatim (a single client per session), limited 
+    to 1 request per second as required by the usage policy (https://operations.osmfoundation.org/policies/nominatim/).
+    """
+    global _PUBLIC_NOMINATIM
+    if _PUBLIC_NOMINATIM is None:
+        nom = Nominatim(user_agent="FindApartment_CH", scheme='http', domain='nominatim.openstreetmap.org')
+        _PUBLIC_NOMINATIM = RateLimiter(nom.geocode, min_delay_seconds=1)
+    return _PUBLIC_NOMINATIM
+
+
+def haversineMatrix(latlons1, latlons2):
+    """
+    Vectorized version of haversine(): distances between all pairs of two sets of points 
+    in one pass (e.g. listings x destinations).
+
+    Parameters
+    ----------
+    latlons1 : array-like (n,2)
+        lat/lon in decimal degrees
+    latlons2 : array-like (m,2)
+        lat/lon in decimal degrees
+
+    Returns
+    -------
+    np.array (n,m), distances in meters.
+
+    """
+    latlon1 = np.deg2rad(np.asarray(latlons1, dtype=float).reshape(-1,2))
+    latlon2 = np.deg2rad(np.asarray(latlons2, dtype=float).reshape(-1,2))
+    lat1, lon1 = latlon1[:,0][:,None], latlon1[:,1][:,None]
+    lat2, lon2 = latlon2[:,0][None,:], latlon2[:,1][None,:]
+    
+    insideArcsin = np.sin((lat2-lat1)/2)**2 + np.cos(lat1) * np.cos(lat2) * np.sin((lon2-lon1)/2)**2
+    d = 2 * np.arcsin(np.sqrt(np.clip(insideArcsin, 0, 1)))
+    return EARTH_RADIUS * d
+
+
+def parseDurations(durations):
+    """
+    Parses the durations of the SBB-API (e.g. '00d00:32:00') to minutes, all at once.
+
+    Parameters
+    ----------
+    durations : list
+        durations as 'DDdHH:MM:SS'
+
+    Returns
+    -------
+    np.array of float, NaN if not parseable.
+
+    """
+    parts = pd.Series(durations, dtype=object).astype(str).str.extract(r'^(\d+)d(\d+):(\d+):(\d+)$').astype(float)
+    return parts.to_numpy().reshape(-1,4) @ np.array([24*60, 60, 1, 1/60])
+
+
+def _pagesOfUnits(units, source):
+    """ Page numbers of the units of a portal, e.g. ['homegate-3', 'immoscout-0'] -> [3] for homegate """
+    return [int(unit.split('-')[1]) for unit in units if unit.startswith(source + '-')]
+
+
+class SpatialIndex:
+    """
+    KD-tree (scipy) over a set of points (e.g. destinations or stops) for nearest neighbour and 
+    within-radius queries. The points are mapped to 3D coordinates on a sphere, so that the 
+    euclidean (chord) distances of the tree can be converted to great-circle distances exactly.
+
+    Parameters:
+        latlons (array-like (n,2)): lat/lon in decimal degrees
+    """
+    
+    def __init__(self, latlons):
+        self.LATLONS = np.asarray(latlons, dtype=float).reshape(-1,2)
+        self.tree = cKDTree(self.__toXYZ(self.LATLONS))
+        
+        
+    def __toXYZ(self, latlons):
+        lat, lon = np.deg2rad(np.asarray(latlons, dtype=float).reshape(-1,2)).T
+        return np.column_stack([np.cos(lat)*np.cos(lon), np.cos(lat)*np.sin(lon), np.sin(lat)]) * EARTH_RADIUS
+    
+    
+    def nearest(self, latlons, k=1):
+        """ Returns distances (meters) and indices of the k nearest points """
+        chord, idx = self.tree.query(self.__toXYZ(latlons), k=k)
+        distance = 2 * EARTH_RADIUS * np.arcsin(np.clip(chord / (2*EARTH_RADIUS), 0, 1))
+        return distance, idx
+    
+    
+    def withinRadius(self, latlons, radius):
+        """ Returns for each point the indices of the points within the radius (meters) """
+        chord = 2 * EARTH_RADIUS * np.sin(min(radius / (2*EARTH_RADIUS), np.pi/2))
+        return self.tree.query_ball_point(self.__toXYZ(latlons), r=chord)
+
+
+def loadAreas(areas):
+    """
+    Reads polygons (areas of interest) given as GeoJSON file, GeoJSON dict or shapely geometry.
+
+    Parameters
+    ----------
+    areas : str / dict / shapely geometry / list
+        see SpatialFilter
+
+    Returns
+    -------
+    polygons (list of shapely geometries), names (list)
+
+    """
+    if not isinstance(areas, (list, tuple)):
+        areas = [areas]
+        
+    polygons = []
+    names = []
+    for area in areas:
+        if isinstance(area, str):
+            with open(area, 'r') as file:
+                content = file.read()
+            area = json.loads(content[content.find('{'):].rstrip().rstrip(';'))
+            
+        if isinstance(area, dict) and area.get('type') == 'FeatureCollection':
+            features = area['features']
+        elif isinstance(area, dict) and area.get('type') == 'Feature':
+            features = [area]
+        else:
+            features = [{'geometry': area, 'properties': {}}]
+            
+        for feature in features:
+            geometry = feature['geometry']
+            if isinstance(geometry, dict):
+                geometry = shape(geometry)
+            properties = feature.get('properties') or {}
+            polygons.append(geometry)
+            names.append(properties.get('name', properties.get('title', len(names))))
+            
+    return polygons, names
+
+
+def clusterOrigins(latlons, cellSize):
+    """
+    Clusters points on a grid with square cells of cellSize meters (side length). The representative 
+    of a cell is the point closest to the mean of the cell.
+
+    Parameters
+    ----------
+    latlons : array-like (n,2)
+        lat/lon in decimal degrees
+    cellSize : float
+        side length of the grid cells in meters (<= 0: every point is its own representative)
+
+    Returns
+    -------
+    representatives (np.array (n,), position of the representative of each point), 
+    distances (np.array (n,), distance to the representative in meters)
+
+    """
+    latlons = np.asarray(latlons, dtype=float).reshape(-1,2)
+    if cellSize <= 0 or len(latlons) == 0:
+        return np.arange(len(latlons)), np.zeros(len(latlons))
+    
+    metersPerDegree = np.pi / 180 * EARTH_RADIUS
+    y = latlons[:,0] * metersPerDegree
+    x = latlons[:,1] * metersPerDegree * np.cos(np.deg2rad(latlons[:,0].mean()))
+    cells = pd.DataFrame({'cellY': np.floor(y / cellSize), 'cellX': np.floor(x / cellSize), 'y': y, 'x': x})
+    
+    cellNo = cells.groupby(['cellY','cellX']).ngroup().to_numpy()
+    meanY = cells.groupby(cellNo)['y'].transform('mean').to_numpy()
+    meanX = cells.groupby(cellNo)['x'].transform('mean').to_numpy()
+    toMean = np.hypot(y - meanY, x - meanX)
+    
+    order = np.lexsort((toMean, cellNo))
+    firstOfCell = np.r_[True, cellNo[order][1:] != cellNo[order][:-1]]
+    repOfCell = dict(zip(cellNo[order][firstOfCell], order[firstOfCell]))
+    representatives = np.array([repOfCell[c] for c in cellNo])
+    
+    distances = haversine(latlons.T, latlons[representatives].T) # element-wise
+    return representatives, distances
+
+
+class RateLimit:
+    """ 
+    Thread-safe rate limit: wait() blocks until the next request is allowed, such that at most 
+    requestsPerSecond requests are started per second (None or <= 0: no limit).
+    """
+    
+    def __init__(self, requestsPerSecond):
+        self.interval = 1 / requestsPerSecond if requestsPerSecond else 0
+        self.next = time.time()
+        self.__lock = threading.Lock()
+        
+        
+    def wait(self):
+        if self.interval <= 0:
+            return
+        with self.__lock:
+            now = time.time()
+            slot = max(now, self.next)
+            self.next = slot + self.interval
+        time.sleep(max(0, slot - now))
+
+
 def geocode(addressString):
     """ Geocoding a single address using Nominatim online """
-    nom = Nominatim(user_agent="FindApartment", scheme='http', domain='nominatim.openstreetmap.org')
-    location = nom.geocode(addressString)
+    location = publicNominatim()(addressString)
     try:
         location = location.raw
         lat = float(location['lat'])
@@ -1481,3 +2941,180 @@ def postalcode2city(postalcode):
             city = lookupdict[plz]
             cities.append(city)
         return cities
+
+
+##################################################################################
+#
+# Functions C: Parsers of the portals (module level, to be run in a process pool)
+#
+##################################################################################
+
+def parseImmoscoutPage(html):
+    """
+    Parses a result page of immoscout (raw bytes or str).
+
+    Returns
+    -------
+    dict of lists (columns as Scraper.scrape(), without source).
+
+    """
+    startStr = '\{"id":\d{7},"accountId"'
+    endStr = '\<\/script>'
+
+    urls = []
+    addresses = []
+    prices = []
+    rooms = []
+    sizes = []
+    descriptions = []
+    pdates = []
+    currency = []
+    lat = []
+    lon = []
+
+    if isinstance(html, bytes):
+        html = html.decode('utf-8')
+    startInfos = re.search(startStr,html).span(0)[0]
+    endInfos = re.search(endStr,html).span(0)[0]
+    infoChunk = html[startInfos:endInfos]
+
+    startPoints = [m.start(0)  for m in re.finditer(startStr,infoChunk)][:24]
+
+    for i,point in enumerate(startPoints):
+
+        info = infoChunk[point:infoChunk.find('"userRelevantScore"', point+1)-1]+"}"
+        if len(info) > 15000:
+            continue
+
+        infoAsDict = json.loads(info)
+        if len(infoAsDict) <9:
+            continue
+
+        _url = 'https://www.immoscout24.ch'+infoAsDict['propertyUrl']
+        _url = _url.replace("https://www.immoscout24.chhttps://","https://www.")
+        urls.append(_url)
+
+        if 'street' in infoAsDict:
+            addresses.append( ", ".join([infoAsDict['street'], " ".join([infoAsDict['zip'],  infoAsDict['cityName']])]))
+        else:
+            addresses.append(" ".join([infoAsDict['zip'],  infoAsDict['cityName']]))
+
+        if infoAsDict['priceFormatted'] == 'Preis auf Anfrage':
+            prices.append(np.nan)
+        elif 'grossPrice' in infoAsDict:
+            prices.append( infoAsDict['grossPrice'] )
+        else:
+            prices.append( infoAsDict['price'])
+
+        # ugly, but necessary (?)
+        try:
+            rooms.append(infoAsDict['numberOfRooms'])
+        except KeyError:
+            rooms.append(np.nan)
+
+        try:
+            sizes.append(infoAsDict['surfaceLiving'] )
+        except KeyError:
+            sizes.append(np.nan)
+
+        try:
+            descriptions.append(infoAsDict['title'])
+        except KeyError:
+            descriptions.append('no description')
+
+        currency.append(infoAsDict['priceFormatted'][:3])
+
+        pdate = infoAsDict['lastPublished']
+        pdates.append(pdate)
+
+        try:
+            lat.append( infoAsDict['latitude'])
+            lon.append( infoAsDict['longitude'])
+        except KeyError:
+            lat.append(np.nan)
+            lon.append(np.nan)
+
+    return {'url':urls, 'address':addresses, 'nRooms':rooms, 'size':sizes, 'rent':prices, 'currency':currency, 
+            'description':descriptions, 
+            'published':pdates, 'lat':lat, 'lon':lon}
+
+
+def parseHomegatePage(html):
+    """
+    Parses a result page of homegate (raw bytes or str).
+
+    Returns
+    -------
+    dict of lists (columns as Scraper.scrape(), without source).
+
+    """
+    if isinstance(html, bytes):
+        html = html.decode('utf-8')
+    chunkStart = re.search('<script>window.__INITIAL_STATE__=', html).span()[1]
+    chunkEnd = re.search(',"page":\d{1,5},"pageCount":\d{1,5},"', html).span()[0]
+    htmlChunk = html[chunkStart:chunkEnd]
+
+    urls = []
+    addresses = []
+    prices = []
+    rooms = []
+    sizes = []
+    descriptions = []
+    pdates = []
+    currency = []
+    lat = []
+    lon = []
+
+    matches = [m.start(0) for m in re.finditer('{"listingType":', htmlChunk)]
+    for miniStart in matches:
+        miniEnd = htmlChunk.find('"currency":',miniStart)+len('"currency":')+5
+        miniChunk = htmlChunk[miniStart:miniEnd]+"}}}"
+        chunkDict = json.loads(miniChunk)
+
+        url = 'https://www.homegate.ch/mieten/'+chunkDict['listing']['id']
+        urls.append(url)
+
+        try: 
+            if chunkDict['listing']['prices']['rent']['interval'] == 'WEEK':
+                multiplier = 4
+            else:
+                multiplier = 1
+
+        except KeyError:
+            #print('KeyError: check rent interval, assumed interval: monthly')
+            multiplier = 1
+
+
+        try:
+            chunkDict['listing']['prices']['rent']['gross']
+            rent = chunkDict['listing']['prices']['rent']['gross'] * multiplier
+
+        except KeyError:
+            rent = np.nan
+
+        prices.append(rent)
+        currency.append(chunkDict['listing']['prices']['currency'])
+
+        if len(chunkDict['listing']['address']) == 3:
+            plzAdr = " ".join([chunkDict['listing']['address']['postalCode'], chunkDict['listing']['address']['locality']])
+            address = ", ".join([chunkDict['listing']['address']['street'], plzAdr])
+
+        elif len(chunkDict['listing']['address']) == 2:
+            address = " ".join([chunkDict['listing']['address']['postalCode'], chunkDict['listing']['address']['locality']])
+
+        addresses.append(address.replace(',,',','))        
+
+        rooms.append(chunkDict['listing']['characteristics']['numberOfRooms'])
+        sizes.append(chunkDict['listing']['characteristics']['livingSpace'])
+        descriptions.append(chunkDict['listing']['localization']['de']['text']['title'])
+
+        pdates.append(np.nan)
+        lat.append(np.nan)
+        lon.append(np.nan)
+
+    return {'url':urls, 'address':addresses, 'nRooms':rooms, 'size':sizes, 'rent':prices, 'currency':currency, 
+            'description':descriptions, 
+            'published':pdates, 'lat':lat, 'lon':lon}
+
+
+PAGE_PARSERS = {'immoscout': parseImmoscoutPage, 'homegate': parseHomegatePage}
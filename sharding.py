@@ -0,0 +1,241 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Sharded scraping over a local work queue (SQLite): many locations and portals, N worker processes.
+
+A planner splits the search space into work units of location x portal x page range (the number of
+pages is fetched once per location and portal) and stores them in a SQLite file. Workers, separate
+processes started by run() or by hand (also on other machines sharing the file system, as long as
+it supports file locks), claim one unit after the other, scrape its pages and store the listings
+in the queue. A claim expires after LEASE_SECONDS (e.g. a killed worker), failed units are retried
+up to MAX_ATTEMPTS times. The merger deduplicates the listings of all units (as Scraper.scrape()).
+
+Running it again with the same QUEUE_PATH resumes: the units are planned once, done units are kept.
+
+Usage:
+    class Cantons(ShardedScrape):
+        LOCATIONS = CANTON_CAPITALS
+        WORKERS = 8
+        class SCRAPER(Scraper):
+            PRICE_MAX = 2500
+    if __name__ == '__main__':
+        listings = Cantons().run()   # plan, N worker processes, merge -> pd.DataFrame
+
+    # a further worker (e.g. on another machine):  Cantons().work()
+
+"""
+
+import multiprocessing
+import os
+import pickle
+import socket
+import sqlite3
+import time
+
+import pandas as pd
+
+from scrapeApartments import Scraper
+
+
+CANTON_CAPITALS = ['Aarau', 'Altdorf', 'Appenzell', 'Basel', 'Bellinzona', 'Bern', 'Chur', 'Delémont',
+                   'Frauenfeld', 'Fribourg', 'Genève', 'Glarus', 'Herisau', 'Lausanne', 'Liestal', 'Luzern',
+                   'Neuchâtel', 'Sarnen', 'Schaffhausen', 'Schwyz', 'Sion', 'Solothurn', 'St. Gallen', 'Stans',
+                   'Zug', 'Zürich']
+
+
+class WorkQueue:
+    """
+    Work units and their results in a SQLite file, claimed by workers in a transaction each.
+
+    Parameters:
+        path (str): path of the SQLite file
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.connection = sqlite3.connect(path, timeout=60, isolation_level=None)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('CREATE TABLE IF NOT EXISTS units (id INTEGER PRIMARY KEY, location TEXT, portal TEXT, '
+                                'pages TEXT, status TEXT, worker TEXT, claimed REAL, attempts INTEGER, error TEXT)')
+        self.connection.execute('CREATE TABLE IF NOT EXISTS results (id INTEGER PRIMARY KEY, listings BLOB)')
+
+
+    def add(self, units):
+        """ Adds units given as (location, portal, pages) with pages as list of unit names (e.g. homegate-3) """
+        with self.connection:
+            self.connection.executemany("INSERT INTO units (location, portal, pages, status, attempts) VALUES (?,?,?,'pending',0)",
+                                        [(location, portal, ','.join(pages)) for location, portal, pages in units])
+
+
+    def __len__(self):
+        return self.connection.execute('SELECT COUNT(*) FROM units').fetchone()[0]
+
+
+    def claim(self, worker, leaseSeconds, maxAttempts):
+        """ Returns (id, location, portal, pages) of the next unit, or None if there is none left """
+        now = time.time()
+        self.connection.execute('BEGIN IMMEDIATE') # one worker at a time
+        try:
+            # expired claims of the last attempt (e.g. a killed worker) are not retried
+            self.connection.execute("UPDATE units SET status = 'failed', error = 'lease expired on the last attempt' "
+                                    "WHERE status = 'claimed' AND claimed < ? AND attempts >= ?", (now - leaseSeconds, maxAttempts))
+            row = self.connection.execute("SELECT id, location, portal, pages FROM units WHERE attempts < ? AND "
+                                          "(status = 'pending' OR (status = 'claimed' AND claimed < ?)) ORDER BY id LIMIT 1",
+                                          (maxAttempts, now - leaseSeconds)).fetchone()
+            if row is not None:
+                self.connection.execute("UPDATE units SET status = 'claimed', worker = ?, claimed = ?, attempts = attempts + 1 "
+                                        "WHERE id = ?", (worker, now, row[0]))
+            self.connection.execute('COMMIT')
+        except Exception:
+            self.connection.execute('ROLLBACK')
+            raise
+        if row is None:
+            return None
+        return row[0], row[1], row[2], row[3].split(',')
+
+
+    def complete(self, unitId, listings):
+        with self.connection:
+            self.connection.execute('INSERT OR REPLACE INTO results (id, listings) VALUES (?,?)', (unitId, pickle.dumps(listings)))
+            self.connection.execute("UPDATE units SET status = 'done', error = NULL WHERE id = ?", (unitId,))
+
+
+    def fail(self, unitId, error, maxAttempts):
+        """ Releases a unit for a retry, or marks it as failed after maxAttempts """
+        with self.connection:
+            self.connection.execute("UPDATE units SET status = CASE WHEN attempts < ? THEN 'pending' ELSE 'failed' END, "
+                                    "error = ? WHERE id = ?", (maxAttempts, error, unitId))
+
+
+    def progress(self):
+        """ Number of units per status """
+        return dict(self.connection.execute('SELECT status, COUNT(*) FROM units GROUP BY status').fetchall())
+
+
+    def results(self):
+        """ Yields the listings (pd.DataFrame) of the done units """
+        for (blob,) in self.connection.execute('SELECT listings FROM results ORDER BY id'):
+            yield pickle.loads(blob)
+
+
+    def close(self):
+        self.connection.close()
+
+
+class ShardedScrape:
+    """
+    Plans, scrapes and merges LOCATIONS x PORTALS in work units of PAGES_PER_UNIT pages (see module docstring).
+
+    Parameters:
+        SCRAPER (class): Scraper (or subclass) with the search parameters, LOCATION and PAGE are set per unit
+        LOCATIONS (list): locations to scrape (e.g. CANTON_CAPITALS)
+        PORTALS (list): 'homegate' and/or 'immoscout' (paginated portals)
+        PAGES_PER_UNIT (int): pages per work unit
+        QUEUE_PATH (str): SQLite file of the work queue
+        WORKERS (int): worker processes started by run()
+        LEASE_SECONDS (float): a claimed unit is given to another worker after this time
+        MAX_ATTEMPTS (int): attempts per unit
+
+    Returns:
+        run(): pd.DataFrame of the listings of all units, deduplicated
+        plan(): number of units planned; work(): number of units done by this worker; merge(): pd.DataFrame
+    """
+
+    SCRAPER = Scraper
+    LOCATIONS = ['Zürich']
+    PORTALS = ['homegate', 'immoscout']
+    PAGES_PER_UNIT = 5
+    QUEUE_PATH = 'workQueue.sqlite'
+    WORKERS = 4
+    LEASE_SECONDS = 600
+    MAX_ATTEMPTS = 3
+
+    def run(self):
+        self.plan()
+        if self.WORKERS <= 1:
+            self.work()
+        else:
+            processes = [multiprocessing.Process(target=runWorker, args=(type(self), i)) for i in range(self.WORKERS)]
+            for process in processes:
+                process.start()
+            for process in processes:
+                process.join()
+
+        queue = WorkQueue(self.QUEUE_PATH)
+        print("ShardedScrape: units {}".format(queue.progress()))
+        queue.close()
+        return self.merge()
+
+
+    def plan(self):
+        """ Splits the search space into work units (once per QUEUE_PATH), returns the number of units """
+        queue = WorkQueue(self.QUEUE_PATH)
+        try:
+            if len(queue) > 0:
+                return len(queue)
+            units = []
+            for location in self.LOCATIONS:
+                for portal in self.PORTALS:
+                    try:
+                        pages = self.__scraper(location, portal)().units()
+                    except Exception as e:
+                        print("ShardedScrape: pages of {} ({}) failed: {}".format(location, portal, e))
+                        continue
+                    units += [(location, portal, pages[i:i+self.PAGES_PER_UNIT]) for i in range(0, len(pages), self.PAGES_PER_UNIT)]
+            queue.add(units)
+            print("ShardedScrape: {} units planned.".format(len(units)))
+            return len(units)
+        finally:
+            queue.close()
+
+
+    def work(self, worker=None):
+        """ Claims and scrapes units until none is left, returns the number of units done """
+        worker = worker or '{}-{}'.format(socket.gethostname(), os.getpid())
+        queue = WorkQueue(self.QUEUE_PATH)
+        done = 0
+        try:
+            while True:
+                unit = queue.claim(worker, self.LEASE_SECONDS, self.MAX_ATTEMPTS)
+                if unit is None:
+                    break
+                unitId, location, portal, pages = unit
+                try:
+                    errors = []
+                    batches = [batch for name, batch in self.__scraper(location, portal)().scrapeUnits(errors=errors, only=pages)]
+                    if errors:
+                        raise errors[0][1]
+                    listings = pd.concat(batches).assign(location=location) if batches else pd.DataFrame()
+                    queue.complete(unitId, listings)
+                    done += 1
+                except Exception as e:
+                    print("ShardedScrape: unit {} ({}, {}) failed: {}".format(unitId, location, portal, e))
+                    queue.fail(unitId, '{}: {}'.format(type(e).__name__, e), self.MAX_ATTEMPTS)
+        finally:
+            queue.close()
+        return done
+
+
+    def merge(self):
+        """ Listings of all done units, deduplicated (e.g. overlapping radii of locations) """
+        queue = WorkQueue(self.QUEUE_PATH)
+        try:
+            batches = [batch for batch in queue.results() if len(batch) > 0]
+        finally:
+            queue.close()
+        if len(batches) == 0:
+            return pd.DataFrame()
+
+        listings = pd.concat(batches).sort_values('url')
+        listings = listings.drop_duplicates(subset=['url'], keep='first')
+        return listings.drop_duplicates(subset=['address', 'description', 'rent'], keep='first').reset_index(drop=True)
+
+
+    def __scraper(self, location, portal):
+        return type('Unit', (self.SCRAPER,), {'LOCATION': location, 'PAGE': portal,
+                                              'SCRAPING_METHOD': 'requests', 'MAX_WORKERS': self.PAGES_PER_UNIT})
+
+
+def runWorker(sharded, workerNo):
+    """ Entry point of a worker process: sharded is the ShardedScrape (sub)class """
+    sharded().work('{}-{}-{}'.format(socket.gethostname(), os.getpid(), workerNo))
@@ -0,0 +1,157 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Routing on the street network of OpenStreetMap (offline), for commuting by bike or by foot.
+
+The street graph is read from an OSM XML extract (e.g. exported from https://www.openstreetmap.org/export,
+overpass or osmium) and stored as compressed sparse rows (CSR) of travel times in seconds. A one-to-all
+Dijkstra from a destination on the reversed graph yields the travel time of every node to the
+destination, i.e. the commuting times of all listings come from a single search per destination.
+
+Used by CommutingTimes (MEANS = 'bike' or 'walk'). A small extract for testing purposes is found in data/streets_sample.osm.
+
+"""
+
+import xml.etree.ElementTree as ET
+
+import numpy as np
+from scipy.sparse import csr_matrix
+from scipy.sparse.csgraph import dijkstra
+
+from scrapeApartments import SpatialIndex, haversine
+
+
+SPEEDS = {'walk': 4000 / 3600, # meters per second (as in CommutingTimes)
+          'bike': 15000 / 3600}
+
+# highway types usable per means (https://wiki.openstreetmap.org/wiki/Key:highway)
+HIGHWAYS = {'walk': {'primary', 'primary_link', 'secondary', 'secondary_link', 'tertiary', 'tertiary_link',
+                     'unclassified', 'residential', 'living_street', 'service', 'pedestrian', 'track', 'road',
+                     'footway', 'path', 'steps', 'cycleway', 'bridleway'},
+            'bike': {'primary', 'primary_link', 'secondary', 'secondary_link', 'tertiary', 'tertiary_link',
+                     'unclassified', 'residential', 'living_street', 'service', 'track', 'road',
+                     'cycleway', 'path'}}
+
+
+class StreetGraph:
+    """
+    Street graph of an OSM extract for one means (walk or bike) as CSR matrix of travel times.
+
+    Parameters:
+        PATH (str): path to the OSM XML file (.osm) or to a graph saved with save() (.npz)
+        MEANS (str): 'walk' or 'bike'
+        SPEED (float): travel speed in km/h (None: default of the means, 4 km/h walking, 15 km/h by bike)
+        MAX_SNAP_DISTANCE (float): listings/destinations farther away from the street network (meters) are not routed
+    """
+
+    PATH = 'streets.osm'
+    MEANS = 'bike'
+    SPEED = None
+    MAX_SNAP_DISTANCE = 500
+
+    def __init__(self):
+        assert self.MEANS in SPEEDS, "MEANS must be 'walk' or 'bike'"
+        self.speed = SPEEDS[self.MEANS] if self.SPEED is None else self.SPEED * 1000 / 3600
+
+        if self.PATH.endswith('.npz'):
+            graph = np.load(self.PATH)
+            self.NODE_LATLON = graph['latlon']
+            fromNode, toNode, meters = graph['fromNode'], graph['toNode'], graph['meters']
+        else:
+            self.NODE_LATLON, fromNode, toNode, meters = self.__readOSM()
+
+        nNodes = len(self.NODE_LATLON)
+        # csr_matrix sums duplicate entries (overlapping ways, a segment added twice): keep the shortest
+        order = np.argsort(meters, kind='stable')
+        fromNode, toNode, meters = fromNode[order], toNode[order], meters[order]
+        unique = np.unique(fromNode.astype(np.int64) * nNodes + toNode, return_index=True)[1]
+        fromNode, toNode, meters = fromNode[unique], toNode[unique], meters[unique]
+        self.EDGES = (fromNode, toNode, meters)
+        self.GRAPH = csr_matrix((meters / self.speed, (fromNode, toNode)), shape=(nNodes, nNodes))
+        self.REVERSED = self.GRAPH.T.tocsr() # to search from the destination
+        self.NODE_INDEX = SpatialIndex(self.NODE_LATLON)
+
+
+    def __readOSM(self):
+        """ Streams the OSM file, keeps nodes and ways usable for MEANS """
+        latlon = {}
+        fromNode = []
+        toNode = []
+        highways = HIGHWAYS[self.MEANS]
+
+        for event, element in ET.iterparse(self.PATH, events=('end',)):
+            if element.tag == 'node':
+                latlon[element.get('id')] = (float(element.get('lat')), float(element.get('lon')))
+                element.clear()
+
+            elif element.tag == 'way':
+                tags = {tag.get('k'): tag.get('v') for tag in element.iter('tag')}
+                if tags.get('highway') in highways and tags.get('access') not in ('no', 'private'):
+                    refs = [nd.get('ref') for nd in element.iter('nd')]
+                    oneway = self.__oneway(tags)
+                    for a, b in zip(refs[:-1], refs[1:]):
+                        if oneway >= 0:
+                            fromNode.append(a)
+                            toNode.append(b)
+                        if oneway <= 0:
+                            fromNode.append(b)
+                            toNode.append(a)
+                element.clear()
+
+        # only nodes of the street network, numbered 0..n-1
+        used = sorted(set(fromNode) | set(toNode))
+        nodeNo = {node: i for i,node in enumerate(used)}
+        nodeLatLon = np.array([latlon[node] for node in used], dtype=float).reshape(-1,2)
+        fromNode = np.array([nodeNo[node] for node in fromNode], dtype=np.int32)
+        toNode = np.array([nodeNo[node] for node in toNode], dtype=np.int32)
+        meters = haversine(nodeLatLon[fromNode].T, nodeLatLon[toNode].T) # element-wise
+        return nodeLatLon, fromNode, toNode, meters
+
+
+    def __oneway(self, tags):
+        """ 1: only forward, -1: only backward, 0: both directions """
+        if self.MEANS == 'walk' or tags.get('oneway:bicycle') == 'no':
+            return 0
+        oneway = tags.get('oneway', 'no')
+        if oneway in ('yes', 'true', '1') or tags.get('junction') == 'roundabout':
+            return 1
+        if oneway == '-1':
+            return -1
+        return 0
+
+
+    def save(self, path):
+        """ Saves the graph (nodes and edges) as .npz, loads much faster than the OSM file """
+        fromNode, toNode, meters = self.EDGES
+        np.savez_compressed(path, latlon=self.NODE_LATLON, fromNode=fromNode, toNode=toNode, meters=meters)
+
+
+    def travelTimes(self, latlons, destination):
+        """
+        Travel times (minutes) from many origins (e.g. listings) to one destination, using a single
+        Dijkstra from the destination on the reversed graph. The distances from the origins and the
+        destination to the closest node are added (straight line).
+
+        Parameters
+        ----------
+        latlons : array-like (n,2)
+            origins, lat/lon in decimal degrees
+        destination : tuple
+            lat/lon in decimal degrees
+
+        Returns
+        -------
+        minutes (np.array (n,), NaN if not reachable)
+
+        """
+        latlons = np.asarray(latlons, dtype=float).reshape(-1,2)
+        destSnap, destNode = self.NODE_INDEX.nearest([destination])
+        if destSnap[0] > self.MAX_SNAP_DISTANCE:
+            return np.full(len(latlons), np.nan)
+
+        seconds = dijkstra(self.REVERSED, directed=True, indices=int(destNode[0]))
+        snap, nodes = self.NODE_INDEX.nearest(latlons)
+        total = seconds[nodes] + (snap + destSnap[0]) / self.speed
+        total[snap > self.MAX_SNAP_DISTANCE] = np.nan
+        total[~np.isfinite(total)] = np.nan
+        return total / 60
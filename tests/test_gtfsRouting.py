@@ -0,0 +1,54 @@
+# -*- coding: utf-8 -*-
+"""
+Reverse RAPTOR on the sample feed (data/gtfs_sample). Run from the repository: python -m pytest tests
+"""
+
+from datetime import date
+
+import numpy as np
+
+from gtfsRouting import GTFSTimetable
+
+
+WINTERTHUR = (47.500331, 8.723822)
+STADELHOFEN = (47.366717, 8.548526)
+ENGE = (47.364267, 8.531264)
+CENTRAL = (47.376836, 8.544135)
+
+
+class Monday(GTFSTimetable):
+    SERVICE_DATE = date(2024, 1, 8)
+
+
+class BoxingDay(GTFSTimetable):
+    SERVICE_DATE = date(2022, 12, 26) # a monday, WD removed in calendar_dates.txt
+
+
+def test_directTrip():
+    # arrive by 08:00: S12 Winterthur 07:30 -> Stadelhofen 07:54, both at the stops (no walking)
+    minutes, trips = Monday().travelTimes([WINTERTHUR], STADELHOFEN, 8*3600)
+    assert minutes[0] == 24
+    assert trips[0] == 1
+
+
+def test_transfer():
+    # S12 07:30 reaches HB at 07:51, too late for the S2 at 07:52 (2 min. to change): S12 07:15 -> HB 07:36, S2 07:52 -> Enge 07:58
+    timetable = Monday()
+    departure, arrival, trips = timetable.latestDepartures(ENGE, 8*3600, maxWalk=50)
+    winterthur = list(timetable.STOP_IDS).index('8506000')
+    assert (departure[winterthur], arrival[winterthur], trips[winterthur]) == (7*3600 + 15*60, 7*3600 + 58*60, 2)
+    minutes, trips = timetable.travelTimes([WINTERTHUR], ENGE, 8*3600, maxWalk=50)
+    assert (minutes[0], trips[0]) == (43, 2)
+
+
+def test_footpath():
+    # transfers.txt: HB -> Central 5 min. on foot, S12 07:30 -> HB 07:51 -> Central 07:56 with one trip (not the tram)
+    timetable = Monday()
+    departure, arrival, trips = timetable.latestDepartures(CENTRAL, 8*3600, maxWalk=50)
+    winterthur = list(timetable.STOP_IDS).index('8506000')
+    assert (departure[winterthur], arrival[winterthur], trips[winterthur]) == (7*3600 + 30*60, 7*3600 + 56*60, 1)
+
+
+def test_noService():
+    minutes, trips = BoxingDay().travelTimes([WINTERTHUR], STADELHOFEN, 8*3600)
+    assert np.isnan(minutes[0])
@@ -0,0 +1,68 @@
+# -*- coding: utf-8 -*-
+"""
+Checkpoints of the Pipeline: a failed unit is recorded and retried alone on resume. Offline (the
+listings carry their coordinates, the commuting times are stubbed). Run from the repository: python -m pytest tests
+"""
+
+import json
+import os
+
+import pandas as pd
+
+from scrapeApartments import Scraper, CommutingTimes
+from pipeline import Pipeline
+
+
+UNITS = ['homegate-1', 'homegate-2', 'homegate-3']
+
+
+class Pages(Scraper):
+    SCRAPED = []
+
+    def scrapeUnits(self, skip=(), seen=(), errors=None, only=None):
+        for no, unit in enumerate(UNITS):
+            if unit in skip:
+                continue
+            self.SCRAPED.append(unit)
+            yield unit, pd.DataFrame({'url': ['{}/{}'.format(unit, i) for i in range(3)],
+                                      'address': ['Bahnhofstrasse {}, 8001 Zürich'.format(no*3 + i) for i in range(3)],
+                                      'rent': 2000, 'lat': 47.37 + no*0.001, 'lon': 8.54})
+
+
+class Commuting(CommutingTimes):
+    DESTINATION = []
+    COMMUTE_CACHE = None
+    FAILING = {'homegate-2'}
+    ROUTED = []
+
+    def getCommutingTimes(self):
+        unit = self.DATA.url.iloc[0].split('/')[0]
+        Commuting.ROUTED.append(unit)
+        if unit in self.FAILING:
+            return None # as after a failed test() of the transport API
+        return self.DATA.assign(mins_sbb_1=20)
+
+
+def test_failedUnitIsRetriedOnResume(tmp_path):
+    class Run(Pipeline):
+        SCRAPER = Pages
+        COMMUTING = Commuting
+        RUN_DIR = str(tmp_path)
+
+    run = Run()
+    listings = run.run()
+    assert sorted(listings.url.str.split('/').str[0].unique()) == ['homegate-1', 'homegate-3']
+    assert [(stage, unit) for stage, unit, e in run.ERRORS] == [('commute', 'homegate-2')]
+    with open(os.path.join(str(tmp_path), 'errors.jsonl')) as f:
+        errors = [json.loads(line) for line in f]
+    assert [(error['stage'], error['unit']) for error in errors] == [('commute', 'homegate-2')]
+
+    Pages.SCRAPED.clear()
+    Commuting.ROUTED.clear()
+    Commuting.FAILING = set()
+    run = Run()
+    listings = run.run()
+    assert Pages.SCRAPED == []
+    assert Commuting.ROUTED == ['homegate-2']
+    assert run.ERRORS == []
+    assert len(listings) == 9
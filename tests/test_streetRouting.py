@@ -0,0 +1,56 @@
+# -*- coding: utf-8 -*-
+"""
+Street routing on the sample extract (data/streets_sample.osm). Run from the repository: python -m pytest tests
+"""
+
+import os
+
+import numpy as np
+import pytest
+
+from scrapeApartments import haversine
+from streetRouting import StreetGraph, SPEEDS
+
+
+SAMPLE = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'data', 'streets_sample.osm')
+
+NODE1 = (47.0000, 8.0000)
+NODE3 = (47.0020, 8.0000)
+NODE10 = (47.1000, 8.0000)
+NODE11 = (47.1010, 8.0000)
+
+
+class Bike(StreetGraph):
+    PATH = SAMPLE
+    MEANS = 'bike'
+
+
+class Walk(StreetGraph):
+    PATH = SAMPLE
+    MEANS = 'walk'
+
+
+def minutes(meters, means):
+    return meters / SPEEDS[means] / 60
+
+
+def test_oneway():
+    meters = haversine(NODE1, (47.0010, 8.0000)) + haversine((47.0010, 8.0000), NODE3)
+    bike = Bike()
+    assert bike.travelTimes([NODE1], NODE3)[0] == pytest.approx(minutes(meters, 'bike'))
+    assert np.isnan(bike.travelTimes([NODE3], NODE1)[0]) # against the one-way street
+    assert Walk().travelTimes([NODE3], NODE1)[0] == pytest.approx(minutes(meters, 'walk'))
+
+
+def test_duplicateSegment():
+    # two ways over the same segment: its travel time once, not summed
+    bike = Bike()
+    assert len(bike.EDGES[0]) == 2 + 2 # one-way (2 segments) and the segment in both directions
+    assert bike.travelTimes([NODE10], NODE11)[0] == pytest.approx(minutes(haversine(NODE10, NODE11), 'bike'))
+
+
+def test_beyondSnapDistance():
+    far = (47.0100, 8.0000) # about 900 m from the closest node
+    times = Bike().travelTimes([NODE1, far], NODE3)
+    assert np.isfinite(times[0])
+    assert np.isnan(times[1])
@@ -0,0 +1,287 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Asynchronous client for the connections endpoint of transport.opendata.ch (SBB timetable), and a local
+stand-in server of this endpoint to benchmark throughput and failure handling offline.
+
+The client keeps one pool of connections (aiohttp), limits the number of concurrent requests and
+the requests per second, and retries rate limited (429) or failed (5xx, timeouts) requests with an
+exponential backoff, respecting the Retry-After header. Error payloads do not raise: the result
+of such a query contains no connections and the error message.
+
+Usage:
+    class Client(TransportClient):
+        MAX_CONCURRENCY = 10
+    results = Client().connections([(origin, destination, '2022-04-04T08:00'), ...])
+
+    server = MockTransportServer()   # http://127.0.0.1:<port>/v1/connections
+    server.start()
+    benchmark(server.URL, nQueries=500)
+    server.stop()
+
+"""
+
+import asyncio
+import concurrent.futures
+import json
+import random
+import threading
+import time
+import email.utils
+from datetime import datetime, timezone
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+
+import aiohttp
+import yarl
+
+from scrapeApartments import haversine
+
+
+class TransportClient:
+    """
+    Async client for the connections of transport.opendata.ch.
+
+    Parameters:
+        BASE_URL (str): URL of the API (or of the MockTransportServer)
+        MAX_CONCURRENCY (int): max. number of requests in flight (and size of the connection pool)
+        REQUESTS_PER_SECOND (float): max. number of requests started per second (None: no limit)
+        MAX_RETRIES (int): retries of a request failing with 429, 5xx or a timeout
+        BACKOFF (float): wait (seconds) before the first retry, doubled with each retry (unless Retry-After is given)
+        TIMEOUT (float): timeout of a request in seconds
+    """
+
+    BASE_URL = 'http://transport.opendata.ch/v1'
+    MAX_CONCURRENCY = 10
+    REQUESTS_PER_SECOND = None
+    MAX_RETRIES = 4
+    BACKOFF = 1.0
+    TIMEOUT = 30
+
+    def __init__(self):
+        self.STATS = {'requests': 0, 'retries': 0, 'failures': 0}
+
+
+    def connections(self, queries):
+        """
+        Fetches the connections for many queries at once.
+
+        Parameters
+        ----------
+        queries : list of tuples
+            (origin, destination, datetime) with origin/destination as (lat, lon) and datetime as
+            'YYYY-MM-DDTHH:MM' (or '' for now)
+
+        Returns
+        -------
+        list of dict (json of the API) in the order of the queries. Failed queries
+            return {'connections': [], 'error': message}.
+
+        """
+        coroutine = self.__fetchAll(queries)
+        try:
+            asyncio.get_running_loop()
+        except RuntimeError:
+            return asyncio.run(coroutine)
+        # e.g. in a jupyter notebook: the event loop is running already
+        with concurrent.futures.ThreadPoolExecutor(max_workers=1) as executor:
+            return executor.submit(asyncio.run, coroutine).result()
+
+
+    def url(self, origin, destination, when):
+        return (self.BASE_URL + '/connections?from=' + str(origin[0]) + '+' + str(origin[1]) +
+                '&to=' + str(destination[0]) + '+' + str(destination[1]) + '&datetime=' + when.replace(':', '%3A'))
+
+
+    async def __fetchAll(self, queries):
+        connector = aiohttp.TCPConnector(limit=self.MAX_CONCURRENCY)
+        timeout = aiohttp.ClientTimeout(total=self.TIMEOUT)
+        self.__semaphore = asyncio.Semaphore(self.MAX_CONCURRENCY)
+        self.__interval = 1 / self.REQUESTS_PER_SECOND if self.REQUESTS_PER_SECOND else 0
+        self.__next = time.monotonic()
+
+        async with aiohttp.ClientSession(connector=connector, timeout=timeout) as session:
+            return await asyncio.gather(*[self.__fetch(session, *query) for query in queries])
+
+
+    async def __throttle(self):
+        if self.__interval <= 0:
+            return
+        now = time.monotonic()
+        slot = max(now, self.__next)
+        self.__next = slot + self.__interval
+        await asyncio.sleep(slot - now)
+
+
+    async def __fetch(self, session, origin, destination, when):
+        url = yarl.URL(self.url(origin, destination, when), encoded=True)
+        error = ''
+
+        for attempt in range(self.MAX_RETRIES + 1):
+            wait = self.BACKOFF * 2**attempt
+            async with self.__semaphore:
+                await self.__throttle()
+                self.STATS['requests'] += 1
+                try:
+                    async with session.get(url) as response:
+                        text = await response.text()
+                        if response.status == 200:
+                            payload = json.loads(text)
+                            if 'connections' in payload:
+                                return payload
+                            error = errorMessage(payload)
+                            break
+                        error = 'HTTP {}: {}'.format(response.status, text[:200])
+                        if response.status not in (429, 500, 502, 503, 504):
+                            break
+                        wait = retryAfter(response.headers.get('Retry-After'), wait)
+                except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as e:
+                    error = '{}: {}'.format(type(e).__name__, e)
+
+            if attempt < self.MAX_RETRIES:
+                self.STATS['retries'] += 1
+                await asyncio.sleep(wait)
+
+        self.STATS['failures'] += 1
+        return {'connections': [], 'error': error}
+
+
+def errorMessage(payload):
+    """ Message of an error payload of the API """
+    try:
+        return payload['errors'][0]['message']
+    except (KeyError, IndexError, TypeError):
+        return str(payload)[:200]
+
+
+def retryAfter(header, default):
+    """ Seconds to wait given the Retry-After header (seconds or HTTP date) """
+    if header is None:
+        return default
+    try:
+        return max(0.0, float(header))
+    except ValueError:
+        pass
+    try:
+        until = email.utils.parsedate_to_datetime(header)
+        return max(0.0, (until - datetime.now(timezone.utc)).total_seconds())
+    except (TypeError, ValueError):
+        return default
+
+
+##################################################################################
+#
+# Local stand-in server
+#
+##################################################################################
+
+class MockTransportServer:
+    """
+    Local stand-in for the connections endpoint (GET /v1/connections?from=lat+lon&to=lat+lon&datetime=...).
+    Returns plausible connections (duration from the air distance) after LATENCY seconds, and fails
+    randomly with 429 (Retry-After: RETRY_AFTER) or 500 to test the failure handling.
+
+    Parameters:
+        HOST (str): interface to listen on
+        PORT (int): port (0: any free port, see URL after start())
+        LATENCY (float): seconds per response
+        RATE_LIMITED (float): share of the requests answered with 429
+        FAILING (float): share of the requests answered with 500
+        RETRY_AFTER (int): seconds sent with the Retry-After header
+        SEED (int): seed of the random failures
+    """
+
+    HOST = '127.0.0.1'
+    PORT = 0
+    LATENCY = 0.05
+    RATE_LIMITED = 0.0
+    FAILING = 0.0
+    RETRY_AFTER = 1
+    SEED = 0
+
+    def __init__(self):
+        self.random = random.Random(self.SEED)
+        self.requests = 0
+        self.server = None
+
+
+    def start(self):
+        mock = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                mock.requests += 1
+                time.sleep(mock.LATENCY)
+                status, headers, body = mock.respond(self.path)
+                self.send_response(status)
+                for key, value in headers.items():
+                    self.send_header(key, value)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer((self.HOST, self.PORT), Handler)
+        self.server.daemon_threads = True
+        self.URL = 'http://{}:{}/v1'.format(self.HOST, self.server.server_address[1])
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+
+    def stop(self):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+
+
+    def respond(self, path):
+        """ Returns status, headers and body for a request path """
+        url = urlparse(path)
+        if url.path.rstrip('/') != '/v1/connections':
+            return 404, {}, b'{"errors":[{"message":"Not found"}]}'
+
+        draw = self.random.random()
+        if draw < self.RATE_LIMITED:
+            return 429, {'Retry-After': str(self.RETRY_AFTER)}, b'{"errors":[{"message":"Rate limit exceeded"}]}'
+        if draw < self.RATE_LIMITED + self.FAILING:
+            return 500, {}, b'{"errors":[{"message":"Internal server error"}]}'
+
+        query = parse_qs(url.query)
+        try:
+            origin = [float(x) for x in query['from'][0].split()]
+            destination = [float(x) for x in query['to'][0].split()]
+        except (KeyError, ValueError):
+            return 200, {}, b'{"errors":[{"message":"from/to missing"}]}'
+
+        minutes = 5 + haversine(origin, destination) / 1000 / 25 * 60 # 25 km/h on average + 5 min.
+        connections = []
+        for i in range(4):
+            m = int(round(minutes + 3*i))
+            connections.append({'duration': '00d{:02d}:{:02d}:00'.format(m // 60, m % 60), 'transfers': i % 2})
+        return 200, {}, json.dumps({'connections': connections}).encode()
+
+
+def benchmark(baseURL, nQueries=500, maxConcurrency=20):
+    """
+    Sends nQueries to baseURL (e.g. of a MockTransportServer) and returns the throughput and
+    the failure statistics of the TransportClient.
+    """
+    class Client(TransportClient):
+        BASE_URL = baseURL
+        MAX_CONCURRENCY = maxConcurrency
+        BACKOFF = 0.1
+
+    rng = random.Random(1)
+    queries = [((47.3 + rng.random()*0.2, 8.4 + rng.random()*0.3), (47.3782, 8.5402), '') for _ in range(nQueries)]
+    client = Client()
+    t0 = time.time()
+    results = client.connections(queries)
+    seconds = time.time() - t0
+
+    stats = dict(client.STATS)
+    stats.update({'queries': nQueries, 'seconds': seconds, 'queries_per_s': nQueries / seconds,
+                  'empty': sum(1 for r in results if not r['connections'])})
+    return stats